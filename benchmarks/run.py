@@ -0,0 +1,194 @@
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from datetime import datetime
+from importlib import metadata
+from pathlib import Path
+
+from absl import app, flags
+
+from pea.analysis import AnalysisOptions, find_target_region, count_query_seqs, align_query_seqs, run_align_mutations
+from pea.util import NamedArgs, UserRegion, IndicatorLocator, matchUpto1, locate_indicators
+from pea.util import user_region_alignment, user_region_query
+from pea.util_io import iter_fastq
+from pea.read_store import ReadStore
+from .synthetic import library_from_flags, write_fastqjoin
+
+try:
+    import maund_default
+except ImportError:  # Levenshtein is not installed
+    maund_default = None
+
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string('input', None, "fastqjoin file to benchmark; synthetic reads are generated if not given")
+flags.DEFINE_string('results', None, "Output JSON file; benchmark.<commit>.json if not given")
+flags.DEFINE_string('baseline', None, "Results JSON of an earlier run to compare stage times with")
+flags.DEFINE_float('max_slowdown', 1.2, "Stage time ratio to the baseline above which the run fails")
+flags.DEFINE_integer('repeats', 3, "Number of runs of each stage; the fastest is reported")
+flags.DEFINE_multi_string('be_mut', ['AtoG', 'CtoT'], "Base editing mutations of the be_stats stage")
+flags.DEFINE_multi_string('nonX_mut', ['C', 'G'], "X to non-X mutations of the be_stats stage")
+flags.DEFINE_multi_integer('split_pos', [5, 10], "1-based positions of the split_align_file stage")
+flags.DEFINE_string('maund_rgen', None, "RGEN sequence of the MAUND stage; --target_seq if not given")
+
+flags.DEFINE_integer('comparison_radius', 60, "Radius for a comparison range")
+flags.DEFINE_integer('indicator_seq_length', 15, "Length of indicator sequences")
+flags.DEFINE_integer('pam_length', 3, "Length of PAM seq; e.g. 3 for NGG")
+flags.DEFINE_integer('workers', 1, "Number of processes aligning unique query sequences")
+flags.DEFINE_integer('fast_path_max_mismatches', None,
+                     "Substitutions up to which equal-length queries skip the aligner; negative disables")
+flags.DEFINE_boolean('banded_alignment', False, "Align queries within a diagonal band first")
+flags.DEFINE_integer('band_margin', 10, "Band half-width beyond the query/reference length difference")
+
+GENERATOR_FLAGS = ['amplicon_seq', 'target_seq', 'user_target_mutation', 'user_region_length',
+                   'user_region_beg_offset', 'n_reads', 'diversity', 'substitution_rate', 'indel_rate',
+                   'prime_edit_rate', 'reverse_fraction', 'seed']
+VERSIONED_PACKAGES = ['numpy', 'pandas', 'biopython', 'fastparquet', 'Levenshtein']
+REPO_DIR = Path(__file__).resolve().parent.parent
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=REPO_DIR).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def package_versions():
+    versions = {}
+    for name in VERSIONED_PACKAGES:
+        try:
+            versions[name] = metadata.version(name)
+        except metadata.PackageNotFoundError:
+            versions[name] = None
+    return versions
+
+
+def run_program(module, *args):
+    subprocess.run([sys.executable, '-m', module, *args], check=True, stdout=subprocess.DEVNULL,
+                   stderr=subprocess.DEVNULL, env=dict(os.environ, PYTHONPATH=str(REPO_DIR)))
+
+
+class Stages:
+    """Wall-clock times of named stages over repeated runs."""
+    def __init__(self, repeats):
+        self.repeats = repeats
+        self.runs = {}
+
+    def time(self, name, func, *args, **kwargs):
+        """Run func repeats times, record the times under name and return the last result."""
+        for _ in range(self.repeats):
+            t = time.perf_counter()
+            result = func(*args, **kwargs)
+            self.runs.setdefault(name, []).append(time.perf_counter() - t)
+        print(f'{name}: {min(self.runs[name]):.4f} s', file=sys.stderr)
+        return result
+
+    def to_dict(self):
+        return {name: {'seconds': min(runs), 'runs': runs} for name, runs in self.runs.items()}
+
+
+def run_stages(fastqjoin_path, workdir, stages):
+    """Time every stage on one fastqjoin file; returns counts of the data seen."""
+    options = AnalysisOptions.from_flags(FLAGS)
+    aseq, tr = find_target_region(FLAGS.amplicon_seq.upper(), FLAGS.target_seq.upper(), options)
+    ur = UserRegion.build(tr.pam_beg, options.user_region_beg_offset, options.user_region_length)
+    idc_l = tr.left_indicator_seq(options.indicator_seq_length)
+    idc_r = tr.right_indicator_seq(options.indicator_seq_length)
+
+    reads = stages.time('read', lambda: list(iter_fastq(fastqjoin_path)))
+    read_counts = stages.time('dedup', Counter, reads)
+    stages.time('packed_dedup', ReadStore.from_fastq, fastqjoin_path)
+    unique_reads = list(read_counts)
+    stages.time('matchUpto1', lambda: [matchUpto1(idc_l, x) for x in unique_reads])
+    stages.time('locate_indicators', locate_indicators, idc_l, unique_reads)
+    locator = IndicatorLocator(options.indicator_search)
+    query_seq_counts, _ = stages.time('query_seqs', count_query_seqs, read_counts, idc_l, idc_r, locator, True)
+    stages.time('align_read_to_user_region', align_query_seqs, user_region_alignment, query_seq_counts, tr, ur, options)
+    pe_query_seq_counts, _ = count_query_seqs(read_counts, idc_l, idc_r, locator, False)
+    stages.time('get_user_region_query', align_query_seqs, user_region_query, pe_query_seq_counts, tr, ur, options)
+
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        prefix = run_align_mutations(NamedArgs.build(f'aseq:{FLAGS.amplicon_seq}').upper(),
+                                     NamedArgs.build(f'target:{FLAGS.target_seq}').upper(),
+                                     fastqjoin_path, 'benchmark', options)
+        # be_stats and split_align_file are timed as programs, on the align table of this file.
+        align_file = f'{prefix}.align.csv'
+        be_args = [f'--be_mut={x}' for x in FLAGS.be_mut] + [f'--nonX_mut={x}' for x in FLAGS.nonX_mut]
+        stages.time('be_stats', run_program, 'pea.be_stats', f'--input_file_glob={align_file}', *be_args)
+        split_args = [f'--pos={x}' for x in FLAGS.split_pos] + ['--beg=0', f'--end={options.user_region_length}']
+        stages.time('split_align_file', run_program, 'pea.split_align_file', f'--input_file_glob={align_file}',
+                    *split_args)
+    finally:
+        os.chdir(cwd)
+
+    if maund_default is None:
+        print('maund: skipped, Levenshtein is not installed', file=sys.stderr)
+    else:
+        rgen = FLAGS.maund_rgen or FLAGS.target_seq
+        # A new engine per run, so memoized alignments are not reused across repeats.
+        stages.time('maund', lambda: maund_default.Maund(FLAGS.amplicon_seq, rgen).analyze(fastqjoin_path))
+    return {'reads': len(reads), 'unique_reads': len(unique_reads), 'queries': len(query_seq_counts)}
+
+
+def compare(results, baseline):
+    """Print stage times against a baseline; returns the stages slower than --max_slowdown."""
+    if results['parameters'] != baseline.get('parameters'):
+        print('Warning: the baseline was run with different parameters', file=sys.stderr)
+    slower = []
+    for name, stage in results['stages'].items():
+        if name not in baseline['stages']:
+            continue
+        ratio = stage['seconds'] / baseline['stages'][name]['seconds']
+        print(f'{name:28s} {baseline["stages"][name]["seconds"]:9.4f} {stage["seconds"]:9.4f} {ratio:6.2f}x')
+        if ratio > FLAGS.max_slowdown:
+            slower.append(name)
+    return slower
+
+
+def main(argv):
+    del argv
+    parameters = {k: FLAGS[k].value for k in GENERATOR_FLAGS}
+    parameters.update({k: FLAGS[k].value for k in AnalysisOptions._fields if k in FLAGS})
+    results = {'commit': git_commit(),
+               'created': datetime.now().isoformat(timespec='seconds'),
+               'python': platform.python_version(),
+               'platform': platform.platform(),
+               'versions': package_versions(),
+               'input': FLAGS.input,
+               'parameters': parameters}
+
+    stages = Stages(FLAGS.repeats)
+    with tempfile.TemporaryDirectory() as workdir:
+        fastqjoin_path = FLAGS.input
+        if fastqjoin_path is None:
+            fastqjoin_path = FLAGS.output or os.path.join(workdir, 'synthetic.fastqjoin')
+            library = library_from_flags()
+            write_fastqjoin(fastqjoin_path, library.reads(FLAGS.n_reads, FLAGS.reverse_fraction))
+        results['counts'] = run_stages(os.path.abspath(fastqjoin_path), workdir, stages)
+    results['stages'] = stages.to_dict()
+
+    output = FLAGS.results or f'benchmark.{(results["commit"] or "unknown")[:10]}.json'
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'Results saved to {output}', file=sys.stderr)
+
+    if FLAGS.baseline:
+        with open(FLAGS.baseline) as f:
+            slower = compare(results, json.load(f))
+        if slower:
+            print(f'Slower than the baseline by more than {FLAGS.max_slowdown}x: {", ".join(slower)}', file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    app.run(main)
@@ -0,0 +1,110 @@
+import numpy as np
+from absl import app, flags
+
+from pea.analysis import AnalysisOptions, find_target_region
+from pea.util import UserRegion, revertedSeq
+
+
+FLAGS = flags.FLAGS
+
+EXAMPLE_AMPLICON = ('ccctggtcaacctcaacctaggcctcctatttattctagccacctctagcctagccgtttactcaatcctctgatcagggtgagcatcaaactcaaa'
+                    'ctacgccctgatcggcgcactgcgagcagtagcccaaacaatctcatatgaagtcaccctagccatcattctactatcaacattactaataagtggct'
+                    'cctttaacctctccaccctt')
+EXAMPLE_TARGET = 'actcaatcctctgatc'
+TRANSITIONS = str.maketrans('ACGT', 'GTAC')
+
+flags.DEFINE_string('amplicon_seq', EXAMPLE_AMPLICON, "Amplicon sequence of the simulated library")
+flags.DEFINE_string('target_seq', EXAMPLE_TARGET, "Target RGEN sequence in the amplicon")
+flags.DEFINE_string('user_target_mutation', None, "User region sequence of prime-edited molecules; "
+                    "a transition at the 4th base of the user region if not given")
+flags.DEFINE_integer('user_region_length', 30, "Length of the user region")
+flags.DEFINE_integer('user_region_beg_offset', 3, "Starting offset of user region, from a PAM start position.")
+flags.DEFINE_integer('n_reads', 100000, "Number of reads")
+flags.DEFINE_integer('diversity', 10000, "Number of molecules in the library; unmutated ones share a sequence")
+flags.DEFINE_float('substitution_rate', 0.002, "Per-base substitution rate of a molecule")
+flags.DEFINE_float('indel_rate', 0.0005, "Per-base rate of 1-base insertions and deletions of a molecule")
+flags.DEFINE_float('prime_edit_rate', 0.1, "Fraction of molecules carrying the user target mutation")
+flags.DEFINE_float('reverse_fraction', 0.5, "Fraction of reads on the reverse strand")
+flags.DEFINE_integer('seed', 0, "Random seed")
+flags.DEFINE_string('output', None, "Output fastqjoin file of the synthetic reads")
+
+
+class Library:
+    """Simulated amplicon library: distinct molecules with log-normal abundances.
+
+    Molecules are the amplicon, prime-edited at the user region with
+    probability prime_edit_rate, then given random substitutions and 1-base
+    indels. Reads are drawn from the molecules by abundance and reverse
+    complemented with probability reverse_fraction.
+    """
+    def __init__(self, aseq, target_seq, user_target_mutation=None, user_region_length=30, user_region_beg_offset=3,
+                 diversity=10000, substitution_rate=0.002, indel_rate=0.0005, prime_edit_rate=0.1, seed=0):
+        options = AnalysisOptions(user_region_length=user_region_length, user_region_beg_offset=user_region_beg_offset)
+        aseq, tr = find_target_region(aseq.upper(), target_seq.upper(), options)
+        if tr is None:
+            raise ValueError(f'{target_seq} is not in the amplicon sequence')
+        ur = UserRegion.build(tr.pam_beg, user_region_beg_offset, user_region_length)
+        user_region_seq = aseq[ur.beg:ur.end]
+        if user_target_mutation is None:
+            user_target_mutation = user_region_seq[:3] + user_region_seq[3].translate(TRANSITIONS) + user_region_seq[4:]
+        self.aseq = aseq
+        self.edited_seq = aseq[:ur.beg] + user_target_mutation.upper() + aseq[ur.end:]
+
+        self.rng = np.random.default_rng(seed)
+        edited = self.rng.random(diversity) < prime_edit_rate
+        self.molecules = [self.mutate(self.edited_seq if e else aseq, substitution_rate, indel_rate) for e in edited]
+        self.reverted = [revertedSeq(x) for x in self.molecules]
+        abundance = self.rng.lognormal(0, 1, diversity)
+        self.p = abundance / abundance.sum()
+
+    def mutate(self, seq, substitution_rate, indel_rate):
+        u = self.rng.random(len(seq))
+        events = np.flatnonzero(u < substitution_rate + indel_rate)
+        if not len(events):
+            return seq
+        seq = list(seq)
+        for i in events[::-1]:
+            if u[i] < substitution_rate:
+                seq[i] = 'ACGT'.replace(seq[i], '')[self.rng.integers(3)]
+            elif u[i] < substitution_rate + indel_rate / 2:
+                del seq[i]
+            else:
+                seq.insert(i, 'ACGT'[self.rng.integers(4)])
+        return ''.join(seq)
+
+    def reads(self, n_reads, reverse_fraction=0.5, chunk_size=100000):
+        """Yield n_reads read sequences, drawn chunk_size at a time."""
+        for beg in range(0, n_reads, chunk_size):
+            n = min(chunk_size, n_reads - beg)
+            idx = self.rng.choice(len(self.molecules), n, p=self.p)
+            reverse = self.rng.random(n) < reverse_fraction
+            for i, r in zip(idx.tolist(), reverse.tolist()):
+                yield self.reverted[i] if r else self.molecules[i]
+
+
+def write_fastqjoin(path, reads, chunk_size=100000):
+    with open(path, 'w') as f:
+        lines = []
+        for i, x in enumerate(reads):
+            lines.append(f'@read{i}\n{x}\n+\n{"I" * len(x)}\n')
+            if len(lines) == chunk_size:
+                f.write(''.join(lines))
+                lines = []
+        f.write(''.join(lines))
+
+
+def library_from_flags():
+    return Library(FLAGS.amplicon_seq, FLAGS.target_seq, FLAGS.user_target_mutation, FLAGS.user_region_length,
+                   FLAGS.user_region_beg_offset, FLAGS.diversity, FLAGS.substitution_rate, FLAGS.indel_rate,
+                   FLAGS.prime_edit_rate, FLAGS.seed)
+
+
+def main(argv):
+    del argv
+    library = library_from_flags()
+    write_fastqjoin(FLAGS.output, library.reads(FLAGS.n_reads, FLAGS.reverse_fraction))
+
+
+if __name__ == '__main__':
+    flags.mark_flag_as_required('output')
+    app.run(main)
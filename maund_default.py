@@ -5,17 +5,25 @@
 
 
 import argparse
+import functools
 import logging
 import time
 import uuid
 
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
 from pathlib import Path
+from typing import NamedTuple
 
 
 import pandas as pd
 import numpy as np
 import Levenshtein as ed
 
+from pea.metrics import Metrics
+from pea.util_io import ReadFilter, REJECT_REASONS, iter_fastq
+
 
 ch = logging.StreamHandler()
 ch.setLevel(logging.DEBUG)
@@ -29,6 +37,10 @@ logger.addHandler(ch)
 write_to_tsv = lambda df, output : df.to_csv(output,header=False,index=False,sep='\t')
 toCharArray = lambda seq : np.array([seq]).astype('S').view('S1')
 revertedSeq = lambda seq : seq.translate(str.maketrans("ATGC", "TACG"))[::-1]
+def stage(metrics, name):
+    """metrics.stage(name), or a block recording nothing if metrics is None."""
+    return nullcontext({}) if metrics is None else metrics.stage(name)
+
 def mismatch(seq1,seq2):
     n = min(len(seq1),len(seq2))
     m = max(len(seq1),len(seq2))
@@ -60,266 +72,416 @@ def matchUpto1(target, seq):
     return -1
 
 
-parser = argparse.ArgumentParser(description='MAUND',
-                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-#parser.add_argument("-v", "--verbosity", action="count", default=0,
-#                    help="increase output verbosity")
-parser.add_argument('aseq')
-parser.add_argument('rgen')
-parser.add_argument('files', nargs='*')
-parser.add_argument('-c','--comparison_range', type=int, default=60)
-parser.add_argument('-b','--window_beg', type=int, default=4, help='The 1-based start index of the window sequence.')
-parser.add_argument('-e','--window_end', type=int, default=7, help='The 1-based end index of the window sequence; last inclusive.')
-parser.add_argument('-ib','--idxseq_beg', type=int, default=13, help='The 1-based start index of the index sequence.')
-parser.add_argument('-ie','--idxseq_end', type=int, default=22, help='The 1-based end index of the index sequence; last inclusive.')
-parser.add_argument('-t','--target_nt',  default='A', choices=['A','C','G','T'], help='Nucleobase to watch mutations in the window sequence.')
-parser.add_argument('-mcut','--mismatch_cutoff', type=int, default=4)
-args = parser.parse_args()
-
-t1=time.time()
-seq_wt,RGEN_seq, f_input = args.aseq, args.rgen, args.files
-seq_wt=seq_wt.upper()     # target seq of 250 bp
-RGEN_seq=RGEN_seq.upper() # 23bp for RGEN
-
-i_window_beg = args.window_beg - 1
-i_window_end = args.window_end
-i_idxseq_beg = args.idxseq_beg - 1
-i_idxseq_end = args.idxseq_end
-nt_target    = args.target_nt
-
-mismatch_cutoff = args.mismatch_cutoff
-
-len_rgen = len(RGEN_seq)
-idx_cleavage = len_rgen-6
-len_crange = args.comparison_range
 filt_n = 1                                       # cutoff for count number
 len_indicator_seq = 15
 
-for file_path in f_input:
-    file_path = Path(file_path).resolve()
-    file_name = file_path.name
-    logger.info("Begin: {} with {}".format(file_name, RGEN_seq))
-    out_name= '{}.{}.maund.out.'.format(file_name,RGEN_seq)
-        
-    i_for =seq_wt.find(RGEN_seq)
-    i_rev = seq_wt.find(revertedSeq(RGEN_seq))
-    if i_for != -1 : 
-        i = i_for
-        start_pos=i+idx_cleavage-len_crange
-        end_pos  =i+idx_cleavage+len_crange        
-        is_rev_match = False
-    elif i_rev != -1 : 
-        i = i_rev
-        start_pos=i+(len_rgen-idx_cleavage)-len_crange
-        end_pos  =i+(len_rgen-idx_cleavage)+len_crange        
-        is_rev_match = True
-    else:
-        logger.error('Cannot find target seqence in amplicon sequence.')
-        raise Exception('Cannot find target seqence in amplicon sequence.')
-    if start_pos < 0:
-        start_pos=0
-    if end_pos > len(seq_wt):
-        end_pos = len(seq_wt)
-    s_seq = seq_wt[i:i+len_rgen]
-    seq_range = seq_wt[start_pos:end_pos]
-    
-    pri_for = seq_range.upper()[:len_indicator_seq]                   # 15bp primer < 1bp mismatch
-    pri_back = seq_range.upper()[-len_indicator_seq:]                 # 15bp primer < 1bp mismatch
-    length_range=len(seq_range)
-    
-    logger.info("Is reverted match? : {}".format(is_rev_match))
-    logger.info("Use amplicon[{}:{}] as comparison range".format(start_pos,end_pos))
-    ###################################################  0
-    with file_path.open("r") as f1 :
-        s1 = f1.read().splitlines()
-    # Get seqence lines
-    seq_lines = s1[1::4]
-    s_N = 'N'
-    
-    df_z1=pd.DataFrame(seq_lines, columns=['frag'])
-    df_z2=df_z1[-df_z1.frag.str.contains(s_N)].copy()
-    df_z2['i_beg']=df_z2.frag.apply(lambda x : matchUpto1(pri_for,x))
-    tmp = df_z2[df_z2.i_beg!=-1].copy()
-    tmp['i_end']=tmp.frag.apply(lambda x : matchUpto1(pri_back,x))
-    df_z3 = tmp[tmp.i_beg<tmp.i_end].apply(lambda x : x.frag[x.i_beg:x.i_end+len(pri_back)], axis=1).copy()
-    df_z4 = df_z3.value_counts()
-    
-    #write_to_tsv(df_z1, out_name+"z1_M1.fastq.txt")
-    #write_to_tsv(df_z2, out_name+"z2_M1.fastq.txt")
-    #write_to_tsv(df_z3, out_name+"z3_M1.fastq.txt")
-    #write_to_tsv(df_z4.reset_index(), out_name+"z4_re_M1.fastq.txt")    #z4 is Series
-    
-    # Write output_all
-    output_window  = out_name+"_window.txt"
-    output_aligned = out_name+"_aligned.txt"    
-
-    #Filter    
-    df_seq_all = df_z4.reset_index()
-    df_seq_all.columns = ['seq','n_seq']
-    df_seq_all['seq_len']=df_seq_all.seq.str.len()
-    df_seq_all=df_seq_all[df_seq_all.n_seq>filt_n]    
-    df_seq_mut      = df_seq_all[(-df_seq_all.seq.str.contains(s_seq))&(df_seq_all.seq_len!=length_range)]
-    df_seq_wt       = df_seq_all[(-df_seq_all.seq.str.contains(s_seq))&(df_seq_all.seq_len==length_range)]
-    df_seq_same_len = df_seq_all[df_seq_all.seq_len==length_range]    
-    
-    write_to_tsv(df_seq_all, out_name+"_all.txt")   
-    write_to_tsv(df_seq_mut, out_name+"_mut.txt")
-    write_to_tsv(df_seq_wt,  out_name+"_WT_subst.txt")
-    write_to_tsv(df_seq_same_len, out_name+"_same_length.txt")
-    
-    def col_sum(col):
-        if col.empty:
-            return 0
-        return col.sum()
-    tot_count      = col_sum(df_seq_all.n_seq)
-    mut_count      = col_sum(df_seq_mut.n_seq)
-    wt_subst_count = col_sum(df_seq_wt.n_seq)
-    same_len_count = col_sum(df_seq_same_len.n_seq)       
-
-    f2_cols     = "#target_seq No_A No_C No_G No_T No_Non_Target ratio_A ratio_C ratio_G ratio_T ratio_non_target t_ratio_A t_ratio_C t_ratio_G t_ratio_T ratio_non_target_to_allWT".split()    
-    f2_cols_rev = "#target_seq No_T No_G No_C No_A No_Non_Target ratio_T ratio_G ratio_C ratio_A ratio_non_target t_ratio_T t_ratio_G t_ratio_C t_ratio_A ratio_non_target_to_allWT".split()    
-    
-    wt_len_total=tot_count-mut_count
-    
-    if is_rev_match : 
-        rgen_cridx_beg = len_crange + idx_cleavage - len_rgen
-        rgen_cridx_end = len_crange + idx_cleavage
-    else :
-        rgen_cridx_beg = len_crange - idx_cleavage
-        rgen_cridx_end = len_crange - idx_cleavage + len_rgen
-        
-    def countPerLocation2(df_target_regions, s_seq):
-        zero = lambda nt : {'targetRegion':nt*len(s_seq), 'n_seq':0}
-        df_reads = df_target_regions[['targetRegion','n_seq']].append([zero('A'),zero('C'),zero('G'),zero('T')], ignore_index=True)
-
-        df_sseq = pd.DataFrame(np.array([s_seq]).astype('S%d'%len_rgen).view('int8'))
-        df = pd.DataFrame(df_reads.targetRegion.astype('S%d'%len_rgen).values.view('int8').reshape(-1,len_rgen))
-        df.index = df_reads.index
-        #df2 : idx nc n_seq
-        df2 = df.stack().reset_index(level=1).merge(df_reads[['n_seq']],left_index=True,right_index=True)
-        df2.columns = ['idx', 'nc', 'n_seq']
-        df3 = pd.pivot_table(df2, values='n_seq', index=['idx'], columns=['nc'], aggfunc=np.sum, fill_value=0)
-        df_subst = df3.unstack().drop(list(zip(*[df_sseq[0],df_sseq.index])), errors='ignore').groupby(level=1).sum()
-        df_count = pd.concat([df3,df_subst],axis=1)
-        return df_count
-
-    def countPerLocation(df_reads, is_rev_match, s_seq):
-        a = rgen_cridx_beg
-        b = rgen_cridx_end
-        df = df_reads.copy()
-        df['targetRegion'] = df_reads.seq.str.slice(a,b)    
-        return countPerLocation2(df, s_seq)
+f2_cols     = "#target_seq No_A No_C No_G No_T No_Non_Target ratio_A ratio_C ratio_G ratio_T ratio_non_target t_ratio_A t_ratio_C t_ratio_G t_ratio_T ratio_non_target_to_allWT".split()
+f2_cols_rev = "#target_seq No_T No_G No_C No_A No_Non_Target ratio_T ratio_G ratio_C ratio_A ratio_non_target t_ratio_T t_ratio_G t_ratio_C t_ratio_A ratio_non_target_to_allWT".split()
+cols_out     = "target_seq No_A No_C No_G No_T No_Non_Target ratio_A ratio_C ratio_G ratio_T ratio_non_target".split()
+cols_out_rev = "target_seq No_T No_G No_C No_A No_Non_Target ratio_T ratio_G ratio_C ratio_A ratio_non_target".split()
 
-    seq_wt_count  = countPerLocation(df_seq_wt, is_rev_match, s_seq)
-    seq_wt_ratio = seq_wt_count/wt_subst_count
-    samelen_ratio = countPerLocation(df_seq_same_len, is_rev_match, s_seq)/same_len_count
 
-    df=pd.concat([pd.DataFrame(list(s_seq)), seq_wt_count.astype('int'), seq_wt_ratio.round(4), samelen_ratio.round(4)],axis=1)
-    df.columns = f2_cols
-    if is_rev_match:
-        df = df[::-1]
-        df["#target_seq"] = df["#target_seq"].map({"A":"T", "T":"A", "C":"G","G":"C"})
-        df.columns = f2_cols_rev
-        df = df[f2_cols]
-    df.to_csv(out_name+"_subst_result.txt",index=False,sep='\t')
+def col_sum(col):
+    if col.empty:
+        return 0
+    return col.sum()
 
-    
-    def hasReplacement(nt, ref, seq):
-        for r,s in zip(ref,seq):
-            if r==nt and r!=s:
-                return True
-        return False
-    
-    #fineMatch : edit distance to target sequence is less than cutoff
-    #well-aligned : no indel and find match to target sequence.
-    noIndelInTargetSeqRegion = lambda ops : 0 == len([op for op in ops if op[0]!='replace' and rgen_cridx_beg<=op[1] and op[1]<rgen_cridx_end])
-    isFineMatch = lambda ops : len([op for op in ops if rgen_cridx_beg<=op[1] and op[1]<rgen_cridx_end]) < mismatch_cutoff
-    
-    def findIdx(editops, idx):
-        ins  = [op for op in editops if op[0]=='insert' and op[1]<idx]
-        dels = [op for op in editops if op[0]=='delete' and op[1]<idx]
-        return idx + len(ins)-len(dels)
-    
-    df_all = df_seq_all.copy()
-    df_all['editops']=df_all.seq.apply(lambda x : ed.editops(seq_range,x))
-    df_fineMatch   = df_all[df_all.editops.apply(isFineMatch)].copy()
-    df_wellAligned = df_fineMatch[df_fineMatch.editops.apply(noIndelInTargetSeqRegion)].copy()    
-    
-    i_rgen = seq_range.find(s_seq)
-    logger.info("Target seq range is located in comparison_range[{}:{}]".format(i_rgen,i_rgen+len_rgen))
-    if is_rev_match :
-        w_beg = i_rgen + len(s_seq) - i_window_end
-        w_end = i_rgen + len(s_seq) - i_window_beg
-    else:
-        w_beg = i_rgen + i_window_beg
-        w_end = i_rgen + i_window_end
-
-    ttmp = seq_range[i_rgen:i_rgen + len_rgen]
-    if is_rev_match:
-        ttmp = revertedSeq(ttmp)
-    assert (ttmp == RGEN_seq)
-    rgen_window = seq_range[w_beg:w_end]
-    if is_rev_match:
-        rgen_window = revertedSeq(rgen_window)
-    ttmp2 = RGEN_seq[i_window_beg:i_window_end]
-    if i_window_end < len(RGEN_seq):
-        logger.info("Check rgen_window validity.")
-        assert (rgen_window == ttmp2)  # for normal cases
-
-    logger.info("{} base editing in window : comparison_range[{}:{}] = {}".format(nt_target,w_beg,w_end,rgen_window))
-    if df_wellAligned.empty :
-        logger.info("No well-aligned case. Skip to generate _window and _aligned")
-        n_total = 0
-        n_mutated = 0
-        mutation_ratio = np.nan
-    else :
-        df_wellAligned['window']=df_wellAligned.apply(lambda x : x.seq[findIdx(x.editops,w_beg):findIdx(x.editops,w_end)], axis=1)
-        df_Win = df_wellAligned[['window','n_seq']].groupby('window').sum().sort_values(by='n_seq',ascending=False).reset_index()
+
+def hasReplacement(nt, ref, seq):
+    for r,s in zip(ref,seq):
+        if r==nt and r!=s:
+            return True
+    return False
+
+
+OP_REPLACE, OP_INSERT, OP_DELETE = 0, 1, 2
+OP_TYPES = {'replace': OP_REPLACE, 'insert': OP_INSERT, 'delete': OP_DELETE}
+
+
+def editopsArrays(editops_list):
+    """Op type, source position, destination position and list index of the
+    ops of many Levenshtein editops lists, as flat arrays."""
+    flat = [op for ops in editops_list for op in ops]
+    names, src, dst = zip(*flat) if flat else ((), (), ())
+    return (np.array([OP_TYPES[x] for x in names], dtype=np.int8), np.array(src, dtype=np.int64),
+            np.array(dst, dtype=np.int64), np.repeat(np.arange(len(editops_list)), [len(ops) for ops in editops_list]))
+
+
+class AlignedRegion(NamedTuple):
+    """Alignment of a read sequence against the comparison range."""
+    fine_match: bool
+    well_aligned: bool
+    window: str
+    target_region: str
+
+
+def countSubstitutions(regions, weights, s_seq):
+    """Weighted A, C, G, T and non-target (not the s_seq base) counts at each
+    position of a reads x positions uint8 matrix of target regions."""
+    n_pos = len(s_seq)
+    cells = (np.arange(n_pos)*256 + regions).ravel()
+    counts = np.bincount(cells, weights=np.repeat(np.asarray(weights, dtype=np.float64), n_pos), minlength=n_pos*256)
+    counts = np.rint(counts).astype(np.int64).reshape(n_pos, 256)
+    non_target = counts.sum(axis=1) - counts[np.arange(n_pos), toCharArray(s_seq).view(np.uint8)]
+    df_count = pd.DataFrame(counts[:, np.frombuffer(b'ACGT', dtype=np.uint8)], columns=list('ACGT'))
+    df_count['non_target'] = non_target
+    return df_count
+
+
+class MaundResult(NamedTuple):
+    """Per-file MAUND tables; window and aligned are None without well-aligned reads."""
+    file_name: str
+    out_name: str
+    seq_all: pd.DataFrame
+    seq_mut: pd.DataFrame
+    seq_wt: pd.DataFrame
+    seq_same_len: pd.DataFrame
+    subst_result: pd.DataFrame
+    window: pd.DataFrame
+    aligned: pd.DataFrame
+    summary: tuple
+
+
+class Maund:
+    """MAUND analysis of fastqjoin files for one amplicon (seq_wt) and RGEN
+    target sequence; the locations of the comparison range, window and index
+    sequence are found once and shared by all files.
+
+    Reads are prefiltered as they are read: by default those with any N are
+    dropped. A read_length_margin keeps the reads no shorter than the
+    comparison range and no longer than the amplicon, give or take the margin.
+    The alignments of the max_aligned_regions most recently seen sequences
+    are kept for the next files.
+    """
+    def __init__(self, seq_wt, RGEN_seq, comparison_range=60, window_beg=4, window_end=7,
+                 idxseq_beg=13, idxseq_end=22, target_nt='A', mismatch_cutoff=4,
+                 max_n=0, read_length_margin=None, min_mean_quality=None, min_base_quality=None,
+                 max_aligned_regions=200000):
+        seq_wt=seq_wt.upper()     # target seq of 250 bp
+        RGEN_seq=RGEN_seq.upper() # 23bp for RGEN
+        self.RGEN_seq = RGEN_seq
+
+        i_window_beg = window_beg - 1
+        i_window_end = window_end
+        i_idxseq_beg = idxseq_beg - 1
+        i_idxseq_end = idxseq_end
+        self.nt_target = target_nt
+        self.mismatch_cutoff = mismatch_cutoff
+
+        self.len_rgen = len_rgen = len(RGEN_seq)
+        idx_cleavage = len_rgen-6
+        len_crange = comparison_range
+
+        i_for =seq_wt.find(RGEN_seq)
+        i_rev = seq_wt.find(revertedSeq(RGEN_seq))
+        if i_for != -1 : 
+            i = i_for
+            start_pos=i+idx_cleavage-len_crange
+            end_pos  =i+idx_cleavage+len_crange        
+            is_rev_match = False
+        elif i_rev != -1 : 
+            i = i_rev
+            start_pos=i+(len_rgen-idx_cleavage)-len_crange
+            end_pos  =i+(len_rgen-idx_cleavage)+len_crange        
+            is_rev_match = True
+        else:
+            logger.error('Cannot find target seqence in amplicon sequence.')
+            raise Exception('Cannot find target seqence in amplicon sequence.')
+        if start_pos < 0:
+            start_pos=0
+        if end_pos > len(seq_wt):
+            end_pos = len(seq_wt)
+        self.is_rev_match = is_rev_match
+        self.s_seq = s_seq = seq_wt[i:i+len_rgen]
+        self.seq_range = seq_range = seq_wt[start_pos:end_pos]
+
+        self.pri_for = seq_range.upper()[:len_indicator_seq]                   # 15bp primer < 1bp mismatch
+        self.pri_back = seq_range.upper()[-len_indicator_seq:]                 # 15bp primer < 1bp mismatch
+        self.length_range=len(seq_range)
+
+        logger.info("Is reverted match? : {}".format(is_rev_match))
+        logger.info("Use amplicon[{}:{}] as comparison range".format(start_pos,end_pos))
+
+        if is_rev_match : 
+            self.rgen_cridx_beg = len_crange + idx_cleavage - len_rgen
+            self.rgen_cridx_end = len_crange + idx_cleavage
+        else :
+            self.rgen_cridx_beg = len_crange - idx_cleavage
+            self.rgen_cridx_end = len_crange - idx_cleavage + len_rgen
+
+        self.i_rgen = i_rgen = seq_range.find(s_seq)
+        logger.info("Target seq range is located in comparison_range[{}:{}]".format(i_rgen,i_rgen+len_rgen))
+        if is_rev_match :
+            w_beg = i_rgen + len(s_seq) - i_window_end
+            w_end = i_rgen + len(s_seq) - i_window_beg
+        else:
+            w_beg = i_rgen + i_window_beg
+            w_end = i_rgen + i_window_end
+        self.w_beg, self.w_end = w_beg, w_end
+
+        ttmp = seq_range[i_rgen:i_rgen + len_rgen]
+        if is_rev_match:
+            ttmp = revertedSeq(ttmp)
+        assert (ttmp == RGEN_seq)
+        rgen_window = seq_range[w_beg:w_end]
         if is_rev_match:
-            df_Win.window=df_Win.window.apply(revertedSeq)
-        df_Win.to_csv(output_window,sep='\t',index=False)
+            rgen_window = revertedSeq(rgen_window)
+        ttmp2 = RGEN_seq[i_window_beg:i_window_end]
+        if i_window_end < len(RGEN_seq):
+            logger.info("Check rgen_window validity.")
+            assert (rgen_window == ttmp2)  # for normal cases
+        self.rgen_window = rgen_window
+        logger.info("{} base editing in window : comparison_range[{}:{}] = {}".format(target_nt,w_beg,w_end,rgen_window))
 
-        n_mutated = col_sum(df_Win[df_Win.window.apply(lambda x : hasReplacement(nt_target,rgen_window,x))].n_seq)
-        n_total   = col_sum(df_Win.n_seq)
-        mutation_ratio = n_mutated/n_total
-    
-    #targetRegion : region that corresponds to the target sequence region
-        tr_beg = i_rgen
-        tr_end = i_rgen + len(s_seq)
-        df_wellAligned['targetRegion']=df_wellAligned.apply(lambda x : x.seq[findIdx(x.editops,tr_beg):findIdx(x.editops,tr_end)], axis=1)
-        counts = countPerLocation2(df_wellAligned[df_wellAligned.targetRegion.str.len()==len(RGEN_seq)], s_seq)
-        #counts = countPerLocation2(df_wellAligned.query('targetRegion.str.len()=={}'.format(len(RGEN_seq))), s_seq)
-        n_total = df_wellAligned.n_seq.sum()
-        counts=pd.concat([pd.DataFrame(list(s_seq),columns=['target_seq']),counts,counts/n_total],axis=1).round(4)
-        cols_out     = "target_seq No_A No_C No_G No_T No_Non_Target ratio_A ratio_C ratio_G ratio_T ratio_non_target".split()
-        cols_out_rev = "target_seq No_T No_G No_C No_A No_Non_Target ratio_T ratio_G ratio_C ratio_A ratio_non_target".split()
         if is_rev_match:
-            counts = counts[::-1]
-            counts.target_seq = counts.target_seq.map({"A":"T", "T":"A", "C":"G","G":"C"})
-            counts.columns = cols_out_rev
-            counts = counts[cols_out]
+            index_beg = i_rgen + len(s_seq) - i_idxseq_end
+            index_end = i_rgen + len(s_seq) - i_idxseq_beg
         else:
-            counts.columns = cols_out
-        counts.to_csv(output_aligned,index=False,sep='\t')
-    
-    if is_rev_match:
-        index_beg = i_rgen + len(s_seq) - i_idxseq_end
-        index_end = i_rgen + len(s_seq) - i_idxseq_beg
-    else:
-        index_beg = i_rgen + i_idxseq_beg
-        index_end = i_rgen + i_idxseq_end
-    index_seq = seq_range[index_beg:index_end]
-    logger.info("Index sequence = comparison_range[{}:{}] = {}".format(index_beg,index_end,index_seq))
-    df_indels = df_seq_all[(-df_seq_all.seq.str.contains(index_seq))&(df_seq_all.seq_len!=len(seq_range))]
-    n_indels = col_sum(df_indels.n_seq)
-    n_all    = df_seq_all.n_seq.sum()
-    indel_ratio = n_indels/n_all    
-    
+            index_beg = i_rgen + i_idxseq_beg
+            index_end = i_rgen + i_idxseq_end
+        self.index_seq = seq_range[index_beg:index_end]
+        with_length = read_length_margin is not None
+        self.read_filter = ReadFilter(max_n,
+                                      len(seq_range) - read_length_margin if with_length else None,
+                                      len(seq_wt) + read_length_margin if with_length else None,
+                                      min_mean_quality, min_base_quality)
+        logger.info("Index sequence = comparison_range[{}:{}] = {}".format(index_beg,index_end,self.index_seq))
+        self.aligned_regions = OrderedDict()
+        self.max_aligned_regions = max_aligned_regions
+        self.n_aligned = 0
+
+    def alignedRegions(self, seqs):
+        """AlignedRegion of each of seqs, memoized by sequence; the least
+        recently used are dropped beyond max_aligned_regions.
+
+        fineMatch : fewer edit ops than mismatch_cutoff in the target seq region
+        well-aligned : fineMatch with no indel in the target seq region
+        The window and target seq region are projected onto the read by
+        counting the insertions and deletions before their bounds.
+        """
+        regions = {}
+        new = []
+        for x in dict.fromkeys(seqs):
+            if x in self.aligned_regions:
+                self.aligned_regions.move_to_end(x)
+                regions[x] = self.aligned_regions[x]
+            else:
+                new.append(x)
+        if new:
+            types, src, _, ids = editopsArrays([ed.editops(self.seq_range, x) for x in new])
+            in_target = (self.rgen_cridx_beg <= src) & (src < self.rgen_cridx_end)
+            fine = np.bincount(ids[in_target], minlength=len(new)) < self.mismatch_cutoff
+            well = fine & (np.bincount(ids[in_target & (types != OP_REPLACE)], minlength=len(new)) == 0)
+            shift = (types == OP_INSERT).astype(np.int64) - (types == OP_DELETE)
+            bounds = [self.w_beg, self.w_end, self.i_rgen, self.i_rgen + len(self.s_seq)]
+            idx = np.array([bound + np.bincount(ids, weights=shift * (src < bound), minlength=len(new))
+                            for bound in bounds]).astype(np.int64)
+            for x, f, w, (wb, we, tb, te) in zip(new, fine, well, idx.T.tolist()):
+                regions[x] = self.aligned_regions[x] = AlignedRegion(bool(f), bool(w), x[wb:we], x[tb:te])
+            self.n_aligned += len(new)
+        while len(self.aligned_regions) > self.max_aligned_regions:
+            self.aligned_regions.popitem(last=False)
+        return [regions[x] for x in seqs]
+
+    def countPerLocation2(self, df_target_regions, s_seq):
+        regions = np.array(df_target_regions.targetRegion.tolist(), dtype='S%d'%self.len_rgen)
+        return countSubstitutions(regions.view(np.uint8).reshape(-1,self.len_rgen), df_target_regions.n_seq.values, s_seq)
+
+    def countPerLocation(self, df_reads, s_seq):
+        a = self.rgen_cridx_beg
+        b = self.rgen_cridx_end
+        df = df_reads.copy()
+        df['targetRegion'] = df_reads.seq.str.slice(a,b)    
+        return self.countPerLocation2(df, s_seq)
+
+    def read_seq_counts(self, file_path, metrics=None):
+        """Counts of the comparison-range sequences between the two indicators."""
+        with stage(metrics, 'read') as record:
+            # Get seqence lines, without the reads the prefilter rejects
+            rejected = Counter()
+            seq_lines = list(iter_fastq(file_path, read_filter=self.read_filter, rejected=rejected))
+            record.update(reads_in=len(seq_lines) + sum(rejected.values()), reads_out=len(seq_lines),
+                          rejected=dict(rejected))
+        logger.info("{} reads rejected by the prefilter: {}".format(
+            sum(rejected.values()), ', '.join('{} by {}'.format(rejected[x], x) for x in REJECT_REASONS)))
+
+        with stage(metrics, 'indicators') as record:
+            pri_for, pri_back = self.pri_for, self.pri_back
+            df_z2=pd.DataFrame(seq_lines, columns=['frag'])
+            df_z2['i_beg']=df_z2.frag.apply(lambda x : matchUpto1(pri_for,x))
+            tmp = df_z2[df_z2.i_beg!=-1].copy()
+            tmp['i_end']=tmp.frag.apply(lambda x : matchUpto1(pri_back,x))
+            df_z3 = tmp[tmp.i_beg<tmp.i_end].apply(lambda x : x.frag[x.i_beg:x.i_end+len(pri_back)], axis=1).copy()
+            record.update(reads_in=len(seq_lines), reads_out=len(df_z3))
+
+        with stage(metrics, 'value_counts') as record:
+            counts = df_z3.value_counts()
+            record.update(reads_in=len(df_z3), unique_seqs=len(counts))
+        return counts
+
+    def analyze(self, file_path, metrics=None):
+        """MaundResult of one fastqjoin file; stages are recorded in metrics if given."""
+        file_path = Path(file_path).resolve()
+        file_name = file_path.name
+        RGEN_seq, s_seq, seq_range = self.RGEN_seq, self.s_seq, self.seq_range
+        is_rev_match = self.is_rev_match
+        logger.info("Begin: {} with {}".format(file_name, RGEN_seq))
+        out_name= '{}.{}.maund.out.'.format(file_name,RGEN_seq)
+
+        df_z4 = self.read_seq_counts(file_path, metrics)
+
+        #Filter    
+        df_seq_all = df_z4.reset_index()
+        df_seq_all.columns = ['seq','n_seq']
+        df_seq_all['seq_len']=df_seq_all.seq.str.len()
+        df_seq_all=df_seq_all[df_seq_all.n_seq>filt_n]    
+        df_seq_mut      = df_seq_all[(-df_seq_all.seq.str.contains(s_seq))&(df_seq_all.seq_len!=self.length_range)]
+        df_seq_wt       = df_seq_all[(-df_seq_all.seq.str.contains(s_seq))&(df_seq_all.seq_len==self.length_range)]
+        df_seq_same_len = df_seq_all[df_seq_all.seq_len==self.length_range]    
+
+        tot_count      = col_sum(df_seq_all.n_seq)
+        mut_count      = col_sum(df_seq_mut.n_seq)
+        wt_subst_count = col_sum(df_seq_wt.n_seq)
+        same_len_count = col_sum(df_seq_same_len.n_seq)       
+
+        wt_len_total=tot_count-mut_count
+
+        seq_wt_count  = self.countPerLocation(df_seq_wt, s_seq)
+        seq_wt_ratio = seq_wt_count/wt_subst_count
+        samelen_ratio = self.countPerLocation(df_seq_same_len, s_seq)/same_len_count
+
+        df=pd.concat([pd.DataFrame(list(s_seq)), seq_wt_count.astype('int'), seq_wt_ratio.round(4), samelen_ratio.round(4)],axis=1)
+        df.columns = f2_cols
+        if is_rev_match:
+            df = df[::-1]
+            df["#target_seq"] = df["#target_seq"].map({"A":"T", "T":"A", "C":"G","G":"C"})
+            df.columns = f2_cols_rev
+            df = df[f2_cols]
+        df_subst_result = df
+
+        df_all = df_seq_all.copy()
+        with stage(metrics, 'align') as record:
+            n_aligned = self.n_aligned
+            regions = pd.DataFrame(self.alignedRegions(df_all.seq.tolist()), index=df_all.index, columns=AlignedRegion._fields)
+            record.update(unique_seqs=len(df_all), alignments=self.n_aligned - n_aligned)
+        well_aligned = regions.well_aligned.astype(bool)
+        df_wellAligned = df_all[well_aligned].copy()
+
+        df_Win = counts = None
+        if df_wellAligned.empty :
+            logger.info("No well-aligned case. Skip to generate _window and _aligned")
+            n_total = 0
+            n_mutated = 0
+            mutation_ratio = np.nan
+        else :
+            df_wellAligned['window']=regions.window[well_aligned]
+            df_Win = df_wellAligned[['window','n_seq']].groupby('window').sum().sort_values(by='n_seq',ascending=False).reset_index()
+            if is_rev_match:
+                df_Win.window=df_Win.window.apply(revertedSeq)
+
+            n_mutated = col_sum(df_Win[df_Win.window.apply(lambda x : hasReplacement(self.nt_target,self.rgen_window,x))].n_seq)
+            n_total   = col_sum(df_Win.n_seq)
+            mutation_ratio = n_mutated/n_total
+
+        #targetRegion : region that corresponds to the target sequence region
+            df_wellAligned['targetRegion']=regions.target_region[well_aligned]
+            counts = self.countPerLocation2(df_wellAligned[df_wellAligned.targetRegion.str.len()==len(RGEN_seq)], s_seq)
+            n_total = df_wellAligned.n_seq.sum()
+            counts=pd.concat([pd.DataFrame(list(s_seq),columns=['target_seq']),counts,counts/n_total],axis=1).round(4)
+            if is_rev_match:
+                counts = counts[::-1]
+                counts.target_seq = counts.target_seq.map({"A":"T", "T":"A", "C":"G","G":"C"})
+                counts.columns = cols_out_rev
+                counts = counts[cols_out]
+            else:
+                counts.columns = cols_out
+
+        df_indels = df_seq_all[(-df_seq_all.seq.str.contains(self.index_seq))&(df_seq_all.seq_len!=len(seq_range))]
+        n_indels = col_sum(df_indels.n_seq)
+        n_all    = df_seq_all.n_seq.sum()
+        indel_ratio = n_indels/n_all    
+
+        summary = (file_name, RGEN_seq, n_mutated, n_total, mutation_ratio, n_indels, n_all, indel_ratio)
+        return MaundResult(file_name, out_name, df_seq_all, df_seq_mut, df_seq_wt, df_seq_same_len,
+                           df_subst_result, df_Win, counts, summary)
+
+
+def write_result(result):
+    """Write the output files of a MaundResult as the MAUND program does."""
+    out_name = result.out_name
+    write_to_tsv(result.seq_all, out_name+"_all.txt")   
+    write_to_tsv(result.seq_mut, out_name+"_mut.txt")
+    write_to_tsv(result.seq_wt,  out_name+"_WT_subst.txt")
+    write_to_tsv(result.seq_same_len, out_name+"_same_length.txt")
+    result.subst_result.to_csv(out_name+"_subst_result.txt",index=False,sep='\t')
+    if result.window is not None:
+        result.window.to_csv(out_name+"_window.txt",sep='\t',index=False)
+        result.aligned.to_csv(out_name+"_aligned.txt",index=False,sep='\t')
+
     with open(out_name+"Miseq_summary.txt",'w') as fsumm:
         #fsumm.write('{}\t{}\t{}\t{}\t{.4f}\n'.format("input_file", "target_seq", "window_mutated", "window_total", "window_ratio"))
         form = '{}\t{}\t{}\t{}\t{:.4f}\t{}\t{}\t{:.4f}\n'
-        fsumm.write(form.format(file_name, RGEN_seq, n_mutated,n_total, mutation_ratio, n_indels, n_all, indel_ratio))
-    
-t2=time.time()
-logger.info('Finished: {:.4f} sec'.format(t2-t1))
+        fsumm.write(form.format(*result.summary))
+
+
+def run_file(maund, file_path, metrics=False, profile=False):
+    """Analyze one file, write its outputs and return its summary row.
+
+    With metrics (or profile), the stage times, read counts and peak RSS are
+    written to <out_name>metrics.json (and a cProfile to <out_name>prof).
+    """
+    m = Metrics('maund', profile) if metrics or profile else None
+    result = maund.analyze(file_path, m)
+    with stage(m, 'write'):
+        write_result(result)
+    if m is not None:
+        m.write(result.out_name)
+    return result.summary
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='MAUND',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    #parser.add_argument("-v", "--verbosity", action="count", default=0,
+    #                    help="increase output verbosity")
+    parser.add_argument('aseq')
+    parser.add_argument('rgen')
+    parser.add_argument('files', nargs='*')
+    parser.add_argument('-c','--comparison_range', type=int, default=60)
+    parser.add_argument('-b','--window_beg', type=int, default=4, help='The 1-based start index of the window sequence.')
+    parser.add_argument('-e','--window_end', type=int, default=7, help='The 1-based end index of the window sequence; last inclusive.')
+    parser.add_argument('-ib','--idxseq_beg', type=int, default=13, help='The 1-based start index of the index sequence.')
+    parser.add_argument('-ie','--idxseq_end', type=int, default=22, help='The 1-based end index of the index sequence; last inclusive.')
+    parser.add_argument('-t','--target_nt',  default='A', choices=['A','C','G','T'], help='Nucleobase to watch mutations in the window sequence.')
+    parser.add_argument('-mcut','--mismatch_cutoff', type=int, default=4)
+    parser.add_argument('-j','--jobs', type=int, default=1, help='Number of input files analyzed in parallel.')
+    parser.add_argument('--max_n', type=int, default=0, help='Reads with more Ns are rejected as they are read.')
+    parser.add_argument('--read_length_margin', type=int, help='Reads shorter than the comparison range or longer than the amplicon by more than this are rejected as they are read.')
+    parser.add_argument('--min_mean_quality', type=float, help='Reads of a lower mean Phred quality are rejected as they are read.')
+    parser.add_argument('--min_base_quality', type=int, help='Reads with a base of lower Phred quality are rejected as they are read.')
+    parser.add_argument('--max_aligned_regions', type=int, default=200000, help='Number of the most recently seen sequences whose alignments are kept for the next files.')
+    parser.add_argument('--metrics', action='store_true', help='Write the time, read counts and peak RSS of each stage to <output prefix>metrics.json.')
+    parser.add_argument('--profile', action='store_true', help='Profile the stages with cProfile into <output prefix>prof; implies --metrics.')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    t1=time.time()
+    maund = Maund(args.aseq, args.rgen, args.comparison_range, args.window_beg, args.window_end,
+                  args.idxseq_beg, args.idxseq_end, args.target_nt, args.mismatch_cutoff,
+                  args.max_n, args.read_length_margin, args.min_mean_quality, args.min_base_quality,
+                  args.max_aligned_regions)
+    run = functools.partial(run_file, maund, metrics=args.metrics, profile=args.profile)
+    if args.jobs <= 1:
+        for file_path in args.files:
+            run(file_path)
+    else:
+        with ProcessPoolExecutor(args.jobs) as executor:
+            list(executor.map(run, args.files))
+    t2=time.time()
+    logger.info('Finished: {:.4f} sec'.format(t2-t1))
+
 
+if __name__ == '__main__':
+    main()
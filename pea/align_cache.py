@@ -0,0 +1,72 @@
+import hashlib
+import json
+import sqlite3
+
+from .util import get_aligner
+
+
+class AlignmentCache:
+    """Size-bounded SQLite store of alignment results.
+
+    Keys hash the alignment helper, the comparison region, the user region
+    bounds, the aligner scores and the query sequence; values are the JSON
+    encoded results. The least recently used entries are evicted once the
+    store holds more than max_entries.
+    """
+    BATCH = 500
+
+    def __init__(self, path, max_entries=1_000_000):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS alignments '
+                          '(key TEXT PRIMARY KEY, value TEXT, last_used INTEGER)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS alignments_last_used ON alignments (last_used)')
+        self.conn.commit()
+        self.tick = self.conn.execute('SELECT COALESCE(MAX(last_used), 0) FROM alignments').fetchone()[0] + 1
+
+    @staticmethod
+    def namespace(func, tr, ur, open_gap_score):
+        aligner = get_aligner(open_gap_score)
+        scores = (aligner.match_score, aligner.mismatch_score, aligner.open_gap_score, aligner.extend_gap_score)
+        h = hashlib.sha1()
+        h.update(f'{func.__name__}\t{tr.comparison_region()}\t{ur.beg - tr.cmp_beg}\t{ur.end - tr.cmp_beg}\t'
+                 f'{scores}\t'.encode())
+        return h
+
+    @staticmethod
+    def key(namespace, query_seq):
+        h = namespace.copy()
+        h.update(query_seq.encode())
+        return h.hexdigest()
+
+    def get_many(self, keys):
+        found = {}
+        for i in range(0, len(keys), self.BATCH):
+            batch = keys[i:i + self.BATCH]
+            rows = self.conn.execute(f'SELECT key, value FROM alignments WHERE key IN ({",".join("?" * len(batch))})',
+                                     batch).fetchall()
+            found.update((k, json.loads(v)) for k, v in rows)
+        self.conn.executemany('UPDATE alignments SET last_used=? WHERE key=?', [(self.tick, k) for k in found])
+        self.conn.commit()
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, items):
+        self.conn.executemany('INSERT OR REPLACE INTO alignments VALUES (?, ?, ?)',
+                              [(k, json.dumps(v), self.tick) for k, v in items])
+        n = self.conn.execute('SELECT COUNT(*) FROM alignments').fetchone()[0]
+        if n > self.max_entries:
+            self.conn.execute('DELETE FROM alignments WHERE key IN '
+                              '(SELECT key FROM alignments ORDER BY last_used LIMIT ?)', (n - self.max_entries,))
+        self.conn.commit()
+        self.tick += 1
+
+    def close(self):
+        self.conn.close()
+
+    def __str__(self):
+        return f'Alignment cache {self.path}: {self.hits} hits, {self.misses} misses'
@@ -0,0 +1,362 @@
+import logging
+from collections import Counter
+from pathlib import Path
+from typing import NamedTuple
+
+import numpy as np
+import pandas as pd
+from termcolor import colored
+
+from .util import TargetRegion, UserRegion, IndicatorLocator, locate_on_both_strands
+from .util import revertedSeq, user_region_query, user_region_alignment, align_queries
+from .util_io import iter_chunks, write_table, output_name, ReadFilter, REJECT_REASONS
+from .read_store import ReadStore
+from .align_cache import AlignmentCache
+from .metrics import Metrics
+from .manifest import write_manifest, is_current
+
+
+logger = logging.getLogger('align_mutations')
+
+
+class AnalysisOptions(NamedTuple):
+    comparison_radius: int = 60
+    indicator_seq_length: int = 15
+    user_region_length: int = 30
+    user_region_beg_offset: int = 3
+    pam_length: int = 3
+    indel_in_alignment: bool = True
+    workers: int = 1
+    fast_path_max_mismatches: int = None
+    alignment_cache: str = None
+    alignment_cache_size: int = 1000000
+    banded_alignment: bool = False
+    band_margin: int = 10
+    indicator_search: str = 'vectorized'
+    output_format: str = 'csv'
+    metrics: bool = False
+    profile: bool = False
+    resume: bool = False
+    max_n: int = None
+    read_length_margin: int = None
+    min_mean_quality: float = None
+    min_base_quality: int = None
+
+    @classmethod
+    def from_flags(cls, flag_values):
+        return cls(**{k: flag_values[k].value for k in cls._fields if k in flag_values})
+
+    @property
+    def open_gap_score(self):
+        return -2.01 if self.indel_in_alignment else -20
+
+
+# Options that do not change the outputs of a run, left out of its manifest
+RUN_ONLY_OPTIONS = ['workers', 'alignment_cache', 'alignment_cache_size', 'metrics', 'profile', 'resume']
+
+
+def find_target_region(aseq, target_seq, options):
+    """(aseq, TargetRegion), trying the reverted amplicon if needed; tr is None if not found."""
+    tr = TargetRegion.build(aseq, target_seq, options.comparison_radius, options.pam_length)
+    if tr is None:
+        logger.info("Cannot find target sequence in the amplicon sequence.")
+        logger.info("Find target sequence in the reverted amplicon sequence.")
+        aseq = revertedSeq(aseq)
+        tr = TargetRegion.build(aseq, target_seq, options.comparison_radius, options.pam_length)
+    if tr is None:
+        logger.error("cannot find the target sequence in the amplicon_seq")
+        logger.error(f"Target sequence: {target_seq}")
+        logger.error(f"Amplicon sequence: {aseq}")
+    return aseq, tr
+
+
+def log_regions(aseq, tr, ur):
+    colored_target_seq=colored(aseq[tr.beg:tr.pam_beg], 'green'
+                                        )+colored(aseq[tr.pam_beg:tr.end], 'green', attrs=['bold', 'reverse'])
+    colored_aseq = aseq[:tr.beg]+colored_target_seq+aseq[tr.end:]
+    colored_aseq2 = aseq[:ur.beg]+colored(aseq[ur.beg:ur.end], 'yellow', attrs=['underline'])+aseq[ur.end:]
+
+    logger.info(f"Green color: {colored('target sequence', 'green')} with {colored('PAM', 'green', attrs=['bold', 'reverse'])}.")
+    logger.info(f"Target seq: {colored_target_seq}")
+    logger.info(f"Amplicon seq: {colored_aseq}")
+    logger.info(f"Amplicon seq: {colored_aseq2}")
+    logger.info(f"Yellow color: {colored('User defined region', 'yellow', attrs=['underline'])} to align with fastqjoin reads.")
+
+
+def run_prefix(program, args, fastqjoin_path, output_nametag):
+    """<fastqjoin>.<arg names>.<program>.<output_nametag>, the prefix of the outputs of a run."""
+    return f'{output_name(Path(fastqjoin_path))}.{".".join(map(str, args))}.{program}.{output_nametag}'
+
+
+def run_parameters(program, args, output_nametag, options):
+    return {'program': program,
+            'args': [f'{x.name}:{x.val}' for x in args],
+            'output_nametag': output_nametag,
+            'options': {k: v for k, v in options._asdict().items() if k not in RUN_ONLY_OPTIONS}}
+
+
+def is_run_current(program, args, fastqjoin_path, output_nametag, options):
+    """Whether the manifest of an earlier run records the same input file,
+    parameters and outputs."""
+    return is_current(run_prefix(program, args, fastqjoin_path, output_nametag),
+                      run_parameters(program, args, output_nametag, options), [Path(fastqjoin_path)])
+
+
+def build_read_filter(options, aseq=None, tr=None):
+    """ReadFilter of the prefilter options, or None if none is set. Given the
+    amplicon and target region, reads must be no shorter than the comparison
+    range and no longer than the amplicon, give or take read_length_margin."""
+    margin = options.read_length_margin
+    with_length = margin is not None and tr is not None
+    read_filter = ReadFilter(options.max_n,
+                             tr.cmp_end - tr.cmp_beg - margin if with_length else None,
+                             len(aseq) + margin if with_length else None,
+                             options.min_mean_quality, options.min_base_quality)
+    return read_filter if read_filter.is_active() else None
+
+
+def read_fastqjoin(fastqjoin_path, read_counts=None, n_reads=None, read_filter=None, rejected=None):
+    """Distinct read counts of a fastqjoin file, its number of reads, and how
+    many of them were left out of read_counts if those were given.
+
+    A file is read into a ReadStore, which keeps the distinct reads packed.
+    Reads failing read_filter are dropped as the file is read, or from the
+    given read_counts by their sequence, and counted by reason in the
+    rejected Counter; it may hold earlier rejections of the given read_counts.
+    Rejected reads are not counted as left out.
+    """
+    rejected = Counter() if rejected is None else rejected
+    if read_counts is None:
+        read_counts = ReadStore.from_fastq(fastqjoin_path, read_filter, rejected)
+    elif read_filter is not None:
+        read_counts = read_filter.filter_counts(read_counts, rejected)
+    n_given = sum(read_counts.values())
+    n_rejected = sum(rejected.values())
+    n_all = n_given + n_rejected if n_reads is None else n_reads
+    logger.info(f"{len(read_counts)} distinct sequences among {n_given} reads.")
+    if read_filter is not None:
+        logger.info(f"{n_rejected} reads rejected by the prefilter: "
+                    f"{', '.join(f'{rejected[x]} by {x}' for x in REJECT_REASONS)}.")
+    return read_counts, n_all, n_all - n_given - n_rejected
+
+
+def count_query_seqs(raw_read_counts, idc_l, idc_r, locator, last_right_indicator):
+    """Query sequence counts from the indicator-bounded part of both strands
+    of the reads, and the number of reads with the left indicator on neither.
+
+    With last_right_indicator (align_mutations) the query runs to the end of
+    the last right indicator after the left one; otherwise (prime_editor) to
+    the end of the first right indicator, which must follow a left indicator
+    that does not start the read. A read whose two strands both hold a query
+    is counted on each. Only the strands holding the left indicator are
+    searched for the right one.
+    """
+    query_seq_counts = Counter()
+    n_unoriented = 0
+    for block in iter_chunks(raw_read_counts.items()):
+        hits = locate_on_both_strands([x for x, _ in block], idc_l, locator)
+        has_left = hits.left >= 0
+        n_unoriented += sum(n for (_, n), fwd, rev in zip(block, has_left[:len(block)], has_left[len(block):])
+                            if not (fwd or rev))
+        i_left = np.flatnonzero(has_left)
+        seq_lines = [hits.seqs[i] for i in i_left]
+        n_reads = [block[i % len(block)][1] for i in i_left]
+        left = hits.left[i_left]
+        if last_right_indicator:
+            right = locator(idc_r, seq_lines, reverse=True)
+            for x, n, b, e in zip(seq_lines, n_reads, left, right):
+                if 0 <= b < e:
+                    query_seq_counts[x[b:e+len(idc_r)]] += n
+        else:
+            right = locator(idc_r, seq_lines) + len(idc_r)
+            for x, n, b, e in zip(seq_lines, n_reads, left, right):
+                if 0 < b < e:
+                    query_seq_counts[x[b:e]] += n
+    if locator.method == 'compare':
+        logger.info(f"Indicator search: {locator.n_discordant} of {locator.n_compared} searches differ "
+                    "between the vectorized and legacy implementations.")
+    return query_seq_counts, n_unoriented
+
+
+def align_query_seqs(result, query_seq_counts, tr, ur, options, align_stats=None):
+    """DataFrame of query_seq and n, most frequent first, and the result of
+    align_queries for each of its rows; counts per route are added to the
+    align_stats Counter if given."""
+    counts = pd.Series(query_seq_counts, dtype='int64').sort_values(ascending=False).to_frame('n')
+    counts.index.name = 'query_seq'
+    seq_counts = counts.reset_index()
+
+    cache = AlignmentCache(options.alignment_cache, options.alignment_cache_size) if options.alignment_cache else None
+    align_stats = Counter() if align_stats is None else align_stats
+    results = align_queries(result, seq_counts.query_seq, tr, ur, options.open_gap_score, options.workers, cache,
+                            options.fast_path_max_mismatches, align_stats,
+                            options.band_margin if options.banded_alignment else None)
+    logger.info(f"Fast path handled {align_stats['fast_path']} of {len(seq_counts)} unique queries "
+                f"({align_stats['fast_path']/max(1, len(seq_counts)):.1%}); {align_stats['banded']} banded, "
+                f"{align_stats['aligned']} aligned.")
+    if cache is not None:
+        logger.info(str(cache))
+        cache.close()
+    return seq_counts, results
+
+
+def count_alignments(record, align_stats):
+    record['unique_seqs'] = sum(align_stats.values())
+    record['alignments'] = align_stats['aligned'] + align_stats['banded']
+    record.update(align_stats)
+
+
+def write_metrics(metrics, prefix, options):
+    if options.metrics or options.profile:
+        metrics.write(f'{prefix}.')
+
+
+def run_align_mutations(aseq_arg, target_seq_arg, fastqjoin_path, output_nametag='out', options=AnalysisOptions(),
+                        read_counts=None, n_reads=None, rejected=None):
+    """Write the <prefix>.align.csv (or .parquet) of one fastqjoin file and return the
+    prefix; None if the target is not in the amplicon or the input is missing.
+
+    read_counts are the distinct reads of the file if it was read already,
+    e.g. the n_reads reads demultiplexed to this target, and rejected the
+    counts of the reads the prefilter dropped meanwhile. The input, parameters
+    and outputs are recorded in <prefix>.manifest.json; with options.resume,
+    a run it records as current is skipped, and the input is hashed for the
+    next one.
+    """
+    args = [aseq_arg, target_seq_arg]
+    prefix = run_prefix('align_mutations', args, fastqjoin_path, output_nametag)
+    if options.resume and is_run_current('align_mutations', args, fastqjoin_path, output_nametag, options):
+        logger.info(f"Skip {fastqjoin_path}: {prefix} is up to date.")
+        return prefix
+
+    aseq, tr = find_target_region(aseq_arg.str, target_seq_arg.str, options)
+    if tr is None:
+        return None
+    ur = UserRegion.build(tr.pam_beg, options.user_region_beg_offset, options.user_region_length)
+    idc_l = tr.left_indicator_seq(options.indicator_seq_length)
+    idc_r = tr.right_indicator_seq(options.indicator_seq_length)
+
+    fastqjoin_path = Path(fastqjoin_path)
+    if read_counts is None and not fastqjoin_path.exists():
+        logger.error(f"No such file or directory: {fastqjoin_path}")
+        return None
+
+    logger.info(f"입력데이터: {fastqjoin_path}")
+    log_regions(aseq, tr, ur)
+
+    metrics = Metrics('align_mutations', options.profile)
+    locator = IndicatorLocator(options.indicator_search)
+    read_filter = build_read_filter(options, aseq, tr)
+    rejected = Counter(rejected)
+    with metrics.stage('read') as record:
+        raw_read_counts, n_all, n_skipped = read_fastqjoin(fastqjoin_path, read_counts, n_reads, read_filter, rejected)
+        n_kept = sum(raw_read_counts.values())
+        record.update(reads_in=n_all, reads_out=n_kept, unique_seqs=len(raw_read_counts), rejected=dict(rejected))
+    with metrics.stage('query_seqs') as record:
+        query_seq_counts, n_unoriented = count_query_seqs(raw_read_counts, idc_l, idc_r, locator, True)
+        record.update(reads_in=n_kept, reads_out=sum(query_seq_counts.values()),
+                      unique_seqs=len(query_seq_counts))
+    n_unoriented += n_skipped
+
+    logger.info(f"Total {n_all} reads in the fastqjoin file.")
+    logger.info(f"{n_unoriented} reads have no left indicator on either strand (unoriented).")
+    logger.info(f"{sum(query_seq_counts.values())} reads are aligned to the amplicon sequence.")
+
+    align_stats = Counter()
+    with metrics.stage('align') as record:
+        seq_counts, alignments = align_query_seqs(user_region_alignment, query_seq_counts, tr, ur, options, align_stats)
+        count_alignments(record, align_stats)
+    with metrics.stage('write') as record:
+        df = pd.DataFrame(alignments, columns=['ref', 'alignment', 'read'])
+        df['n'] = seq_counts.n.values
+        align_count = df.groupby(['ref','alignment','read']).n.sum().to_frame("n_reads").sort_values("n_reads", ascending=False).reset_index()
+
+        align_count['ratio'] = align_count.n_reads / align_count.n_reads.sum()
+
+        output = f'{prefix}.align.{options.output_format}'
+        write_table(align_count, output)
+        record.update(reads_out=align_count.n_reads.sum(), unique_seqs=len(align_count))
+    logger.info(f"Save output to {output}")
+    write_metrics(metrics, prefix, options)
+    write_manifest(prefix, run_parameters('align_mutations', args, output_nametag, options), [fastqjoin_path], [output],
+                   hash_inputs=options.resume)
+    return prefix
+
+
+def run_prime_editor(aseq_arg, target_seq_arg, user_target_mutation_arg, fastqjoin_path, output_nametag='out',
+                     options=AnalysisOptions(), read_counts=None, n_reads=None, rejected=None):
+    """Write the <prefix>.summary.txt and <prefix>.count.csv (or .parquet) of one fastqjoin
+    file and return the prefix; None if the target is not in the amplicon.
+
+    read_counts, n_reads, rejected and the manifest are as in run_align_mutations.
+    With the prefilter on, the reads it rejected by reason (REJECT_REASONS)
+    are appended to the summary line.
+    """
+    target_seq = target_seq_arg.str
+    user_target_mutation = user_target_mutation_arg.str
+    fastqjoin_path = Path(fastqjoin_path)
+    args = [aseq_arg, target_seq_arg, user_target_mutation_arg]
+    prefix = run_prefix('prime_editor', args, fastqjoin_path, output_nametag)
+    if options.resume and is_run_current('prime_editor', args, fastqjoin_path, output_nametag, options):
+        logger.info(f"Skip {fastqjoin_path}: {prefix} is up to date.")
+        return prefix
+
+    aseq, tr = find_target_region(aseq_arg.str, target_seq, options)
+    if tr is None:
+        return None
+    ur = UserRegion.build(tr.pam_beg, options.user_region_beg_offset, options.user_region_length)
+    idc_l = tr.left_indicator_seq(options.indicator_seq_length)
+    idc_r = tr.right_indicator_seq(options.indicator_seq_length)
+
+    user_region_seq = tr.get_slice(ur.beg, ur.end)
+
+    logger.info(f"입력데이터: {fastqjoin_path}")
+    log_regions(aseq, tr, ur)
+
+    metrics = Metrics('prime_editor', options.profile)
+    locator = IndicatorLocator(options.indicator_search)
+    read_filter = build_read_filter(options, aseq, tr)
+    rejected = Counter(rejected)
+    with metrics.stage('read') as record:
+        raw_read_counts, n_all, n_skipped = read_fastqjoin(fastqjoin_path, read_counts, n_reads, read_filter, rejected)
+        n_kept = sum(raw_read_counts.values())
+        record.update(reads_in=n_all, reads_out=n_kept, unique_seqs=len(raw_read_counts), rejected=dict(rejected))
+    with metrics.stage('query_seqs') as record:
+        query_seq_counts, n_unoriented = count_query_seqs(raw_read_counts, idc_l, idc_r, locator, False)
+        record.update(reads_in=n_kept, reads_out=sum(query_seq_counts.values()),
+                      unique_seqs=len(query_seq_counts))
+    n_unoriented += n_skipped
+
+    align_stats = Counter()
+    with metrics.stage('align') as record:
+        seq_counts, queries = align_query_seqs(user_region_query, query_seq_counts, tr, ur, options, align_stats)
+        count_alignments(record, align_stats)
+    with metrics.stage('count') as record:
+        seq_counts['user_region_query'] = queries
+        user_region_query_counts = seq_counts.groupby('user_region_query').n.sum().to_frame('n_reads').sort_values('n_reads', ascending=False)
+        record.update(reads_out=user_region_query_counts.n_reads.sum(), unique_seqs=len(user_region_query_counts))
+
+    df_mut_all = user_region_query_counts.query('index!=@user_region_seq').copy()
+    df_mut_all['seq_len']=df_mut_all.index.str.len()
+    n_all_mutation = df_mut_all.n_reads.sum()
+    n_target_mutation=df_mut_all.query('index==@user_target_mutation').n_reads.sum()
+    n_incorrect_indels=df_mut_all.query(f'index!=@user_target_mutation and seq_len!={len(user_region_seq)}').n_reads.sum()
+    n_mut_others = n_all_mutation - n_target_mutation - n_incorrect_indels
+
+    n_aligned = user_region_query_counts.n_reads.sum()
+
+    fqname = output_name(fastqjoin_path)
+    rejected_cols = ''.join(f'\t{rejected[x]}' for x in REJECT_REASONS) if read_filter is not None else ''
+    with open(f'{prefix}.summary.txt', 'w') as f:
+        f.write(f'{fqname}\t{output_nametag}\t{aseq_arg}\t{target_seq}\t{user_target_mutation}\t'
+                f'{n_target_mutation}\t{n_target_mutation/n_aligned:.5f}\t'
+                f'{n_incorrect_indels}\t{n_incorrect_indels/n_aligned:.5f}\t'
+                f'{n_mut_others}\t{n_mut_others/n_aligned:.5f}\t'
+                # f'{n_all_mutation}\t{n_all_mutation/n_aligned:.5f}\t'
+                f'{n_aligned}\t{n_all}\t{n_unoriented}{rejected_cols}\n')
+    outputs = [f'{prefix}.summary.txt', f'{prefix}.count.{options.output_format}']
+    write_table(user_region_query_counts, outputs[1], index=True)
+    write_metrics(metrics, prefix, options)
+    write_manifest(prefix, run_parameters('prime_editor', args, output_nametag, options), [fastqjoin_path], outputs,
+                   hash_inputs=options.resume)
+    return prefix
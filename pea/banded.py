@@ -0,0 +1,141 @@
+import numpy as np
+
+from .util import encode_seqs
+
+
+STATE_M, STATE_X, STATE_Y = 0, 1, 2
+SCORE_SCALE = 1000
+NO_SCORE = -(1 << 30)
+
+
+class BandedAligner:
+    """Global alignment restricted to a diagonal band, batched over queries.
+
+    Scores are taken from a PairwiseAligner (see get_aligner) and scaled to
+    integers, so ties compare exactly. Row i of the dynamic programming keeps
+    only the columns j = i+lo .. i+hi, where the band covers the query/reference
+    length differences plus margin on both sides. M, X and Y hold the best
+    scores of paths ending in a pair, a deletion (reference base against a gap)
+    and an insertion. Ties are broken M > X > Y while tracing back, which puts
+    gaps leftmost as PairwiseAligner does.
+
+    A path leaving the band has at least two gaps and at most as many pairs as
+    the band edge allows; when the banded optimum does not beat that bound the
+    query is returned as None, to be aligned by the full aligner.
+    """
+    def __init__(self, aligner, margin=10):
+        scores = (aligner.match_score, aligner.mismatch_score, aligner.open_gap_score, aligner.extend_gap_score)
+        scaled = [round(score * SCORE_SCALE) for score in scores]
+        if any(abs(score * SCORE_SCALE - s) > 1e-6 for score, s in zip(scores, scaled)):
+            raise ValueError(f'Alignment scores {scores} are not multiples of 1/{SCORE_SCALE}')
+        self.match_score, self.mismatch_score, self.open_gap_score, self.extend_gap_score = scaled
+        self.margin = margin
+
+    def band(self, n, m_min, m_max):
+        return min(0, m_min - n) - self.margin, max(0, m_max - n) + self.margin
+
+    def out_of_band_bound(self, n, m, lo, hi):
+        """Upper bound on the score of any path leaving the band, for query lengths m."""
+        above = np.where(hi < m, (m - hi - 1) * self.match_score + 2 * self.open_gap_score, NO_SCORE)
+        below = (n + lo - 1) * self.match_score + 2 * self.open_gap_score if lo > -n else NO_SCORE
+        return np.maximum(above, below)
+
+    def _insertions(self, M, X, Y, valid):
+        opened = np.maximum(M, X)
+        opened += self.open_gap_score
+        if self.extend_gap_score:
+            steps = np.arange(M.shape[1], dtype=np.int32) * self.extend_gap_score
+            Y[:, 1:] = np.maximum.accumulate(opened - steps, axis=1)[:, :-1] + steps[:-1]
+        else:
+            np.maximum.accumulate(opened[:, :-1], axis=1, out=Y[:, 1:])
+        Y[~valid] = NO_SCORE
+
+    def align(self, target, queries):
+        """Alignment coordinates (as alignment.coordinates) of queries against
+        target; None for queries that need the full aligner."""
+        n, n_queries = len(target), len(queries)
+        m = np.array([len(q) for q in queries])[:, None]
+        lo, hi = self.band(n, m.min(), m.max())
+        n_band = hi - lo + 1
+        ks = np.arange(n_band)
+
+        offset = n_band + 1
+        query_codes = np.zeros((n_queries, offset + n + m.max() + n_band + 1), dtype=np.uint8)
+        query_codes[:, offset:offset + m.max()] = encode_seqs(queries)
+        target_codes = np.frombuffer(target.encode('ascii'), dtype=np.uint8)
+
+        scores = np.full((3, n + 1, n_queries, n_band), NO_SCORE, dtype=np.int32)
+        M, X, Y = scores
+        j = lo + ks
+        M[0][:, j == 0] = 0
+        self._insertions(M[0], X[0], Y[0], (j >= 1) & (j <= m))
+        for i in range(1, n + 1):
+            j = i + lo + ks
+            valid = (j >= 0) & (j <= m)
+
+            np.maximum(M[i - 1], X[i - 1], out=M[i])
+            np.maximum(M[i], Y[i - 1], out=M[i])
+            beg = offset + i + lo - 1
+            M[i] += np.where(query_codes[:, beg:beg + n_band] == target_codes[i - 1],
+                             np.int32(self.match_score), np.int32(self.mismatch_score))
+            M[i][~(valid & (j >= 1))] = NO_SCORE
+
+            opened = X[i][:, :-1]
+            np.maximum(M[i - 1][:, 1:], Y[i - 1][:, 1:], out=opened)
+            opened += self.open_gap_score
+            np.maximum(opened, X[i - 1][:, 1:] + self.extend_gap_score, out=opened)
+            X[i][~valid] = NO_SCORE
+
+            self._insertions(M[i], X[i], Y[i], valid & (j >= 1))
+
+        rows = np.arange(n_queries)
+        k_end = m[:, 0] - n - lo
+        end_scores = scores[:, n, rows, k_end]
+        best = end_scores.max(axis=0)
+        in_band = best > self.out_of_band_bound(n, m[:, 0], lo, hi)
+
+        costs = np.array([[0, 0, 0],
+                          [self.open_gap_score, self.extend_gap_score, self.open_gap_score],
+                          [self.open_gap_score, self.open_gap_score, self.extend_gap_score]])
+        # Trace all paths back together, collecting the cells where the move
+        # type changes; those are the alignment coordinates.
+        i = np.full(n_queries, n)
+        k = k_end
+        state = np.argmax(end_scores == best, axis=0)
+        active = in_band & ((i > 0) | (i + lo + k > 0))
+        points = [(rows[in_band], i[in_band], m[in_band, 0], np.zeros(in_band.sum(), dtype=int))]
+        step = 0
+        while active.any():
+            step += 1
+            ia, ka, sa, ra = i[active], k[active], state[active], rows[active]
+            pi = ia - (sa != STATE_Y)
+            pk = ka + (sa == STATE_X) - (sa == STATE_Y)
+            pred = scores[:, pi, ra, pk] + costs[sa].T
+            current = np.where(sa == STATE_M, pred.max(axis=0), scores[sa, ia, ra, ka])
+            ps = np.argmax(pred == current, axis=0)
+            pj = pi + lo + pk
+            turn = (ps != sa) | ((pi == 0) & (pj == 0))
+            points.append((ra[turn], pi[turn], pj[turn], np.full(turn.sum(), step)))
+            i[active], k[active], state[active] = pi, pk, ps
+            active = in_band & ((i > 0) | (i + lo + k > 0))
+
+        r, ti, qj, steps = (np.concatenate(x) for x in zip(*points))
+        order = np.lexsort((-steps, r))
+        paths = np.split(np.stack([ti[order], qj[order]]), np.cumsum(np.bincount(r, minlength=n_queries))[:-1], axis=1)
+        return [path if ok else None for path, ok in zip(paths, in_band)]
+
+    def align_many(self, target, query_seqs, batch_size=1024):
+        """Like align, batching queries of similar lengths together."""
+        order = sorted(range(len(query_seqs)), key=lambda i: len(query_seqs[i]))
+        coordinates = [None] * len(query_seqs)
+        beg = 0
+        while beg < len(order):
+            end = beg + 1
+            while (end < len(order) and end - beg < batch_size
+                   and len(query_seqs[order[end]]) - len(query_seqs[order[beg]]) <= self.margin):
+                end += 1
+            idx = order[beg:end]
+            for i, c in zip(idx, self.align(target, [query_seqs[i] for i in idx])):
+                coordinates[i] = c
+            beg = end
+        return coordinates
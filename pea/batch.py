@@ -0,0 +1,182 @@
+import logging
+import sys
+import pkg_resources
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from logging.config import fileConfig
+
+import pandas as pd
+from absl import app, flags
+
+from .util import NamedArgs, INDICATOR_SEARCH_METHODS
+from .util_io import parse_fastqjoin_group_dict, gen_input_fastqjoins, TABLE_FORMATS
+from .analysis import AnalysisOptions, find_target_region, run_align_mutations, run_prime_editor, is_run_current
+from .analysis import build_read_filter
+from .demux import read_target_table, demultiplex
+from .read_store import ReadStore
+
+
+fileConfig(pkg_resources.resource_filename('pea', 'log.ini'), disable_existing_loggers=False)
+logger = logging.getLogger('batch')
+
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_enum('program', None, ['align_mutations', 'prime_editor'], "Analysis to run on every sample")
+flags.DEFINE_string('sample_sheet', None, "CSV file with key, data_dir and range (e.g. 1~96) columns")
+flags.DEFINE_multi_string('sample', [], "Sample sheet key or fastqjoin file; can be specified multiple times. "
+                          "All sample sheet keys if not given")
+flags.DEFINE_integer('jobs', 1, "Number of samples analyzed in parallel")
+
+flags.DEFINE_string('targets', None, "CSV file of pooled targets with amplicon_seq, target_seq and, for prime_editor, "
+                    "user_target_mutation columns (name:seq values); each sample is read once and its reads are "
+                    "demultiplexed among the targets. Replaces --amplicon_seq, --target_seq and --user_target_mutation")
+flags.DEFINE_string('amplicon_seq', None, "Amplicon sequence")
+flags.DEFINE_string('target_seq', None, "Target RGEN sequence")
+flags.DEFINE_string('user_target_mutation', None, "User sequence with desired mutations; prime_editor only")
+flags.DEFINE_string('output_nametag', 'out', "Output filename tag")
+
+flags.DEFINE_integer('comparison_radius', 60, "Radius for a comparison range")
+flags.DEFINE_integer('indicator_seq_length', 15, "Length of indicator sequences")
+flags.DEFINE_integer('user_region_length', 30, "Length for a comparison range")
+flags.DEFINE_integer('user_region_beg_offset', 3, "Starting offset of user region, from a PAM start position.")
+flags.DEFINE_integer('pam_length', 3, "Length of PAM seq; e.g. 3 for NGG")
+flags.DEFINE_bool('indel_in_alignment', True, "Flag for allowing indels during sequence alignment; "
+                  "align_mutations only")
+flags.DEFINE_integer('fast_path_max_mismatches', None,
+                     "Substitutions up to which equal-length queries skip the aligner; "
+                     "capped at, and by default, the largest count that keeps the aligner's result. Negative disables")
+flags.DEFINE_string('alignment_cache', None, "SQLite file caching alignments across runs; disabled if not given")
+flags.DEFINE_integer('alignment_cache_size', 1000000, "Maximum number of alignments kept in the alignment cache")
+flags.DEFINE_boolean('banded_alignment', False,
+                     "Align queries within a diagonal band first; queries it cannot settle use the full aligner")
+flags.DEFINE_integer('band_margin', 10, "Band half-width beyond the query/reference length difference")
+flags.DEFINE_enum('indicator_search', 'vectorized', INDICATOR_SEARCH_METHODS,
+                  "Indicator sequence search; 'compare' runs the vectorized and legacy (matchUpto1) searches and reports differences")
+flags.DEFINE_enum('output_format', 'csv', TABLE_FORMATS,
+                  "Format of the align (align_mutations) or count (prime_editor) tables")
+flags.DEFINE_integer('max_n', None, "Reads with more Ns are rejected as they are read; not checked if not given")
+flags.DEFINE_integer('read_length_margin', None, "Reads shorter than the comparison range or longer than the amplicon "
+                     "by more than this are rejected as they are read; not checked if not given")
+flags.DEFINE_float('min_mean_quality', None, "Reads of a lower mean Phred quality are rejected as they are read; "
+                   "not checked if not given")
+flags.DEFINE_integer('min_base_quality', None, "Reads with a base of lower Phred quality are rejected as they are read; "
+                     "not checked if not given")
+flags.DEFINE_boolean('metrics', False, "Write the time, read counts and peak RSS of each stage to "
+                     "<output prefix>.metrics.json")
+flags.DEFINE_boolean('resume', False, "Skip the samples and targets whose <output prefix>.manifest.json records the "
+                     "same input file, parameters and unchanged outputs")
+flags.DEFINE_boolean('profile', False,
+                     "Profile the stages with cProfile into <output prefix>.prof; implies --metrics")
+
+flags.register_validator('comparison_radius',
+                         lambda x: x > 20,
+                         message='--comparison_radius should be larger than 20')
+
+flags.mark_flag_as_required('program')
+
+
+def run_sample(program, targets, input_fqj, output_nametag, options):
+    """Run every target on one sample; returns an (input_fqj, target, error
+    message or None) tuple per target.
+
+    With several targets the file is read once and its reads are
+    demultiplexed among the targets by their left indicators. The prefilter
+    is applied before, as in a run of each target on its own: the criteria
+    but the length window as the file is read, then the window of each group
+    of targets sharing one. With
+    options.resume, targets whose manifest is current are skipped, and the
+    file is not read if all of them are.
+    """
+    run = run_prime_editor if program == 'prime_editor' else run_align_mutations
+    current = [options.resume and is_run_current(program, target, input_fqj, output_nametag, options)
+               for target in targets]
+    results = [(input_fqj, target, None) for target, c in zip(targets, current) if c]
+    if results:
+        logger.info(f"{input_fqj}: skip {len(results)} of {len(targets)} targets, which are up to date.")
+    targets = [target for target, c in zip(targets, current) if not c]
+    kwargs = [{} for _ in targets]
+    try:
+        if len(targets) > 1:
+            rejected = Counter()
+            read_counts = ReadStore.from_fastq(input_fqj, build_read_filter(options), rejected)
+            n_reads = sum(read_counts.values()) + sum(rejected.values())
+            groups = {}
+            for i, target in enumerate(targets):
+                aseq, tr = find_target_region(target[0].str, target[1].str, options)
+                if tr is not None:
+                    groups.setdefault(build_read_filter(options, aseq, tr), []).append((i, tr))
+            for read_filter, members in groups.items():
+                group_rejected = Counter(rejected)
+                group_counts = read_counts if read_filter is None else \
+                    read_filter.filter_counts(read_counts, group_rejected)
+                per_target, n_unassigned = demultiplex(
+                    group_counts, [tr.left_indicator_seq(options.indicator_seq_length) for _, tr in members])
+                n_kept = n_reads - sum(group_rejected.values())
+                logger.info(f"{input_fqj}: {n_kept - n_unassigned} of {n_kept} reads passing the prefilter "
+                            f"assigned to {len(members)} targets.")
+                for (i, _), counts in zip(members, per_target):
+                    kwargs[i] = dict(read_counts=counts, n_reads=n_reads, rejected=group_rejected)
+    except Exception as e:
+        logger.exception(f"{input_fqj} failed")
+        return results + [(input_fqj, target, f'{type(e).__name__}: {e}') for target in targets]
+
+    for target, kw in zip(targets, kwargs):
+        try:
+            prefix = run(*target, input_fqj, output_nametag, options, **kw)
+            error = None if prefix is not None else 'not analyzed'
+        except Exception as e:
+            logger.exception(f"{input_fqj} failed")
+            error = f'{type(e).__name__}: {e}'
+        results.append((input_fqj, target, error))
+    return results
+
+
+def main(argv):
+    del argv
+
+    logger.info('Program start.')
+
+    group_dict = {}
+    if FLAGS.sample_sheet:
+        group_dict = parse_fastqjoin_group_dict(pd.read_csv(FLAGS.sample_sheet, dtype=str))
+    input_fqjs = list(gen_input_fastqjoins(FLAGS.sample or list(group_dict), group_dict))
+    if not input_fqjs:
+        logger.error("No samples; give --sample_sheet and/or --sample")
+        sys.exit(1)
+
+    if FLAGS.targets:
+        targets = read_target_table(FLAGS.targets)
+    elif FLAGS.amplicon_seq and FLAGS.target_seq:
+        targets = [tuple(NamedArgs.build(x).upper() for x in
+                         [FLAGS.amplicon_seq, FLAGS.target_seq, FLAGS.user_target_mutation] if x is not None)]
+    else:
+        logger.error("Give --targets, or --amplicon_seq and --target_seq")
+        sys.exit(1)
+    if FLAGS.program == 'prime_editor' and any(len(target) < 3 for target in targets):
+        logger.error("A user target mutation is required for prime_editor")
+        sys.exit(1)
+    targets = [target[:3 if FLAGS.program == 'prime_editor' else 2] for target in targets]
+    options = AnalysisOptions.from_flags(FLAGS)._replace(workers=1)
+    if FLAGS.program == 'prime_editor':
+        options = options._replace(indel_in_alignment=True)
+    logger.info(f"{len(input_fqjs)} samples x {len(targets)} targets, {FLAGS.jobs} samples at a time.")
+
+    args = [(FLAGS.program, targets, input_fqj, FLAGS.output_nametag, options) for input_fqj in input_fqjs]
+    if FLAGS.jobs <= 1:
+        results = [r for a in args for r in run_sample(*a)]
+    else:
+        with ProcessPoolExecutor(FLAGS.jobs) as executor:
+            results = [r for rs in executor.map(run_sample, *zip(*args)) for r in rs]
+
+    failed = [(input_fqj, target, error) for input_fqj, target, error in results if error is not None]
+    for input_fqj, target, error in failed:
+        logger.error(f"{input_fqj} {'.'.join(map(str, target))}: {error}")
+    logger.info(f"{len(results) - len(failed)} of {len(results)} analyses done.")
+    logger.info("Program end.")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    app.run(main)
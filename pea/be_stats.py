@@ -1,19 +1,39 @@
 import glob
+import os
+import pickle
+from contextlib import nullcontext
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from typing import NamedTuple
+
 import numpy as np
 import pandas as pd
 from absl import app, flags
 
+from .util import encode_seqs
+from .util_io import read_table
+from .metrics import Metrics
+from .manifest import file_signature, same_file
+
 
 FLAGS = flags.FLAGS
 
 flags.DEFINE_multi_string('be_mut', [], "Base editing mutation of interest. Can be specified multiple times.")
 flags.DEFINE_multi_string('nonX_mut', [], "X to non-X mutation of interest. Can be specified multiple times.")
-flags.DEFINE_string('input_file_glob', '*.fastqjoin.*.align.csv', "Glob pattern for input files")
+flags.DEFINE_string('input_file_glob', '*.fastqjoin.*.align.csv',
+                    "Glob pattern for input files; .parquet files are read as Parquet")
 flags.DEFINE_string('be_output', 'summary.base_editing.csv', "Output filename")
 flags.DEFINE_string('be_output_overall', 'summary.be_overall.csv', "Output filename")
 flags.DEFINE_string('nonX_output', 'summary.mutations.csv', "Output filename")
 flags.DEFINE_string('nonX_detail_output', 'summary.nonX_per_pos.mutations.csv', "Output filename")
 flags.DEFINE_bool('exclude_indel_reads', True, "Do not use reads with indels for base editing stats")
+flags.DEFINE_string('raw_output', None, "Output filename for the reads used in the stats with their input filename, "
+                    "e.g. all_mutation_raw.csv; not written if not given")
+flags.DEFINE_integer('jobs', 1, "Number of input files processed in parallel")
+flags.DEFINE_string('stats_cache', None, "File keeping the stats of each input file across runs; files unchanged "
+                    "since, with the same options, are not read again. Disabled if not given")
+flags.DEFINE_boolean('metrics', False, "Write the time, read counts and peak RSS of each stage to be_stats.metrics.json")
+flags.DEFINE_boolean('profile', False, "Profile the stages with cProfile into be_stats.prof; implies --metrics")
 
 # flags.mark_flag_as_required('be_mut')
 
@@ -29,138 +49,223 @@ flags.register_validator('nonX_mut',
 
 
 
-def base_editing_mask(df):
-    df_ref=pd.DataFrame([[c for c in x] for x in df.ref], index=df.index)
-    df_alignment=pd.DataFrame([[c for c in x] for x in df.alignment], index=df.index)
-    df_read=pd.DataFrame([[c for c in x] for x in df.read], index=df.index)
-    
-    ref_cols = [f'{c}{i+1}' for i, c in enumerate(df.ref.iloc[0].replace('-',''))]
-    df_ref.columns = ref_cols
-    df_alignment.columns = ref_cols
-    df_read.columns = ref_cols
-    
-    df_ref=df_ref[(df_alignment=='X') | (df_alignment=='.')]
-    df_read=df_read[(df_alignment=='X') | (df_alignment=='.')]
-    mutations=df_ref+"to"+df_read
-    return mutations
+SUBSTITUTION_CODES = np.frombuffer(b'X.', dtype=np.uint8)
 
 
-def base_editing_per_pos(df, mut):
-    tmp=base_editing_mask(df)
+class AlignMatrices(NamedTuple):
+    """ref, alignment and read of an align.csv table as uint8 matrices, with
+    the n_reads of each row."""
+    ref: np.ndarray
+    alignment: np.ndarray
+    read: np.ndarray
+    n_reads: np.ndarray
 
-    mut_match=(tmp==mut)
-    mut_match['any']=mut_match.any(axis=1)
-    mut_match *=df.n_reads.values.reshape((-1,1))
-    mut_match['filename']=df.filename
-    mut_match['mut']=mut
-    return mut_match
+    @staticmethod
+    def build(df, width=None):
+        return AlignMatrices(encode_seqs(df.ref, width), encode_seqs(df.alignment, width),
+                             encode_seqs(df.read, width), df.n_reads.values)
 
+    def substitutions(self):
+        return np.isin(self.alignment, SUBSTITUTION_CODES)
 
-def base_editing_summary(df, target_muts):
-    mutations = base_editing_mask(df)
-    
-    tmp=pd.concat([(mutations == t).any(axis=1).to_frame(t) for t in target_muts], axis=1)
-    tmp['any']=tmp.any(axis=1)
-    tmp*=df.n_reads.values.reshape((-1,1))
-    tmp['filename']=df.filename
-    return tmp.groupby('filename').sum()
 
+def ref_columns(df):
+    return [f'{c}{i+1}' for i, c in enumerate(df.ref.iloc[0].replace('-',''))]
 
-def x_to_nonX_mutation_count(df, bps):
-    df_ref=pd.DataFrame([[c for c in x] for x in df.ref], index=df.index)
-    df_alignment=pd.DataFrame([[c for c in x] for x in df.alignment], index=df.index)
-    
-    mutations=df_ref[(df_alignment=='X') | (df_alignment=='.')]
-    count = pd.concat([(mutations==bp).any(axis=1).to_frame(bp) for bp in bps], axis=1)
-    count['any']=count.any(axis=1)
-    count *= df[['n_reads']].values
-    return count
 
+def base_editing_masks(m, muts):
+    """Boolean reads x positions matrix per mutation like AtoG."""
+    substitutions = m.substitutions()
+    return [substitutions & (m.ref == ord(mut[0])) & (m.read == ord(mut[-1])) for mut in muts]
 
-def x_to_nonX_mutation_per_pos_count(df):
-    df_ref=pd.DataFrame([[c for c in x] for x in df.ref], index=df.index)
-    df_alignment=pd.DataFrame([[c for c in x] for x in df.alignment], index=df.index)
-    
-    ref_cols = [f'{c}{i+1}' for i, c in enumerate(df.ref.iloc[0].replace('-',''))]
-    
-    mutations=df_ref[(df_alignment=='X') | (df_alignment=='.')].notnull()
-    mutations['mut_any']=mutations.any(axis=1)
-    all_muts=mutations*df.n_reads.values.reshape(-1,1)    
-    all_muts_per_pos = all_muts.sum(axis=0)
-    all_muts_per_pos.index = ref_cols+['n_mut_any']
-    return all_muts_per_pos
 
+def base_editing_per_pos(m, mut, width=None):
+    """Reads with mut at each of width positions, then at any position."""
+    mask, = base_editing_masks(m, [mut])
+    per_pos = np.zeros(mask.shape[1] if width is None else width, dtype=np.int64)
+    per_pos[:mask.shape[1]] = m.n_reads @ mask
+    return np.append(per_pos, m.n_reads @ mask.any(axis=1))
 
-def mask_insertion(row):
-    mask=np.array(list(row.ref))!='-'
-    f=lambda x:''.join(np.array(list(x))[mask])
-    return [f(row.ref), f(row.alignment), f(row.read), row.n_reads]#, names=['ref','alignment','read','count']
 
+def base_editing_summary(m, target_muts):
+    """Reads with each of target_muts, then with any of them."""
+    found = np.array([mask.any(axis=1) for mask in base_editing_masks(m, target_muts)])
+    return np.append(found @ m.n_reads, m.n_reads @ found.any(axis=0))
 
-def main(argv):
-    del argv
-    input_file_glob=FLAGS.input_file_glob
-    be_muts=FLAGS.be_mut
-    nonX_muts=FLAGS.nonX_mut
-    be_output=FLAGS.be_output
-    be_output_overall = FLAGS.be_output_overall
-    nonX_output=FLAGS.nonX_output
-    nonX_detail_output = FLAGS.nonX_detail_output
-    exclude_indel_reads=FLAGS.exclude_indel_reads
-    dfs_all={x:pd.read_csv(x) for x in sorted(glob.glob(input_file_glob))}
-    for k, df in dfs_all.items():
-        if df.empty:
-            print(f"No reads to analyze: {k}")
-    
-    dfs = {k:df.dropna()  for k,df in dfs_all.items() if not df.empty} #Drop empty data
-    
+
+def x_to_nonX_mutation_count(m, bps):
+    """Reads with a substitution of each of the reference bases bps, then of any of them."""
+    substitutions = m.substitutions()
+    found = np.array([(substitutions & (m.ref == ord(bp))).any(axis=1) for bp in bps])
+    return np.append(found @ m.n_reads, m.n_reads @ found.any(axis=0))
+
+
+def x_to_nonX_mutation_per_pos_count(m):
+    """Reads with a substitution at each position, then at any position."""
+    substitutions = m.substitutions()
+    return np.append(m.n_reads @ substitutions, m.n_reads @ substitutions.any(axis=1))
+
+
+def mask_insertions(df):
+    """ref, alignment, read and n_reads with the insertion columns (gaps in
+    ref) removed from each row."""
+    m = AlignMatrices.build(df)
+    keep = (m.ref != ord('-')) & (m.ref != 0)
+    order = np.argsort(~keep, axis=1, kind='stable')
+    lengths = keep.sum(axis=1)
+    cols = {}
+    for name, codes in zip(['ref', 'alignment', 'read'], m[:3]):
+        codes = np.take_along_axis(codes, order, axis=1)
+        cols[name] = [row[:n].tobytes().decode('ascii') for row, n in zip(codes, lengths)]
+    cols['n_reads'] = m.n_reads
+    return pd.DataFrame(cols, columns=['ref','alignment','read','n_reads'])
+
+
+class FileStats(NamedTuple):
+    """Partial aggregates of one input file, merged across files by main."""
+    filename: str
+    ref_cols: list
+    width: int
+    n_aligned_noindel: int
+    n_aligned_total: int
+    n_rows: int
+    be_per_pos: list
+    be_summary: np.ndarray
+    nonX: np.ndarray
+    nonX_per_pos: np.ndarray
+
+
+def file_stats(filename, be_muts, nonX_muts, exclude_indel_reads, keep_reads=False):
+    """FileStats of one align.csv file, or None if it has no reads to use;
+    with keep_reads, also the table of the reads used (else None)."""
+    df_all = read_table(filename, None if keep_reads else ['ref','alignment','read','n_reads'])
+    if df_all.empty:
+        print(f"No reads to analyze: {filename}")
+        return None, None
     if exclude_indel_reads:
-        dfs = {k:df[~df.alignment.str.contains("-").astype(bool)] for k,df in dfs_all.items()} #No-indels. For Python 3.7
+        df = df_all[~df_all.alignment.str.contains("-").astype(bool)] #No-indels. For Python 3.7
     else:
-        f_mask_insertion=lambda df : pd.DataFrame(df.apply(mask_insertion, axis=1).to_list(),
-                                                  columns=['ref','alignment','read','n_reads'])
-        dfs = {k:f_mask_insertion(df) for k,df in dfs.items() if not df.empty}
-        
-    dfs = {k:df for k,df in dfs.items() if not df.empty}
-    
-    def append_col(df, name, col):
-        df=df.copy()
-        df[name]=col
-        return df
-    df_all_mutation_raw = pd.concat([append_col(df, "filename", k) for k,df in dfs.items()])
-    df_all_mutation_raw.to_csv("all_mutation_raw.csv", index=False)
-       
-    df_read_count = pd.DataFrame({name: df['n_reads'].sum() for name,df in dfs.items()}, index=['n_aligned_noindel']).T    
-    df_read_count_all = pd.DataFrame({name: df['n_reads'].sum() for name,df in dfs_all.items()}, index=['n_aligned_total']).T
-    df_read_counts = pd.concat([df_read_count, df_read_count_all], axis=1, sort=False).dropna().astype(np.int32)
-    df_read_counts.index.name='filename'    
+        df = df_all.dropna()
+        df = mask_insertions(df) if not df.empty else df
+    if df.empty:
+        return None, None
+
+    m = AlignMatrices.build(df)
+    stats = FileStats(filename, ref_columns(df), m.ref.shape[1], df.n_reads.sum(), df_all.n_reads.sum(), len(df_all),
+                      [base_editing_per_pos(m, mut) for mut in be_muts],
+                      base_editing_summary(m, be_muts) if be_muts else None,
+                      x_to_nonX_mutation_count(m, nonX_muts) if nonX_muts else None,
+                      x_to_nonX_mutation_per_pos_count(m))
+    return stats, df if keep_reads else None
+
+
+def read_stats_cache(path):
+    """{filename: (signature, options, FileStats or None)} of an earlier run; empty if there is none."""
+    try:
+        with open(path, 'rb') as f:
+            cache = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return {}
+    return {k: (signature, options, s and FileStats(**s)) for k, (signature, options, s) in cache.items()}
+
+
+def write_stats_cache(path, cache):
+    with open(f'{path}.tmp', 'wb') as f:
+        pickle.dump({k: (signature, options, s and s._asdict()) for k, (signature, options, s) in cache.items()}, f)
+    os.replace(f'{path}.tmp', path)
+
+
+def pad_positions(counts, width):
+    """Per-position counts followed by an any count, zero-padded to width positions."""
+    return np.concatenate([counts[:-1], np.zeros(width - len(counts) + 1, dtype=counts.dtype), counts[-1:]])
+
+
+def write_summaries(stats, be_muts, nonX_muts):
+    """Write read_counts.csv and the summary tables of the FileStats of all files."""
+    filenames = [s.filename for s in stats]
+    df_read_counts = pd.DataFrame({'n_aligned_noindel': [s.n_aligned_noindel for s in stats],
+                                   'n_aligned_total': [s.n_aligned_total for s in stats]},
+                                  index=pd.Index(filenames, name='filename')).astype(np.int32)
     df_read_counts.to_csv('read_counts.csv')   
     
-    
     if be_muts:
-        df_be = pd.concat([base_editing_per_pos(df_all_mutation_raw, m) for m in be_muts])
+        # Positions are named after the first read of the first file.
+        ref_cols = stats[0].ref_cols
+        width = max(s.width for s in stats)
+        if width != len(ref_cols):
+            raise ValueError(f"{len(ref_cols)} reference positions in {stats[0].filename}, but reads span {width}")
+        df_be = pd.DataFrame([[mut, s.filename, *pad_positions(counts, width)]
+                              for i, mut in enumerate(be_muts) for s in stats for counts in [s.be_per_pos[i]]],
+                             columns=['mut','filename']+ref_cols+['any'])
         be_per_pos = df_be.groupby(['mut','filename']).sum().reset_index()
         be_per_pos = be_per_pos.merge(df_read_counts.reset_index(), on='filename')
         be_per_pos = be_per_pos.set_index(['mut','filename','n_aligned_noindel','n_aligned_total']).sort_index()
-        be_per_pos.to_csv(be_output, sep='\t')
+        be_per_pos.to_csv(FLAGS.be_output, sep='\t')
         
-        df_be_summary = base_editing_summary(df_all_mutation_raw, be_muts)
+        df_be_summary = pd.DataFrame([s.be_summary for s in stats],
+                                     index=pd.Index(filenames, name='filename'), columns=be_muts+['any'])
         df_be_summary = df_be_summary.merge(df_read_counts.reset_index(), on='filename')
-        df_be_summary.to_csv(be_output_overall, sep='\t', index=False)
+        df_be_summary.to_csv(FLAGS.be_output_overall, sep='\t', index=False)
     
     if nonX_muts:
-        nonXmuts={x:x_to_nonX_mutation_count(df, nonX_muts).sum(axis=0) for x, df in dfs.items()}
+        nonXmuts={s.filename:pd.Series(s.nonX, index=nonX_muts+['any']) for s in stats}
         df_nonX=pd.DataFrame.from_dict(nonXmuts).T
         df_nonX.index.name = 'filename'
         df_nonX=df_nonX.merge(df_read_counts, left_index=True, right_index=True)
-        df_nonX.to_csv(nonX_output, sep='\t')
+        df_nonX.to_csv(FLAGS.nonX_output, sep='\t')
         
-        nonX_per_pos = pd.DataFrame.from_dict({x:x_to_nonX_mutation_per_pos_count(df) for x,df in dfs.items()}).T
+        nonX_per_pos = pd.DataFrame.from_dict({s.filename:pd.Series(s.nonX_per_pos, index=s.ref_cols+['n_mut_any'])
+                                               for s in stats}).T
         nonX_per_pos=nonX_per_pos.merge(df_read_counts, left_index=True, right_index=True)
         nonX_per_pos.index.name = 'nonX_per_pos'
-        nonX_per_pos.to_csv(nonX_detail_output, sep='\t')
+        nonX_per_pos.to_csv(FLAGS.nonX_detail_output, sep='\t')
         
 
+def main(argv):
+    del argv
+    be_muts=FLAGS.be_mut
+    nonX_muts=FLAGS.nonX_mut
+    raw_output=FLAGS.raw_output
+
+    filenames = sorted(glob.glob(FLAGS.input_file_glob))
+    run = partial(file_stats, be_muts=be_muts, nonX_muts=nonX_muts, exclude_indel_reads=FLAGS.exclude_indel_reads,
+                  keep_reads=raw_output is not None)
+    metrics = Metrics('be_stats', FLAGS.profile)
+    # The stats of unchanged files are taken from the cache, unless their reads are needed for raw_output.
+    options = [be_muts, nonX_muts, FLAGS.exclude_indel_reads]
+    cache = read_stats_cache(FLAGS.stats_cache) if FLAGS.stats_cache else {}
+    cached = {} if raw_output is not None else {
+        f: cache[f][2] for f in filenames if f in cache and cache[f][1] == options and same_file(cache[f][0], f)}
+    todo = [f for f in filenames if f not in cached]
+    if FLAGS.stats_cache:
+        print(f"{len(cached)} of {len(filenames)} files are unchanged since the last run")
+    n_raw = 0
+    # Files are summarized one at a time (or jobs at a time); only their partials are kept.
+    with metrics.stage('stats') as record, \
+            ProcessPoolExecutor(FLAGS.jobs) if FLAGS.jobs > 1 else nullcontext() as executor:
+        for filename, (s, df) in zip(todo, (executor.map if executor else map)(run, todo)):
+            cached[filename] = s
+            if FLAGS.stats_cache:
+                cache[filename] = (file_signature(filename), options, s)
+            if s is not None and raw_output is not None:
+                df = df.copy()
+                df["filename"] = s.filename
+                df.to_csv(raw_output, index=False, mode='a' if n_raw else 'w', header=not n_raw)
+                n_raw += 1
+        stats = [cached[f] for f in filenames if cached[f] is not None]
+        record.update(files=len(filenames), files_read=len(todo), files_used=len(stats),
+                      reads_in=sum(s.n_aligned_total for s in stats), reads_out=sum(s.n_aligned_noindel for s in stats),
+                      unique_seqs=sum(s.n_rows for s in stats))
+    if FLAGS.stats_cache:
+        write_stats_cache(FLAGS.stats_cache, {f: cache[f] for f in filenames})
+    if not stats:
+        print("No reads to analyze")
+    else:
+        with metrics.stage('write'):
+            write_summaries(stats, be_muts, nonX_muts)
+    if FLAGS.metrics or FLAGS.profile:
+        metrics.write('be_stats.')
+
+
 if __name__=='__main__':
     app.run(main)
-
@@ -0,0 +1,56 @@
+import argparse
+import json
+import os
+import sys
+from urllib.error import HTTPError, URLError
+from urllib.request import Request, urlopen
+
+
+# Only the standard library is imported here, so that submitting a job to
+# pea.serve costs an interpreter start-up and a request, not the imports of
+# the analysis.
+SERVED_PROGRAMS = ['align_mutations', 'prime_editor']
+DEFAULT_PORT = 8765
+
+
+def request(port, path, body=None):
+    """JSON response of the server to a GET, or to a POST of body."""
+    data = None if body is None else json.dumps(body).encode()
+    req = Request(f'http://127.0.0.1:{port}{path}', data=data, headers={'Content-Type': 'application/json'})
+    try:
+        with urlopen(req) as response:
+            return json.load(response)
+    except HTTPError as e:
+        return json.load(e)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run a pea program on a pea.serve server, in the current directory, and exit with its exit code. "
+                    "'status' prints the queue depth and throughput of the server.")
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help="Port of the server on localhost")
+    parser.add_argument('--nowait', action='store_true', help="Print the job id and return without waiting")
+    parser.add_argument('program', choices=SERVED_PROGRAMS + ['status'])
+    parser.add_argument('args', nargs=argparse.REMAINDER, help="Flags of the program")
+    args = parser.parse_args()
+
+    try:
+        if args.program == 'status':
+            print(json.dumps(request(args.port, '/status'), indent=2))
+            return
+        job = request(args.port, '/jobs', {'program': args.program, 'args': args.args, 'cwd': os.getcwd()})
+        if 'id' not in job:
+            sys.exit(f"pea.client: {job['error']}")
+        if args.nowait:
+            print(job['id'])
+            return
+        job = request(args.port, f"/jobs/{job['id']}?wait=1")
+    except URLError as e:
+        sys.exit(f"pea.client: no server on port {args.port}: {e.reason}")
+    if job.get('error'):
+        print(job['error'], file=sys.stderr)
+    sys.exit(job['exit_code'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+
+from .util import NamedArgs, encode_seqs, revertedSeq
+from .util_io import iter_chunks
+
+
+BASE_CODES = np.full(256, 4, dtype=np.uint8)
+for _i, _c in enumerate(b'ACGT'):
+    BASE_CODES[_c] = _i
+
+
+def read_target_table(path):
+    """Targets of a pooled run from a CSV file with amplicon_seq and target_seq
+    columns and, for prime_editor, user_target_mutation; values are name:seq.
+    Returns a list of NamedArgs tuples, one per row."""
+    df = pd.read_csv(path, dtype=str)
+    cols = [c for c in ['amplicon_seq', 'target_seq', 'user_target_mutation'] if c in df.columns]
+    return [tuple(NamedArgs.build(row[c]).upper() for c in cols) for _, row in df.iterrows()]
+
+
+class IndicatorIndex:
+    """Hash of the k-mers of many indicator sequences, on both strands.
+
+    A window within one mismatch of an indicator of length L matches either
+    its first or its last k = L//2 bases exactly, so every read holding an
+    indicator (as found by locate_indicators, including windows hanging one
+    base over either read end) hits one of the indexed k-mers. Hits are
+    checked against the whole indicator before a read is assigned.
+    """
+    def __init__(self, indicators):
+        lengths = {len(x) for x in indicators}
+        if len(lengths) != 1:
+            raise ValueError('Indicator sequences must all have the same length')
+        if any(set(x) - set('ACGT') for x in indicators):
+            raise ValueError('Indicator sequences must consist of A, C, G and T')
+        self.length = lengths.pop()
+        self.k = self.length // 2
+        self.n_targets = len(indicators)
+
+        patterns = [x for idc in indicators for x in (idc, revertedSeq(idc))]
+        self.pattern_codes = BASE_CODES[encode_seqs(patterns, self.length)]
+        self.pattern_target = np.repeat(np.arange(self.n_targets), 2)
+
+        entries = {}
+        for p, codes in enumerate(self.pattern_codes):
+            for offset in (0, self.length - self.k):
+                kmer = self._kmer_code(codes[None, offset:offset + self.k])[0, 0]
+                entries.setdefault(kmer, set()).add((p, offset))
+        self.keys = np.array(sorted(entries), dtype=np.int64)
+        self.entry_beg = np.cumsum([0] + [len(entries[key]) for key in self.keys])
+        self.entry_pattern = np.array([p for key in self.keys for p, _ in sorted(entries[key])], dtype=np.int64)
+        self.entry_offset = np.array([o for key in self.keys for _, o in sorted(entries[key])], dtype=np.int64)
+
+    def _kmer_code(self, codes):
+        n_pos = codes.shape[1] - self.k + 1
+        kmers = np.zeros((codes.shape[0], n_pos), dtype=np.int64)
+        for t in range(self.k):
+            kmers = kmers * 4 + (codes[:, t:t + n_pos] & 3)
+        return kmers
+
+    def assign(self, seqs):
+        """Boolean matrix of reads x targets: whether the read holds the
+        target's indicator on either strand."""
+        seqs = list(seqs)
+        assigned = np.zeros((len(seqs), self.n_targets), dtype=bool)
+        if not seqs or not len(self.keys):
+            return assigned
+        codes = np.full((len(seqs), max(map(len, seqs)) + 2), 4, dtype=np.uint8)
+        codes[:, 1:-1] = BASE_CODES[encode_seqs(seqs)]
+
+        kmers = self._kmer_code(codes)
+        invalid = np.zeros(kmers.shape, dtype=bool)
+        for t in range(self.k):
+            invalid |= codes[:, t:t + kmers.shape[1]] == 4
+        key_idx = np.searchsorted(self.keys, kmers).clip(max=len(self.keys) - 1)
+        rows, pos = np.nonzero((self.keys[key_idx] == kmers) & ~invalid)
+        key_idx = key_idx[rows, pos]
+
+        n_entries = self.entry_beg[key_idx + 1] - self.entry_beg[key_idx]
+        entry = np.repeat(self.entry_beg[key_idx], n_entries) + _ranges(n_entries)
+        rows = np.repeat(rows, n_entries)
+        beg = np.repeat(pos, n_entries) - self.entry_offset[entry]
+        pattern = self.entry_pattern[entry]
+
+        cols = beg[:, None] + np.arange(self.length)
+        inside = (cols >= 0) & (cols < codes.shape[1])
+        window = np.where(inside, codes[rows[:, None], cols.clip(0, codes.shape[1] - 1)], 4)
+        n_mismatch = (window != self.pattern_codes[pattern]).sum(axis=1)
+        hit = n_mismatch < 2
+        assigned[rows[hit], self.pattern_target[pattern[hit]]] = True
+        return assigned
+
+
+def _ranges(counts):
+    """Concatenation of arange(c) for every c in counts."""
+    ends = np.cumsum(counts)
+    return np.arange(ends[-1] if len(ends) else 0) - np.repeat(ends - counts, counts)
+
+
+def demultiplex(read_counts, indicators):
+    """Split distinct read counts among targets by their left indicators.
+
+    Returns one Counter per indicator with the reads that hold it on either
+    strand (a read holding several is given to each), and the number of reads
+    assigned to no target.
+    """
+    index = IndicatorIndex(indicators)
+    per_target = [Counter() for _ in indicators]
+    n_unassigned = 0
+    for block in iter_chunks(read_counts.items()):
+        assigned = index.assign([x for x, _ in block])
+        for (x, n), row in zip(block, assigned):
+            targets = np.flatnonzero(row)
+            if not len(targets):
+                n_unassigned += n
+            for t in targets:
+                per_target[t][x] = n
+    return per_target, n_unassigned
@@ -0,0 +1,78 @@
+import hashlib
+import json
+import os
+from datetime import datetime
+from importlib import metadata
+
+
+def pea_version():
+    try:
+        return metadata.version('pea')
+    except metadata.PackageNotFoundError:
+        return None
+
+
+def file_hash(path, chunk_size=1 << 20):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def file_signature(path, with_hash=True):
+    """Path, size, mtime and (with_hash) SHA-1 of a file."""
+    st = os.stat(path)
+    signature = {'path': str(path), 'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+    if with_hash:
+        signature['sha1'] = file_hash(path)
+    return signature
+
+
+def same_file(signature, path=None):
+    """Whether the file (at path, or the path of signature) still has the
+    size and mtime of signature, or failing the mtime, its SHA-1."""
+    try:
+        st = os.stat(signature['path'] if path is None else path)
+    except OSError:
+        return False
+    if st.st_size != signature['size']:
+        return False
+    if st.st_mtime_ns == signature['mtime_ns']:
+        return True
+    return 'sha1' in signature and file_hash(signature['path'] if path is None else path) == signature['sha1']
+
+
+def manifest_path(prefix):
+    return f'{prefix}.manifest.json'
+
+
+def write_manifest(prefix, parameters, inputs, outputs, hash_inputs=False):
+    """Write <prefix>.manifest.json: the pea version, parameters, and the
+    signatures of the input and output files of a run. The inputs are
+    hashed, which reads them again, only with hash_inputs; without a hash, an
+    input whose mtime changed counts as changed."""
+    manifest = {'created': datetime.now().isoformat(timespec='seconds'),
+                'version': pea_version(),
+                'parameters': parameters,
+                'inputs': [file_signature(x, with_hash=hash_inputs) for x in inputs],
+                'outputs': [file_signature(x, with_hash=False) for x in outputs]}
+    path = manifest_path(prefix)
+    with open(f'{path}.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(f'{path}.tmp', path)
+
+
+def is_current(prefix, parameters, inputs):
+    """Whether <prefix>.manifest.json records this pea version, these
+    parameters and inputs, and all of its files are unchanged."""
+    try:
+        with open(manifest_path(prefix)) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return False
+    if manifest.get('version') != pea_version() or manifest.get('parameters') != parameters:
+        return False
+    if [x['path'] for x in manifest['inputs']] != [str(x) for x in inputs]:
+        return False
+    return all(same_file(x) for x in manifest['inputs'] + manifest['outputs'])
@@ -0,0 +1,64 @@
+import cProfile
+import json
+import sys
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def peak_rss_mb(children=False):
+    """Peak resident set size in MiB of this process, or of its terminated
+    children (e.g. pool workers); None where getrusage is not available."""
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return round(usage.ru_maxrss / (2**20 if sys.platform == 'darwin' else 2**10), 1)
+
+
+class Metrics:
+    """Wall time, counters and peak RSS of the stages of one run.
+
+    stage() times a block and yields its record, to which the block adds
+    counters such as reads_in, reads_out, unique_seqs and alignments. A stage
+    entered again accumulates its time. The process_peak_rss_mb of a stage is
+    the peak of the process up to its end, not the memory the stage used.
+    With profile, the stages also run under cProfile.
+    """
+    def __init__(self, program, profile=False):
+        self.program = program
+        self.stages = {}
+        self.profiler = cProfile.Profile() if profile else None
+        self.t0 = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        record = self.stages.setdefault(name, {'seconds': 0.0})
+        t = time.perf_counter()
+        if self.profiler is not None:
+            self.profiler.enable()
+        try:
+            yield record
+        finally:
+            if self.profiler is not None:
+                self.profiler.disable()
+            record['seconds'] = round(record['seconds'] + time.perf_counter() - t, 6)
+            record['process_peak_rss_mb'] = peak_rss_mb()
+
+    def to_dict(self):
+        return {'program': self.program,
+                'seconds': round(time.perf_counter() - self.t0, 6),
+                'peak_rss_mb': peak_rss_mb(),
+                'peak_children_rss_mb': peak_rss_mb(children=True),
+                'stages': self.stages}
+
+    def write(self, prefix):
+        """Write <prefix>metrics.json, and <prefix>prof if profiling."""
+        with open(f'{prefix}metrics.json', 'w') as f:
+            json.dump(self.to_dict(), f, indent=2, default=int)
+        if self.profiler is not None:
+            self.profiler.dump_stats(f'{prefix}prof')
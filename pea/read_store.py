@@ -0,0 +1,294 @@
+import itertools
+from typing import NamedTuple
+
+import numpy as np
+
+from .util_io import iter_seq_blocks
+
+
+MAX_PACKED_LENGTH = 600
+CODE_CHARS = bytes.maketrans(bytes(range(4)), b'ACGT')
+PACK_SHIFTS = np.array([6, 4, 2, 0], dtype=np.uint8)
+PACK_MULTIPLIER = np.uint32(1 + (1 << 10) + (1 << 20) + (1 << 30))
+LENGTH_BYTES = 2  # big-endian read length in front of each key
+MIX_MULTIPLIERS = np.array([0xBF58476D1CE4E5B9, 0x94D049BB133111EB], dtype=np.uint64)
+PENDING_INDEXES = 8
+CHUNK_ROWS = 1 << 16
+READ_BLOCK_SIZE = 1 << 15
+DECODE_BLOCK_SIZE = 1 << 14
+
+
+class PackedReads(NamedTuple):
+    """Reads of A, C, G and T at 2 bits per base (A=0, C=1, G=2, T=3), four
+    bases per byte with the first in the high bits; rows are padded with A."""
+    lengths: np.ndarray
+    packed: np.ndarray
+
+    @classmethod
+    def from_codes(cls, codes, lengths):
+        """Pack a matrix of base codes, one read per row."""
+        n, m = codes.shape
+        width = -(-m // 4)
+        if m % 4:
+            codes = np.pad(codes, ((0, 0), (0, width * 4 - m)))
+        # c0 | c1 << 8 | c2 << 16 | c3 << 24 times PACK_MULTIPLIER holds
+        # c0 << 30 | c1 << 28 | c2 << 26 | c3 << 24 in its top byte, and no
+        # other term reaches it
+        words = np.ascontiguousarray(codes).view('<u4').reshape(n, width)
+        packed = ((words * PACK_MULTIPLIER) >> np.uint32(24)).astype(np.uint8)
+        return cls(np.asarray(lengths, dtype=np.int64), packed)
+
+    def codes(self):
+        n, width = self.packed.shape
+        return ((self.packed[:, :, None] >> PACK_SHIFTS) & 3).reshape(n, width * 4)
+
+    def reverse_complement(self):
+        """The reverse complements of the reads, computed on their codes:
+        the complement of code c is 3 - c."""
+        codes = self.codes()
+        idx = self.lengths[:, None] - 1 - np.arange(codes.shape[1])
+        rc = np.where(idx >= 0, 3 - np.take_along_axis(codes, idx.clip(min=0), axis=1), 0)
+        return PackedReads.from_codes(rc.astype(np.uint8), self.lengths)
+
+    def decode(self):
+        """The reads as str."""
+        codes = self.codes()
+        m = codes.shape[1]
+        raw = codes.tobytes().translate(CODE_CHARS)
+        return [raw[i * m:i * m + n].decode('ascii') for i, n in enumerate(self.lengths.tolist())]
+
+
+def base_codes(chars):
+    """Codes of the ASCII bytes of A, C, G and T.
+
+    Bits 1-2 of A, C, G and T are 0, 1, 3 and 2; swapping the last two gives
+    their codes without a lookup table."""
+    codes = (chars >> 1) & 3
+    codes ^= codes >> 1
+    return codes
+
+
+def pack_seqs(seqs, max_length=MAX_PACKED_LENGTH):
+    """PackedReads of those of the bytes seqs that consist of A, C, G and T and
+    are at most max_length long, and a boolean mask of them."""
+    lengths = np.fromiter(map(len, seqs), dtype=np.int64, count=len(seqs))
+    too_long = lengths > max_length
+    m = int(lengths[~too_long].max(initial=0))
+    # pad with A (code 0) to a common width; longer reads are cut and escaped below
+    if too_long.any():
+        seqs = [x[:m] for x in seqs]
+    if (lengths == m).all():
+        padded = b''.join(seqs)
+    else:
+        padded = b''.join(map(bytes.ljust, seqs, itertools.repeat(m), itertools.repeat(b'A')))
+    chars = np.frombuffer(padded, dtype=np.uint8).reshape(len(seqs), m)
+    codes = base_codes(chars)
+    packable = ~too_long
+    if padded.translate(None, b'ACGT'):
+        is_base = (chars == ord('A')) | (chars == ord('C')) | (chars == ord('G')) | (chars == ord('T'))
+        packable &= is_base.all(axis=1)
+    if packable.all():
+        return PackedReads.from_codes(codes, lengths), packable
+    return PackedReads.from_codes(codes[packable], lengths[packable]), packable
+
+
+def mix64(h):
+    """The splitmix64 finalizer of a uint64 array."""
+    h = (h ^ (h >> np.uint64(30))) * MIX_MULTIPLIERS[0]
+    h = (h ^ (h >> np.uint64(27))) * MIX_MULTIPLIERS[1]
+    return h ^ (h >> np.uint64(31))
+
+
+def row_hashes(keys):
+    """64-bit hashes of ReadStore keys, which do not depend on the width the
+    keys are padded to."""
+    lengths = keys[:, 0].astype(np.int64) << 8 | keys[:, 1]
+    n_words = -(-(LENGTH_BYTES + -(-lengths // 4)) // 8)
+    h = np.zeros(len(keys), dtype=np.uint64)
+    for j in range(0, keys.shape[1], 8):
+        word = np.zeros((len(keys), 8), dtype=np.uint8)
+        word[:, :keys.shape[1] - j] = keys[:, j:j + 8]
+        h = np.where(n_words > j // 8, mix64(h ^ word.view(np.uint64).ravel()), h)
+    return h
+
+
+def unique_rows(keys, hashes):
+    """Index of the first occurrence of each distinct row of a uint8 matrix,
+    in order, and the position of every row among them.
+
+    Rows are grouped by their hashes; the rare groups whose rows are not all
+    equal are resolved by exact comparison."""
+    _, first, inverse = np.unique(hashes, return_index=True, return_inverse=True)
+    inverse = inverse.ravel()
+    collided = np.flatnonzero((keys != keys[first[inverse]]).any(axis=1))
+    if len(collided):
+        rows = keys[collided].view(np.dtype((np.void, keys.shape[1]))).ravel()
+        _, extra_first, extra_inverse = np.unique(rows, return_index=True, return_inverse=True)
+        first = np.concatenate([first, collided[extra_first]])
+        inverse[collided] = len(first) - len(extra_first) + extra_inverse.ravel()
+    order = np.argsort(first, kind='stable')
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    return first[order], rank[inverse]
+
+
+def decode_keys(keys):
+    """Reads of ReadStore keys, as str."""
+    lengths = keys[:, 0].astype(np.int64) << 8 | keys[:, 1]
+    return PackedReads(lengths, keys[:, LENGTH_BYTES:]).decode()
+
+
+class ReadStore:
+    """Distinct reads and their counts, kept 2-bit packed.
+
+    Reads are added a block at a time as bytes. Reads of A, C, G and T up to
+    max_length bases are packed behind their length into keys, which are
+    numbered in order of first appearance and found again through a sorted
+    index of their 64-bit hashes, checked against the keys themselves. Other
+    reads (e.g. with N) take an escape path, a dict of their bytes. Only the
+    distinct reads are decoded, by items(), in order of first appearance like
+    a Counter of the reads; values() and len() are as for a Counter.
+    """
+    def __init__(self, max_length=MAX_PACKED_LENGTH):
+        self.max_length = max_length
+        # keys of the packed reads, in chunks of about CHUNK_ROWS
+        self.chunks = []
+        self.offsets = np.zeros(0, dtype=np.int64)
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.n_packed = 0
+        # sorted hashes with the ids of their keys, and those of the latest chunks
+        self.index = (np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64))
+        self.pending = []
+        # read bytes -> [count, number of packed reads that appeared before it]
+        self.escaped = {}
+
+    @classmethod
+    def from_fastq(cls, path, read_filter=None, rejected=None, max_length=MAX_PACKED_LENGTH):
+        """Store of the reads of a FASTQ(join) file; read_filter and rejected
+        are as in iter_seq_blocks."""
+        store = cls(max_length)
+        for seqs in iter_seq_blocks(path, read_filter, rejected, block_size=READ_BLOCK_SIZE):
+            store.add(seqs)
+        return store
+
+    def add(self, seqs):
+        """Count a list of bytes reads."""
+        if not seqs:
+            return
+        reads, packable = pack_seqs(seqs, self.max_length)
+        keys = np.zeros((len(reads.lengths), LENGTH_BYTES + reads.packed.shape[1]), dtype=np.uint8)
+        keys[:, 0] = reads.lengths >> 8
+        keys[:, 1] = reads.lengths & 255
+        keys[:, LENGTH_BYTES:] = reads.packed
+        hashes = row_hashes(keys)
+        first, inverse = unique_rows(keys, hashes)
+        keys, hashes, counts = keys[first], hashes[first], np.bincount(inverse)
+
+        ids = self.find(keys, hashes)
+        new = ids < 0
+        self.counts[ids[~new]] += counts[~new]
+        escaped = np.flatnonzero(~packable)
+        n_before = self.n_packed + np.searchsorted(np.flatnonzero(packable)[first[new]], escaped)
+        for i, n in zip(escaped.tolist(), n_before.tolist()):
+            self.escaped.setdefault(seqs[i], [0, n])[0] += 1
+        if new.any():
+            self.append(keys[new], hashes[new], counts[new])
+
+    def append(self, keys, hashes, counts):
+        ids = self.n_packed + np.arange(len(keys))
+        if self.chunks and len(self.chunks[-1]) < CHUNK_ROWS:
+            last = self.chunks[-1]
+            chunk = np.zeros((len(last) + len(keys), max(last.shape[1], keys.shape[1])), dtype=np.uint8)
+            chunk[:len(last), :last.shape[1]] = last
+            chunk[len(last):, :keys.shape[1]] = keys
+            self.chunks[-1] = chunk
+        else:
+            self.chunks.append(keys)
+            self.offsets = np.append(self.offsets, self.n_packed)
+        self.n_packed += len(keys)
+        if self.n_packed > len(self.counts):
+            grown = np.zeros(max(self.n_packed, len(self.counts) * 3 // 2), dtype=np.int64)
+            grown[:len(self.counts)] = self.counts
+            self.counts = grown
+        self.counts[ids] = counts
+
+        order = np.argsort(hashes, kind='stable')
+        self.pending.append((hashes[order], ids[order]))
+        if len(self.pending) >= PENDING_INDEXES:
+            new_hashes = np.concatenate([h for h, _ in self.pending])
+            new_ids = np.concatenate([i for _, i in self.pending])
+            order = np.argsort(new_hashes, kind='stable')
+            pos = np.searchsorted(self.index[0], new_hashes[order])
+            self.index = (np.insert(self.index[0], pos, new_hashes[order]),
+                          np.insert(self.index[1], pos, new_ids[order]))
+            self.pending = []
+
+    def find(self, keys, hashes):
+        """Ids of the stored keys equal to keys, -1 for those not stored."""
+        ids = np.full(len(keys), -1, dtype=np.int64)
+        # sorted queries are found faster
+        order = np.argsort(hashes)
+        for index_hashes, index_ids in [self.index] + self.pending:
+            if not len(index_hashes):
+                continue
+            pos = np.searchsorted(index_hashes, hashes[order]).clip(max=len(index_hashes) - 1)
+            hit = (index_hashes[pos] == hashes[order]) & (ids[order] < 0)
+            ids[order[hit]] = index_ids[pos[hit]]
+        hit = np.flatnonzero(ids >= 0)
+        for i in hit[~self.equal_keys(ids[hit], keys[hit])].tolist():
+            ids[i] = self.find_collided(keys[i], hashes[i])
+        return ids
+
+    def equal_keys(self, ids, keys):
+        """Whether the stored keys of ids equal keys."""
+        equal = np.zeros(len(ids), dtype=bool)
+        chunk = np.searchsorted(self.offsets, ids, side='right') - 1
+        order = np.argsort(chunk, kind='stable')
+        bounds = np.searchsorted(chunk[order], np.arange(len(self.chunks) + 1))
+        for c in np.flatnonzero(np.diff(bounds)).tolist():
+            sel = order[bounds[c]:bounds[c + 1]]
+            stored = self.chunks[c][ids[sel] - self.offsets[c]]
+            # keys of equal length have equal widths beyond which both are 0
+            w = min(stored.shape[1], keys.shape[1])
+            equal[sel] = (stored[:, :w] == keys[sel, :w]).all(axis=1)
+        return equal
+
+    def find_collided(self, key, h):
+        """Id of the stored key equal to key among all of hash h, or -1."""
+        for index_hashes, index_ids in [self.index] + self.pending:
+            candidates = index_ids[np.searchsorted(index_hashes, h):np.searchsorted(index_hashes, h, side='right')]
+            equal = self.equal_keys(candidates, np.repeat(key[None], len(candidates), axis=0))
+            if equal.any():
+                return int(candidates[equal][0])
+        return -1
+
+    def __len__(self):
+        return self.n_packed + len(self.escaped)
+
+    def values(self):
+        yield from self.counts[:self.n_packed].tolist()
+        yield from (n for n, _ in self.escaped.values())
+
+    @property
+    def nbytes(self):
+        """Approximate memory of the packed reads and their index."""
+        return sum(k.nbytes for k in self.chunks) + self.counts.nbytes + \
+            sum(h.nbytes + i.nbytes for h, i in [self.index] + self.pending)
+
+    def items(self):
+        """(read, count) pairs in order of first appearance, decoded a block at a time."""
+        escaped = iter(self.escaped.items())
+        next_escaped = next(escaped, None)
+        i = 0
+        for keys in self.chunks:
+            for beg in range(0, len(keys), DECODE_BLOCK_SIZE):
+                block = keys[beg:beg + DECODE_BLOCK_SIZE]
+                for x, n in zip(decode_keys(block), self.counts[i:i + len(block)].tolist()):
+                    while next_escaped is not None and next_escaped[1][1] <= i:
+                        yield next_escaped[0].decode('ascii'), next_escaped[1][0]
+                        next_escaped = next(escaped, None)
+                    yield x, n
+                    i += 1
+        while next_escaped is not None:
+            yield next_escaped[0].decode('ascii'), next_escaped[1][0]
+            next_escaped = next(escaped, None)
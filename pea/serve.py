@@ -0,0 +1,291 @@
+import importlib
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import time
+import pkg_resources
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logging.config import fileConfig
+from typing import NamedTuple
+from urllib.parse import urlparse, parse_qs
+
+from absl import app, flags
+
+from .client import SERVED_PROGRAMS, DEFAULT_PORT
+
+
+fileConfig(pkg_resources.resource_filename('pea', 'log.ini'), disable_existing_loggers=False)
+logger = logging.getLogger('serve')
+
+
+FLAGS = flags.FLAGS
+
+# The flags are prefixed, as the workers parse the flags of the programs on the
+# same absl FLAGS.
+flags.DEFINE_integer('serve_port', DEFAULT_PORT, "Port on localhost to accept jobs on")
+flags.DEFINE_integer('serve_jobs', 1, "Number of warm worker processes of each program")
+flags.DEFINE_integer('serve_throughput_window', 60, "Seconds over which the status reports finished jobs per minute")
+flags.DEFINE_integer('serve_max_finished_jobs', 10000, "Number of the last finished jobs kept for GET /jobs/<id>")
+
+# Queue on which a worker reports the id of each job it starts.
+job_starts = None
+
+
+class JobResult(NamedTuple):
+    exit_code: int
+    error: str
+    started: float
+    finished: float
+
+
+def load_program(program, starts):
+    """Import a program and its dependencies, once per worker process, and
+    keep the queue to report job starts on."""
+    global job_starts
+    job_starts = starts
+    importlib.import_module(f'pea.{program}')
+
+
+def run_job(job_id, program, args, cwd):
+    """Run a program in cwd as its command line would, with args the flags.
+
+    The start is reported first. The flags of the previous job of the worker
+    are reset. A flag error or an exception gives exit code 1, as the command
+    line does.
+    """
+    started = time.time()
+    job_starts.put(job_id)
+    module = importlib.import_module(f'pea.{program}')
+    exit_code, error = 0, None
+    try:
+        os.chdir(cwd)
+        FLAGS.unparse_flags()
+        FLAGS([program] + list(args))
+        module.main([program])
+    except flags.Error as e:
+        exit_code, error = 1, f'Flags parsing error: {e}'
+    except SystemExit as e:
+        exit_code = e.code if isinstance(e.code, int) else 0 if e.code is None else 1
+    except Exception as e:
+        logger.exception(f"{program} failed")
+        exit_code, error = 1, f'{type(e).__name__}: {e}'
+    return JobResult(exit_code, error, started, time.time())
+
+
+class Job:
+    def __init__(self, id, program, args, cwd, future):
+        self.id = id
+        self.program = program
+        self.args = args
+        self.cwd = cwd
+        self.submitted = time.time()
+        self.future = future
+        self.started = False
+
+    def state(self):
+        # future.running() is also true of the jobs waiting in the call queue
+        # of the pool, so a job runs once its worker has reported it.
+        if not self.future.done():
+            return 'running' if self.started else 'queued'
+        if self.future.exception() is not None or self.future.result().exit_code != 0:
+            return 'failed'
+        return 'done'
+
+    def to_dict(self):
+        job = {'id': self.id, 'program': self.program, 'args': self.args, 'cwd': self.cwd,
+               'state': self.state(), 'exit_code': None, 'error': None}
+        if self.future.done():
+            e = self.future.exception()
+            if e is not None:
+                job.update(exit_code=1, error=f'{type(e).__name__}: {e}')
+            else:
+                result = self.future.result()
+                job.update(exit_code=result.exit_code, error=result.error,
+                           seconds=round(result.finished - result.started, 3),
+                           queued_seconds=round(result.started - self.submitted, 3))
+        return job
+
+
+class Scheduler:
+    """Warm worker pools, one per program, and the jobs submitted to them.
+
+    Programs get their own pools because their flags are defined on the same
+    absl FLAGS; each worker imports its program once. A pool broken by a
+    worker that died is replaced on the next submission. Workers report the
+    jobs they start on a queue, which a thread reads.
+
+    Only the max_finished_jobs last finished jobs are kept; the status counts
+    all of them as they finish.
+    """
+    def __init__(self, programs, jobs, throughput_window=60, max_finished_jobs=10000):
+        self.jobs = jobs
+        self.throughput_window = throughput_window
+        self.max_finished_jobs = max_finished_jobs
+        self.starts = multiprocessing.Queue()
+        self.executors = {program: self.start_pool(program) for program in programs}
+        self.ids = itertools.count(1)
+        self.live = {}
+        self.retained = OrderedDict()
+        self.counts = {'done': 0, 'failed': 0}
+        self.done_seconds = 0.0
+        self.finished = deque()
+        self.lock = threading.Lock()
+        self.t0 = time.time()
+        self.start_reader = threading.Thread(target=self.read_starts, daemon=True)
+        self.start_reader.start()
+
+    def start_pool(self, program):
+        executor = ProcessPoolExecutor(self.jobs, initializer=load_program, initargs=(program, self.starts))
+        executor.submit(importlib.import_module, 'pea')  # start a worker now rather than on the first job
+        return executor
+
+    def read_starts(self):
+        for job_id in iter(self.starts.get, None):
+            with self.lock:
+                job = self.live.get(job_id)
+                if job is not None:
+                    job.started = True
+
+    def submit(self, program, args, cwd):
+        with self.lock:
+            job_id = next(self.ids)
+            try:
+                future = self.executors[program].submit(run_job, job_id, program, args, cwd)
+            except BrokenProcessPool:
+                logger.warning(f"{program} workers died; starting new ones.")
+                self.executors[program] = self.start_pool(program)
+                future = self.executors[program].submit(run_job, job_id, program, args, cwd)
+            job = Job(job_id, program, args, cwd, future)
+            self.live[job.id] = job
+        future.add_done_callback(lambda f: self.on_done(job))
+        return job
+
+    def get(self, job_id):
+        """The job of job_id, None if there is none or it is no longer kept."""
+        with self.lock:
+            return self.live.get(job_id) or self.retained.get(job_id)
+
+    def drop_old_finished(self, now):
+        while self.finished and self.finished[0] < now - self.throughput_window:
+            self.finished.popleft()
+
+    def on_done(self, job):
+        state = job.state()
+        now = time.time()
+        with self.lock:
+            del self.live[job.id]
+            self.retained[job.id] = job
+            if len(self.retained) > self.max_finished_jobs:
+                self.retained.popitem(last=False)
+            self.counts[state] += 1
+            if state == 'done':
+                result = job.future.result()
+                self.done_seconds += result.finished - result.started
+            self.finished.append(now)
+            self.drop_old_finished(now)
+        log = logger.info if state == 'done' else logger.error
+        log(f"Job {job.id} {job.program} {state}: {job.to_dict()['error'] or ''}")
+
+    def status(self):
+        now = time.time()
+        with self.lock:
+            states = [job.state() for job in self.live.values()]
+            self.drop_old_finished(now)
+            n_recent = len(self.finished)
+            counts = dict(self.counts)
+            done_seconds = self.done_seconds
+        return {'uptime_seconds': round(now - self.t0, 1),
+                'workers': {program: self.jobs for program in self.executors},
+                'queue_depth': states.count('queued'),
+                'running': states.count('running'),
+                'done': counts['done'],
+                'failed': counts['failed'],
+                'jobs_per_minute': round(n_recent * 60 / min(self.throughput_window, max(now - self.t0, 1e-9)), 2),
+                'mean_job_seconds': round(done_seconds / counts['done'], 3) if counts['done'] else None}
+
+    def shutdown(self):
+        for executor in self.executors.values():
+            executor.shutdown(wait=True, cancel_futures=True)
+        self.starts.put(None)
+        self.start_reader.join()
+
+
+class JobRequestHandler(BaseHTTPRequestHandler):
+    """JSON API: POST /jobs {program, args, cwd} as application/json and
+    without an Origin; GET /jobs/<id>, with ?wait=1 to answer once the job has
+    finished; GET /status."""
+    def send_json(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        if urlparse(self.path).path != '/jobs':
+            return self.send_json(404, {'error': f'No such endpoint: {self.path}'})
+        # Browsers send an Origin with cross-site requests, and can't send a JSON
+        # content type without one, so a web page can't submit jobs.
+        if 'Origin' in self.headers:
+            return self.send_json(403, {'error': 'Cross-origin requests are not accepted'})
+        if self.headers.get_content_type() != 'application/json':
+            return self.send_json(415, {'error': 'Jobs must be posted as application/json'})
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            program, args, cwd = body['program'], [str(x) for x in body.get('args', [])], body['cwd']
+        except (ValueError, KeyError, TypeError) as e:
+            return self.send_json(400, {'error': f'Malformed job request: {e}'})
+        if program not in self.server.scheduler.executors:
+            return self.send_json(400, {'error': f'Not a served program: {program}'})
+        if not os.path.isdir(cwd):
+            return self.send_json(400, {'error': f'No such directory: {cwd}'})
+        job = self.server.scheduler.submit(program, args, cwd)
+        self.send_json(202, job.to_dict())
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/status':
+            return self.send_json(200, self.server.scheduler.status())
+        parts = url.path.strip('/').split('/')
+        if len(parts) != 2 or parts[0] != 'jobs' or not parts[1].isdigit():
+            return self.send_json(404, {'error': f'No such endpoint: {self.path}'})
+        job = self.server.scheduler.get(int(parts[1]))
+        if job is None:
+            return self.send_json(404, {'error': f'No such job: {parts[1]}'})
+        if parse_qs(url.query).get('wait') == ['1']:
+            job.future.exception()  # waits for the job without raising
+        self.send_json(200, job.to_dict())
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def main(argv):
+    del argv
+
+    logger.info('Program start.')
+    scheduler = Scheduler(SERVED_PROGRAMS, FLAGS.serve_jobs, FLAGS.serve_throughput_window,
+                          FLAGS.serve_max_finished_jobs)
+    server = ThreadingHTTPServer(('127.0.0.1', FLAGS.serve_port), JobRequestHandler)
+    server.scheduler = scheduler
+    logger.info(f"Serving {', '.join(SERVED_PROGRAMS)} with {FLAGS.serve_jobs} workers each "
+                f"on 127.0.0.1:{FLAGS.serve_port}.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        scheduler.shutdown()
+    logger.info("Program end.")
+
+
+if __name__ == '__main__':
+    app.run(main)
@@ -1,11 +1,17 @@
+import functools
 import glob
 import sys
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
 import numpy as np
 import pandas as pd
 from absl import app, flags
 
+from .util import encode_seqs
+from .util_io import read_table, write_table
+from .metrics import Metrics
+
 
 FLAGS = flags.FLAGS
 
@@ -13,6 +19,12 @@ flags.DEFINE_multi_integer('pos', None, "1-based position to use as flags")
 flags.DEFINE_integer('beg', None, "1-based start position of the subsequence of interest")
 flags.DEFINE_integer('end', None, "1-based end position of the subsequence of interest")
 flags.DEFINE_string('subdir', 'trimmed', "Sub-directory name to store trimmed align files")
+flags.DEFINE_string('input_file_glob', '*.align.csv', "Glob pattern for input files; .parquet files are read and "
+                    "written as Parquet")
+flags.DEFINE_integer('jobs', 1, "Number of input files split in parallel")
+flags.DEFINE_boolean('metrics', False,
+                     "Write the time, read counts and peak RSS of the split to split_align_file.metrics.json")
+flags.DEFINE_boolean('profile', False, "Profile the split with cProfile into split_align_file.prof; implies --metrics")
 
 flags.mark_flag_as_required('pos')
 flags.mark_flag_as_required('beg')
@@ -29,34 +41,70 @@ def trim_seq(df, idx_beg, idx_end):
     return trimmed
 
 
-def get_tag_element(row, one_based_idx):
-    aligner = list(np.cumsum(np.array(list(row.ref))!='-')-1)
-    i_aligned =  aligner.index(one_based_idx-1)
-    return row.ref[i_aligned] + str(one_based_idx) + row.read[i_aligned]
+def get_tags(df, poss):
+    """Tags of all rows: <ref base><pos><read base> for each of poss, joined by '_'.
+
+    The alignment column of each 1-based reference position is found once
+    per distinct ref; the read bases are then picked from a uint8 matrix.
+    """
+    ref_ids, refs = pd.factorize(df.ref)
+    cols = np.empty((len(refs), len(poss)), dtype=np.int64)
+    for k, ref in enumerate(refs):
+        ref_cols = np.flatnonzero(np.frombuffer(ref.encode('ascii'), dtype=np.uint8) != ord('-'))
+        if max(poss) > len(ref_cols):
+            raise ValueError(f'Position {max(poss)} is beyond the {len(ref_cols)} bases of reference {ref}')
+        cols[k] = ref_cols[np.array(poss) - 1]
+    row_cols = cols[ref_ids]
+    rows = np.arange(len(df))[:, None]
+    ref_bases = encode_seqs(df.ref)[rows, row_cols].view('S1').astype(str)
+    read_bases = encode_seqs(df.read)[rows, row_cols].view('S1').astype(str)
+    elements = [np.char.add(np.char.add(ref_bases[:, i], str(pos)), read_bases[:, i]) for i, pos in enumerate(poss)]
+    return list(functools.reduce(lambda x, y: np.char.add(np.char.add(x, '_'), y), elements))
+
+
+def split_file(name, poss, subdir, idx_beg, idx_end):
+    """Write the rows of one align table to <subdir>/<tag>.<file name>, one file
+    per tag; tags with a deletion at any of poss are left out.
+
+    Returns the reads and rows of the table, and the reads and files written.
+    """
+    df = read_table(name)
+    if df.empty:
+        return 0, 0, 0, 0
+    df['tag'] = get_tags(df, poss)
+    trimmed = trim_seq(df, idx_beg, idx_end)
+    tag_ids, tags = pd.factorize(trimmed.tag, sort=True)
+    order = np.argsort(tag_ids, kind='stable')
+    bounds = np.cumsum(np.bincount(tag_ids, minlength=len(tags)))[:-1]
+    n_reads_out = n_files = 0
+    for tag, idx in zip(tags, np.split(order, bounds)):
+        if '-' in tag:
+            continue
+        write_table(trimmed.iloc[idx], Path(subdir) / f'{tag}.{Path(name).name}')
+        n_reads_out += trimmed.n_reads.iloc[idx].sum()
+        n_files += 1
+    return df.n_reads.sum(), len(df), n_reads_out, n_files
 
 
 def main(argv):
     del argv
     
-    poss = FLAGS.pos
-    subdir = FLAGS.subdir
-    
-    idx_beg = FLAGS.beg
-    idx_end = FLAGS.end
-        
-    dfs={x:pd.read_csv(x) for x in sorted(glob.glob('*.align.csv'))}
-    
-    Path(subdir).mkdir(parents=True, exist_ok=True)
+    names = sorted(glob.glob(FLAGS.input_file_glob))
+    Path(FLAGS.subdir).mkdir(parents=True, exist_ok=True)
     
-
-    for name, df in dfs.items():
-        df['tag']=df.apply(lambda x: '_'.join([get_tag_element(x, i) for i in poss]), axis=1)
-        for tag,dg in df.groupby('tag'):
-            new_name = f'{subdir}/{tag}.{name}'
-            if '-' in tag:
-                continue
-            trim_seq(dg, idx_beg, idx_end).to_csv(new_name, index=False)
+    run = functools.partial(split_file, poss=FLAGS.pos, subdir=FLAGS.subdir, idx_beg=FLAGS.beg, idx_end=FLAGS.end)
+    metrics = Metrics('split_align_file', FLAGS.profile)
+    with metrics.stage('split') as record:
+        if FLAGS.jobs <= 1:
+            counts = [run(name) for name in names]
+        else:
+            with ProcessPoolExecutor(FLAGS.jobs) as executor:
+                counts = list(executor.map(run, names))
+        reads_in, unique_seqs, reads_out, files_out = np.sum(counts, axis=0, dtype=np.int64) if counts else [0] * 4
+        record.update(files=len(names), reads_in=reads_in, unique_seqs=unique_seqs, reads_out=reads_out,
+                      files_out=files_out)
+    if FLAGS.metrics or FLAGS.profile:
+        metrics.write('split_align_file.')
 
 if __name__=='__main__':
     app.run(main)
-
@@ -1,3 +1,7 @@
+import math
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from typing import NamedTuple
 
 import numpy as np
@@ -126,47 +130,310 @@ def matchUpto1(target, seq, reverse=False):
     return -1
 
 
-def get_user_region_query(aligner, query_seq, tr, ur):
-    user_seq_beg = max(0, ur.beg - tr.cmp_beg)
-    user_seq_end = max(0, ur.end - tr.cmp_beg)
-
-    alignment = aligner.align(tr.comparison_region(), query_seq)[0]
-#     beg_mapper = get_beg_mapper(alignment)
-#     end_mapper = get_end_mapper(alignment)
-#     assert alignment.target == tr.comparison_region()
-
-    [str_ref, str_align, str_read, _] = str(alignment).split("\n")
-    if len(str_ref)==tr.cmp_end-tr.cmp_beg :
-        beg=user_seq_beg
-        end=user_seq_end
-    else:
-        seq=list(str_ref)
-        mapper=np.cumsum(np.array(seq)!='-')-1
-        beg=np.argmax(mapper==user_seq_beg)
-        end=np.argmax(mapper==user_seq_end)
-    
-    return str_read[beg:end].replace('-','')
+def encode_seqs(seqs, width=None):
+    """Encode sequences as a zero-padded uint8 matrix, one row per sequence."""
+    seqs = list(seqs)
+    if width is None:
+        width = max(map(len, seqs), default=0)
+    codes = np.zeros((len(seqs), width), dtype=np.uint8)
+    if seqs and width:
+        codes[:] = np.array(seqs, dtype=f'S{width}').view(np.uint8).reshape(len(seqs), width)
+    return codes
+
+
+def locate_indicators(target, seqs, reverse=False, block_rows=512):
+    """Vectorized matchUpto1 over a block of reads.
+
+    Every window is compared with the target at once on a uint8 matrix of the
+    reads. Windows whose first half matches exactly are preferred, then any
+    window with at most one mismatch; the leftmost (rightmost if reverse)
+    window wins. A window may hang over the read end by one base, which counts
+    as a mismatch, as in mismatch(). Returns the window starts, -1 if none.
+    """
+    seqs = list(seqs)
+    if len(seqs) > block_rows:
+        return np.concatenate([locate_indicators(target, seqs[i:i + block_rows], reverse, block_rows)
+                               for i in range(0, len(seqs), block_rows)])
+    m = len(target)
+    half_len = m // 2
+    codes = encode_seqs(seqs)
+    n, width = codes.shape
+    n_pos = width - m + 2
+    if n == 0 or n_pos <= 0:
+        return np.full(n, -1, dtype=np.int64)
+
+    padded = np.zeros((n, width + 1), dtype=np.uint8)
+    padded[:, :width] = codes
+    target_codes = np.frombuffer(target.encode('ascii'), dtype=np.uint8)
+
+    mm_fst = np.zeros((n, n_pos), dtype=np.uint8)
+    mm_snd = np.zeros((n, n_pos), dtype=np.uint8)
+    neq = np.empty((n, n_pos), dtype=bool)
+    for k, c in enumerate(target_codes):
+        np.not_equal(padded[:, k:k + n_pos], c, out=neq)
+        mm = mm_fst if k < half_len else mm_snd
+        np.add(mm, neq, out=mm)
+
+    ok = (mm_fst + mm_snd) < 2
+    fst_ok = ok & (mm_fst == 0)
+    if reverse:
+        ok = ok[:, ::-1]
+        fst_ok = fst_ok[:, ::-1]
+    pos = np.where(fst_ok.any(axis=1), fst_ok.argmax(axis=1),
+                   np.where(ok.any(axis=1), ok.argmax(axis=1), -1))
+    if reverse:
+        pos = np.where(pos == -1, -1, n_pos - 1 - pos)
+    return pos.astype(np.int64)
+
+
+INDICATOR_SEARCH_METHODS = ['vectorized', 'legacy', 'compare']
+
+
+class IndicatorLocator:
+    """Finds indicator sequences in blocks of reads.
+
+    method is 'vectorized' (locate_indicators), 'legacy' (matchUpto1 per read)
+    or 'compare', which runs both, keeps the legacy positions and counts the
+    reads on which the two disagree.
+    """
+    def __init__(self, method='vectorized'):
+        if method not in INDICATOR_SEARCH_METHODS:
+            raise ValueError(f'Unknown indicator search method: {method}')
+        self.method = method
+        self.n_compared = 0
+        self.n_discordant = 0
+
+    def __call__(self, target, seqs, reverse=False):
+        if self.method == 'vectorized':
+            return locate_indicators(target, seqs, reverse)
+        legacy = np.array([matchUpto1(target, x, reverse) for x in seqs], dtype=np.int64)
+        if self.method == 'compare':
+            vectorized = locate_indicators(target, seqs, reverse)
+            self.n_compared += len(legacy)
+            self.n_discordant += int(np.sum(legacy != vectorized))
+        return legacy
+
+
+class StrandHits(NamedTuple):
+    seqs: list
+    left: np.ndarray
+
+
+def locate_on_both_strands(seqs, idc_l, locator=locate_indicators):
+    """The left indicator on both strands of the reads.
+
+    seqs holds the reads followed by their reverse complements and left the
+    left indicator position on each (-1 if absent). A read may hold it on
+    both strands, e.g. a spurious forward hit of a reverse read; both are
+    kept, as the programs have always searched every read and its reverse
+    complement.
+    """
+    seqs = list(seqs)
+    seqs += [revertedSeq(x) for x in seqs]
+    return StrandHits(seqs, locator(idc_l, seqs))
+
+
+def alignment_coordinates(alignment):
+    """Segment end points of a pairwise alignment; row 0 target, row 1 query."""
+    try:
+        return alignment.coordinates
+    except AttributeError:
+        return np.array(alignment.path).T
+
+
+def project_path(target, query, coordinates, beg, end):
+    """Aligned ref/alignment/read strings over the target positions [beg, end).
+
+    The gapped strings are assembled from the alignment segments, with '|' for
+    matches, '.' for mismatches and '-' for gaps, as str(alignment) printed
+    them. Without insertions the columns are the target positions; otherwise
+    beg/end map to the column of that target base, and to column 0 past the
+    target end, as the former cumsum/argmax mapper did.
+    """
+    str_ref, str_align, str_read = [], [], []
+    col_beg = col_end = 0
+    has_insertion = False
+    col = 0
+    for (t0, q0), (t1, q1) in zip(coordinates.T[:-1].tolist(), coordinates.T[1:].tolist()):
+        if t0 <= beg < t1:
+            col_beg = col + beg - t0
+        if t0 <= end < t1:
+            col_end = col + end - t0
+        if t1 > t0 and q1 > q0:
+            ref, read = target[t0:t1], query[q0:q1]
+            str_ref.append(ref)
+            str_read.append(read)
+            str_align.append(''.join(['|' if a == b else '.' for a, b in zip(ref, read)]))
+        elif t1 > t0:
+            str_ref.append(target[t0:t1])
+            str_read.append('-' * (t1 - t0))
+            str_align.append('-' * (t1 - t0))
+        else:
+            has_insertion = True
+            str_ref.append('-' * (q1 - q0))
+            str_read.append(query[q0:q1])
+            str_align.append('-' * (q1 - q0))
+        col += max(t1 - t0, q1 - q0)
+    if not has_insertion:
+        col_beg, col_end = beg, end
+    return (''.join(str_ref)[col_beg:col_end],
+            ''.join(str_align)[col_beg:col_end],
+            ''.join(str_read)[col_beg:col_end])
+
+
+def project_alignment(alignment, beg, end):
+    return project_path(alignment.target, alignment.query, alignment_coordinates(alignment), beg, end)
+
+
+def user_region_bounds(tr, ur):
+    return max(0, ur.beg - tr.cmp_beg), max(0, ur.end - tr.cmp_beg)
+
+
+def project_user_region(tr, ur, alignment):
+    return project_alignment(alignment, *user_region_bounds(tr, ur))
+
+
+def user_region_query(projection):
+    _, _, str_read = projection
+    return str_read.replace('-','')
+
+
+def user_region_alignment(projection):
+    str_ref, str_align, str_read = projection
+    return {"ref": str_ref, "alignment": str_align, "read": str_read}
 
-#     return alignment.query[beg_mapper[user_seq_beg]:end_mapper[user_seq_end]]
 
+def get_user_region_query(aligner, query_seq, tr, ur):
+    alignment = aligner.align(tr.comparison_region(), query_seq)[0]
+    return user_region_query(project_user_region(tr, ur, alignment))
 
-def align_read_to_user_region(aligner, x, tr, ur):
-    query_seq = x.query_seq
-    user_seq_beg = max(0, ur.beg - tr.cmp_beg)
-    user_seq_end = max(0, ur.end - tr.cmp_beg)
 
-    
+def align_query_to_user_region(aligner, query_seq, tr, ur):
     alignment = aligner.align(tr.comparison_region(), query_seq)[0]
+    return user_region_alignment(project_user_region(tr, ur, alignment))
 
-    [str_ref, str_align, str_read, _] = str(alignment).split("\n")
-    if len(str_ref)==tr.cmp_end-tr.cmp_beg :
-        f = lambda x: x[user_seq_beg:user_seq_end]
-    else:
-        seq=list(str_ref)
-        mapper=np.cumsum(np.array(seq)!='-')-1
-        beg=np.argmax(mapper==user_seq_beg)
-        end=np.argmax(mapper==user_seq_end)
-        f = lambda x: x[beg:end]
-    # return f(str_ref), f(str_align), f(str_read)
-    return {"ref": f(str_ref), "alignment": f(str_align), "read":f(str_read), "n": x.n}
 
+def align_read_to_user_region(aligner, x, tr, ur):
+    return {**align_query_to_user_region(aligner, x.query_seq, tr, ur), "n": x.n}
+
+
+def max_ungapped_mismatches(aligner):
+    """Largest Hamming distance at which the ungapped alignment of an
+    equal-length query is the unique optimal global alignment.
+
+    Any gapped alignment of two length-L sequences has at most L-1 aligned
+    pairs and at least one gap in each sequence, so it scores at most
+    (L-1)*match + 2*open_gap. With h mismatches the ungapped one scores
+    L*match - h*(match - mismatch).
+    """
+    limit = (aligner.match_score - 2 * aligner.open_gap_score) / (aligner.match_score - aligner.mismatch_score)
+    return max(0, math.ceil(limit) - 1)
+
+
+def triage_ungapped(tr, ur, query_seqs, max_mismatches):
+    """User-region projections of the queries that need no aligner.
+
+    Queries of the comparison region length within max_mismatches
+    substitutions are projected as ungapped alignments; the others get None.
+    """
+    ref = tr.comparison_region()
+    projections = [None] * len(query_seqs)
+    i_same_len = [i for i, query_seq in enumerate(query_seqs) if len(query_seq) == len(ref)]
+    if not i_same_len:
+        return projections
+    neq = encode_seqs([query_seqs[i] for i in i_same_len], len(ref)) != np.frombuffer(ref.encode('ascii'), np.uint8)
+    beg, end = user_region_bounds(tr, ur)
+    str_ref = ref[beg:end]
+    align_codes = np.where(neq[:, beg:end], ord('.'), ord('|')).astype(np.uint8)
+    for row in np.flatnonzero(neq.sum(axis=1) <= max_mismatches):
+        i = i_same_len[row]
+        projections[i] = (str_ref, align_codes[row].tobytes().decode('ascii'), query_seqs[i][beg:end])
+    return projections
+
+
+_align_worker = {}
+
+def _init_align_worker(open_gap_score, tr, ur, band_margin=None):
+    from .banded import BandedAligner
+    aligner = get_aligner(open_gap_score)
+    banded = BandedAligner(aligner, band_margin) if band_margin is not None else None
+    _align_worker.update(aligner=aligner, banded=banded, tr=tr, ur=ur)
+
+
+def _align_chunk(result, query_seqs):
+    aligner, banded, tr, ur = (_align_worker[k] for k in ('aligner', 'banded', 'tr', 'ur'))
+    cmp_region = tr.comparison_region()
+    beg, end = user_region_bounds(tr, ur)
+    paths = banded.align_many(cmp_region, query_seqs) if banded is not None else [None] * len(query_seqs)
+    results = []
+    for query_seq, coordinates in zip(query_seqs, paths):
+        if coordinates is None:
+            coordinates = alignment_coordinates(aligner.align(cmp_region, query_seq)[0])
+        results.append(result(project_path(cmp_region, query_seq, coordinates, beg, end)))
+    return results, sum(c is not None for c in paths)
+
+
+def _align_all(result, query_seqs, tr, ur, open_gap_score, workers, band_margin=None):
+    if workers <= 1 or len(query_seqs) < 2:
+        _init_align_worker(open_gap_score, tr, ur, band_margin)
+        return _align_chunk(result, query_seqs)
+
+    chunk_size = max(1, min(1024, len(query_seqs) // (workers * 8)))
+    chunks = [query_seqs[i:i + chunk_size] for i in range(0, len(query_seqs), chunk_size)]
+    with ProcessPoolExecutor(workers, initializer=_init_align_worker,
+                             initargs=(open_gap_score, tr, ur, band_margin)) as executor:
+        done = list(executor.map(partial(_align_chunk, result), chunks))
+    return [r for results, _ in done for r in results], sum(n_banded for _, n_banded in done)
+
+
+def align_queries(result, query_seqs, tr, ur, open_gap_score=-2.01, workers=1, cache=None,
+                  max_mismatches=None, stats=None, band_margin=None):
+    """Align every unique query sequence and build result(projection) for it.
+
+    result is user_region_query or user_region_alignment. Cached results
+    (if an AlignmentCache is given) are reused first. Equal-length queries
+    within max_mismatches substitutions take the ungapped fast path, capped
+    at max_ungapped_mismatches() so the output equals the aligner's; a
+    negative max_mismatches disables it. The rest are aligned, over a process
+    pool if workers > 1, whose workers build their own aligner and keep tr/ur
+    for their lifetime. With a band_margin they go through a BandedAligner
+    first, and only queries it cannot settle reach the full aligner. Counts
+    per route are added to the stats Counter.
+    Results are returned in the order of query_seqs.
+    """
+    query_seqs = list(query_seqs)
+    stats = Counter() if stats is None else stats
+    results = [None] * len(query_seqs)
+    todo = list(range(len(query_seqs)))
+
+    if cache is not None:
+        namespace = cache.namespace(result, tr, ur, open_gap_score)
+        keys = [cache.key(namespace, query_seq) for query_seq in query_seqs]
+        cached = cache.get_many(keys)
+        for i in todo:
+            results[i] = cached.get(keys[i])
+        todo = [i for i in todo if keys[i] not in cached]
+        stats['cached'] += len(query_seqs) - len(todo)
+
+    safe_max_mismatches = max_ungapped_mismatches(get_aligner(open_gap_score))
+    if max_mismatches is None:
+        max_mismatches = safe_max_mismatches
+    if max_mismatches >= 0:
+        projections = triage_ungapped(tr, ur, [query_seqs[i] for i in todo],
+                                      min(max_mismatches, safe_max_mismatches))
+        for i, projection in zip(todo, projections):
+            if projection is not None:
+                results[i] = result(projection)
+        n_todo = len(todo)
+        todo = [i for i, projection in zip(todo, projections) if projection is None]
+        stats['fast_path'] += n_todo - len(todo)
+
+    aligned, n_banded = _align_all(result, [query_seqs[i] for i in todo], tr, ur, open_gap_score, workers,
+                                   band_margin)
+    for i, r in zip(todo, aligned):
+        results[i] = r
+    stats['banded'] += n_banded
+    stats['aligned'] += len(todo) - n_banded
+    if cache is not None:
+        cache.put_many([(keys[i], r) for i, r in zip(todo, aligned)])
+    return results
@@ -1,7 +1,248 @@
 import asyncio
-import sys
-from asyncio.subprocess import PIPE, STDOUT
+import gzip
+import itertools
+import logging
+import os
+import shlex
+import time
+from asyncio.subprocess import DEVNULL, STDOUT
+from collections import Counter
 from pathlib import Path
+from typing import NamedTuple
+
+import numpy as np
+import pandas as pd
+
+
+logger = logging.getLogger('util_io')
+
+GZIP_MAGIC = b'\x1f\x8b'
+READ_BLOCK_SIZE = 4096
+TABLE_FORMATS = ['csv', 'parquet']
+DICTIONARY_COLUMNS = ['ref', 'alignment', 'read']
+REJECT_REASONS = ['n_content', 'length', 'mean_quality', 'min_quality']
+PHRED_OFFSET = 33
+
+
+def open_fastq(path):
+    """Open a plain or gzip-compressed FASTQ file for binary reading."""
+    with open(path, 'rb') as f:
+        magic = f.read(2)
+    if magic == GZIP_MAGIC:
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def iter_line_chunks(f, chunk_size=1 << 20):
+    """Lists of the lines of a binary file, one per chunk read."""
+    rest = b''
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            break
+        lines = (rest + chunk).split(b'\n')
+        rest = lines.pop()
+        yield lines
+    if rest:
+        yield [rest]
+
+
+def iter_lines(f, chunk_size=1 << 20):
+    for lines in iter_line_chunks(f, chunk_size):
+        yield from lines
+
+
+class ReadFilter(NamedTuple):
+    """Prefilter of FASTQ records; criteria left None are not checked.
+
+    Reads are rejected with more than max_n Ns, a length outside
+    [min_length, max_length], a mean Phred quality below min_mean_quality or
+    a base of quality below min_base_quality.
+    """
+    max_n: int = None
+    min_length: int = None
+    max_length: int = None
+    min_mean_quality: float = None
+    min_base_quality: int = None
+
+    def is_active(self):
+        return any(x is not None for x in self)
+
+    @property
+    def uses_quality(self):
+        return self.min_mean_quality is not None or self.min_base_quality is not None
+
+    def reject_codes(self, seqs, quals=None):
+        """Index in REJECT_REASONS of the first criterion each of the bytes
+        seqs fails, or -1; the quality criteria are checked only if their
+        quality lines are given."""
+        lengths = np.fromiter(map(len, seqs), dtype=np.int64, count=len(seqs))
+        failed = [None] * len(REJECT_REASONS)
+        if self.max_n is not None:
+            failed[0] = segment_reduce(np.add, seqs, lambda x: x == ord('N')) > self.max_n
+        if self.min_length is not None or self.max_length is not None:
+            failed[1] = ((lengths < self.min_length) if self.min_length is not None else False) | \
+                        ((lengths > self.max_length) if self.max_length is not None else False)
+        if quals is not None and self.min_mean_quality is not None:
+            qual_lengths = np.fromiter(map(len, quals), dtype=np.int64, count=len(quals))
+            sums = segment_reduce(np.add, quals)
+            failed[2] = sums < (self.min_mean_quality + PHRED_OFFSET) * qual_lengths
+            failed[2] |= qual_lengths == 0
+        if quals is not None and self.min_base_quality is not None:
+            failed[3] = segment_reduce(np.minimum, quals, initial=255) < self.min_base_quality + PHRED_OFFSET
+        codes = np.full(len(seqs), -1)
+        for k in reversed(range(len(REJECT_REASONS))):
+            if failed[k] is not None:
+                codes[failed[k]] = k
+        return codes
+
+    def filter_counts(self, read_counts, rejected):
+        """read_counts without the reads failing the sequence criteria, whose
+        counts are added to the rejected Counter by reason."""
+        kept = Counter()
+        for block in iter_chunks(read_counts.items()):
+            codes = self.reject_codes([x.encode('ascii') for x, _ in block])
+            for (x, n), code in zip(block, codes.tolist()):
+                if code < 0:
+                    kept[x] = n
+                else:
+                    rejected[REJECT_REASONS[code]] += n
+        return kept
+
+
+def segment_reduce(ufunc, lines, transform=None, initial=0):
+    """ufunc reduction of the bytes of each of lines, initial for empty ones."""
+    lengths = np.fromiter(map(len, lines), dtype=np.int64, count=len(lines))
+    out = np.full(len(lines), initial, dtype=np.int64)
+    nonempty = lengths > 0
+    if nonempty.any():
+        values = np.frombuffer(b''.join(lines), dtype=np.uint8)
+        if transform is not None:
+            values = transform(values)
+        starts = (np.cumsum(lengths) - lengths)[nonempty]
+        out[nonempty] = ufunc.reduceat(values, starts, dtype=np.int64)
+    return out
+
+
+def iter_records(f, chunk_size, with_quality):
+    """(sequence, quality or None) bytes of the FASTQ records of a binary file."""
+    seq = None
+    for i, line in enumerate(iter_lines(f, chunk_size)):
+        k = i % 4
+        if k == 1:
+            seq = line.rstrip(b'\r')
+            if not with_quality:
+                yield seq, None
+        elif k == 3 and with_quality:
+            yield seq, line.rstrip(b'\r')
+
+
+def filter_records(records, read_filter, with_quality, rejected):
+    """The (sequence, quality) records passing read_filter, checked a block at
+    a time; the failing ones are counted by reason in the rejected Counter."""
+    for block in iter_chunks(records):
+        seqs, quals = zip(*block)
+        codes = read_filter.reject_codes(seqs, quals if with_quality else None)
+        for record, code in zip(block, codes.tolist()):
+            if code >= 0:
+                rejected[REJECT_REASONS[code]] += 1
+            else:
+                yield record
+
+
+def iter_fastq(path, with_quality=False, chunk_size=1 << 20, read_filter=None, rejected=None):
+    """Stream the records of a FASTQ(join) file, reading fixed-size chunks.
+
+    Yields sequence lines, or (sequence, quality) pairs if with_quality is set.
+    Only one chunk and the current record are kept in memory. With an active
+    read_filter, records are checked a block at a time before they are
+    decoded; the failing ones are dropped and counted by reason in the
+    rejected Counter if given.
+    """
+    filtered = read_filter is not None and read_filter.is_active()
+    use_quality = with_quality or (filtered and read_filter.uses_quality)
+    with open_fastq(path) as f:
+        records = iter_records(f, chunk_size, use_quality)
+        if filtered:
+            records = filter_records(records, read_filter, use_quality, Counter() if rejected is None else rejected)
+        for seq, qual in records:
+            if with_quality:
+                yield seq.decode('ascii'), qual.decode('ascii')
+            else:
+                yield seq.decode('ascii')
+
+
+def strip_cr(lines):
+    """lines without trailing carriage returns, left as they are if there are none."""
+    if b'\r' not in b''.join(lines):
+        return lines
+    return [x.rstrip(b'\r') for x in lines]
+
+
+def iter_seq_lines(f, chunk_size, block_size):
+    """Lists of at least block_size (but the last) sequence lines of a binary
+    FASTQ file, sliced out of the lines of each chunk."""
+    seqs = []
+    k = 1  # index of the first sequence line in the next chunk
+    for lines in iter_line_chunks(f, chunk_size):
+        seqs += lines[k::4]
+        k = (k - len(lines)) % 4
+        if len(seqs) >= block_size:
+            yield seqs
+            seqs = []
+    if seqs:
+        yield seqs
+
+
+def iter_seq_blocks(path, read_filter=None, rejected=None, chunk_size=1 << 20, block_size=1 << 16):
+    """Stream the sequence lines of a FASTQ(join) file undecoded, as lists of
+    about block_size bytes. Reads failing an active read_filter are dropped
+    and counted by reason in the rejected Counter if given."""
+    active = read_filter is not None and read_filter.is_active()
+    use_quality = active and read_filter.uses_quality
+    rejected = Counter() if rejected is None else rejected
+    with open_fastq(path) as f:
+        if use_quality:
+            blocks = (zip(*block) for block in iter_chunks(iter_records(f, chunk_size, True), block_size))
+        else:
+            blocks = ((strip_cr(block), None) for block in iter_seq_lines(f, chunk_size, block_size))
+        for seqs, quals in blocks:
+            seqs = list(seqs)
+            if active:
+                codes = read_filter.reject_codes(seqs, quals)
+                for k, n in enumerate(np.bincount(codes[codes >= 0], minlength=len(REJECT_REASONS)).tolist()):
+                    if n:
+                        rejected[REJECT_REASONS[k]] += n
+                seqs = list(itertools.compress(seqs, (codes < 0).tolist()))
+            yield seqs
+
+
+def iter_chunks(iterable, size=READ_BLOCK_SIZE):
+    it = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def write_table(df, path, index=False):
+    """Write df as CSV, or as Parquet if path ends with .parquet; there the
+    ref, alignment and read columns are dictionary-encoded."""
+    if str(path).endswith('.parquet'):
+        df = df.astype({c: 'category' for c in DICTIONARY_COLUMNS if c in df.columns})
+        df.to_parquet(path, engine='fastparquet', index=index)
+    else:
+        df.to_csv(path, index=index)
+
+
+def read_table(path, columns=None):
+    """Read a table written by write_table, only the given columns if any."""
+    if str(path).endswith('.parquet'):
+        df = pd.read_parquet(path, engine='fastparquet', columns=columns)
+        return df.astype({c: object for c in DICTIONARY_COLUMNS if c in df.columns})
+    return pd.read_csv(path, usecols=columns)
+
 
 def parse_fastqjoin_group_dict(file_group_rows):
     file_group_dict={}
@@ -13,6 +254,12 @@ def parse_fastqjoin_group_dict(file_group_rows):
     return file_group_dict
 
 
+def output_name(fastqjoin_path):
+    if fastqjoin_path.parent != Path('.'):
+        return f'{fastqjoin_path.parent.name}.{fastqjoin_path.name}'
+    return fastqjoin_path.name
+
+
 def gen_input_fastqjoins(input_cells, group_dict):
     for val in input_cells:
         if val in group_dict:
@@ -23,27 +270,166 @@ def gen_input_fastqjoins(input_cells, group_dict):
             yield input_file
 
             
-@asyncio.coroutine
-def run_async_command(cmd):
-    tmp=cmd.split()
-    exe, args = tmp[0], tmp[1:]
-    p = yield from asyncio.create_subprocess_exec(exe, *args,
-            stdin=PIPE, stdout=PIPE, stderr=STDOUT, cwd="./")
-    return (yield from p.communicate())[0].splitlines()
+class CommandResult(NamedTuple):
+    name: str
+    cmd: str
+    exit_code: int  # None if the last attempt timed out
+    attempts: int
+    seconds: float
+    log: Path
+
+
+def available_memory_mb():
+    """MemAvailable of /proc/meminfo in MiB; None where it is not available."""
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def memory_short(min_free_memory_mb):
+    """Whether less than min_free_memory_mb is available; False if unknown."""
+    available = available_memory_mb()
+    return available is not None and available < min_free_memory_mb
+
+
+def input_commands(template, input_files):
+    """{name: command} of template formatted with each of input_files (e.g. of
+    gen_input_fastqjoins) as {input}, named as the outputs of the file."""
+    input_files = list(input_files)
+    cmds = {output_name(Path(x)): template.format(input=x) for x in input_files}
+    if len(cmds) < len(input_files):
+        raise ValueError("Input files with the same output name")
+    return cmds
+
+
+async def run_logged_command(cmd, log_path, timeout=None):
+    """Run cmd with its stdout and stderr appended to log_path; returns its
+    exit code, or None if it ran over timeout seconds and was killed."""
+    with open(log_path, 'ab') as log:
+        log.write(f'$ {cmd}\n'.encode())
+        log.flush()
+        try:
+            p = await asyncio.create_subprocess_exec(*shlex.split(cmd), stdin=DEVNULL, stdout=log, stderr=STDOUT)
+        except OSError as e:
+            log.write(f'{type(e).__name__}: {e}\n'.encode())
+            return 127
+        try:
+            return await asyncio.wait_for(p.wait(), timeout)
+        except asyncio.TimeoutError:
+            log.write(f'Killed after {timeout} s\n'.encode())
+            return None
+        finally:
+            if p.returncode is None:
+                p.kill()
+                await p.wait()
+
+
+class JobProgress:
+    """Counts of the jobs of a run of run_async_commands, and its progress line."""
+    def __init__(self, total):
+        self.total = total
+        self.running = 0
+        self.done = 0
+        self.failed = 0
+        self.t0 = time.perf_counter()
+
+    def line(self):
+        finished = self.done + self.failed
+        minutes = (time.perf_counter() - self.t0) / 60
+        rate = finished / minutes if minutes > 0 else 0.0
+        eta = f'{(self.total - finished) / rate:.1f} min' if rate > 0 else '-'
+        return (f"{finished}/{self.total} jobs finished ({self.failed} failed), {self.running} running; "
+                f"{rate:.1f} jobs/min, ETA {eta}")
+
+
+async def run_scheduled_commands(cmds, max_jobs, timeout, retries, log_dir, min_free_memory_mb, poll_seconds,
+                                 settle_seconds):
+    semaphore = asyncio.Semaphore(max_jobs)
+    admission = asyncio.Lock()
+    progress = JobProgress(len(cmds))
+    log_dir = Path(log_dir)
+    log_dir.mkdir(parents=True, exist_ok=True)
+    loop = asyncio.get_running_loop()
+    settled_at = 0.0
+
+    async def admit():
+        # Jobs waiting for memory are admitted in order, polling every
+        # poll_seconds; with none running, a job starts whatever the free memory.
+        # The memory of a job shows only once it has loaded its input, so the
+        # next one is checked settle_seconds after it started at the earliest.
+        nonlocal settled_at
+        async with admission:
+            if progress.running > 0:
+                await asyncio.sleep(max(0.0, settled_at - loop.time()))
+            while progress.running > 0 and memory_short(min_free_memory_mb):
+                await asyncio.sleep(poll_seconds)
+            progress.running += 1
+            settled_at = loop.time() + settle_seconds
+
+    async def run(name, cmd):
+        log_path = log_dir / f'{name}.log'
+        log_path.write_bytes(b'')
+        async with semaphore:
+            if min_free_memory_mb is not None:
+                await admit()
+            else:
+                progress.running += 1
+            t = time.perf_counter()
+            try:
+                for attempt in range(1, retries + 2):
+                    exit_code = await run_logged_command(cmd, log_path, timeout)
+                    if exit_code == 0:
+                        break
+                    if attempt <= retries:
+                        logger.warning(f"{name}: {'timed out' if exit_code is None else f'exit code {exit_code}'}; "
+                                       f"retry {attempt} of {retries}.")
+            finally:
+                progress.running -= 1
+        if exit_code == 0:
+            progress.done += 1
+        else:
+            progress.failed += 1
+            logger.error(f"{name}: {'timed out' if exit_code is None else f'exit code {exit_code}'}; see {log_path}")
+        logger.info(progress.line())
+        return CommandResult(name, cmd, exit_code, attempt, round(time.perf_counter() - t, 3), log_path)
+
+    return await asyncio.gather(*(run(name, cmd) for name, cmd in cmds.items()))
 
 
 def get_async_eventloop():
-    if sys.platform.startswith('win'):
-        loop = asyncio.ProactorEventLoop() # for subprocess' pipes on Windows
-        asyncio.set_event_loop(loop)
-    else:
-        loop = asyncio.get_event_loop()
-    
+    # new event loops are ProactorEventLoops on Windows, for subprocess' pipes
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
     return loop
 
 
-def run_async_commands(loop, cmds):
-    coros=[run_async_command(cmd) for cmd in cmds]
-        
-    outputs = loop.run_until_complete(asyncio.gather(*coros))
+def run_async_commands(loop, cmds, max_jobs=None, timeout=None, retries=0, log_dir='logs',
+                       min_free_memory_mb=None, poll_seconds=1.0, settle_seconds=5.0):
+    """Run commands as subprocesses, at most max_jobs (the CPU count by
+    default) at a time, and return a CommandResult per command in order.
 
+    cmds is a list of command lines, or a {name: command} dict such as
+    input_commands gives. The stdout and stderr of each go to <log_dir>/<name>.log.
+    A command is killed after timeout seconds, if given, and run again up to
+    retries times while it fails. With min_free_memory_mb, a command starts
+    only while that much memory is available, checked every poll_seconds
+    while it waits and no sooner than settle_seconds after the previous one
+    started. A progress line is logged as each command finishes.
+    """
+    if not isinstance(cmds, dict):
+        cmds = list(cmds)
+        cmds = {f'job{i:0{len(str(len(cmds)))}d}': cmd for i, cmd in enumerate(cmds, 1)}
+    max_jobs = max_jobs or os.cpu_count() or 1
+    task = loop.create_task(run_scheduled_commands(cmds, max_jobs, timeout, retries, log_dir,
+                                                   min_free_memory_mb, poll_seconds, settle_seconds))
+    try:
+        return loop.run_until_complete(task)
+    except KeyboardInterrupt:
+        task.cancel()  # kills the running commands
+        loop.run_until_complete(asyncio.gather(task, return_exceptions=True))
+        raise
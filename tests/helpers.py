@@ -0,0 +1,110 @@
+import gzip
+import os
+import shutil
+import subprocess
+import sys
+from pathlib import Path
+
+import Bio
+import pandas as pd
+
+from pea.util import TargetRegion, UserRegion
+
+
+DATA = Path(__file__).parent / 'data'
+BASELINE = DATA / 'baseline'
+REPO = Path(__file__).parents[1]
+
+# plate/1.fastqjoin and plate/2.fastqjoin are reads simulated from AMPLICON,
+# half of them reverse complemented and many repeated; the files in baseline
+# were written by the programs before they were optimized.
+AMPLICON = ('ccctggtcaacctcaacctaggcctcctatttattctagccacctctagcctagccgtttactcaatcctctgatcagggtgagcatcaaactcaaac'
+            'tacgccctgatcggcgcactgcgagcagtagcccaaacaatctcatatgaagtcaccctagccatcattctactatcaacattactaataagtggctcc'
+            'tttaacctctccaccctt')
+TARGET_SEQ = 'actcaatcctctgatc'
+READ_FILES = ['1.fastqjoin', '2.fastqjoin']
+# the baseline was written with biopython 1.79; later aligners place some gaps
+# differently between equally scored alignments
+BASELINE_ALIGNER = tuple(map(int, Bio.__version__.split('.')[:2])) < (1, 80)
+
+PROGRAM_RUNS = {
+    'o1': ['pea.align_mutations', '--user_region_length', '60', '--user_region_beg_offset', '30'],
+    'o2': ['pea.align_mutations', '--noindel_in_alignment', '--user_region_length', '40',
+           '--user_region_beg_offset', '10'],
+    'p1': ['pea.prime_editor', '--user_region_length', '20', '--user_region_beg_offset', '6'],
+}
+PROGRAM_TARGETS = {
+    'o1': {'amplicon_seq': f'aseq1:{AMPLICON}', 'target_seq': f'site1:{TARGET_SEQ}'},
+    'o2': {'amplicon_seq': f'aseq1:{AMPLICON}', 'target_seq': f'site1:{TARGET_SEQ}'},
+    'p1': {'amplicon_seq': f'aseq1:{AMPLICON}', 'target_seq': f'trg1:{TARGET_SEQ}',
+           'user_target_mutation': 'mut1:CCTCTGATCAGGGTGAGCAT'},
+}
+PROGRAM_OUTPUTS = {
+    'o1': ['aseq1.site1.align_mutations.o1.align.csv'],
+    'o2': ['aseq1.site1.align_mutations.o2.align.csv'],
+    'p1': ['aseq1.trg1.mut1.prime_editor.p1.count.csv', 'aseq1.trg1.mut1.prime_editor.p1.summary.txt'],
+}
+
+
+def mutated(ref, n_edits, rng):
+    """ref with n_edits random substitutions, insertions and deletions."""
+    query = list(ref)
+    for _ in range(n_edits):
+        pos = rng.integers(len(query))
+        edit = rng.integers(3)
+        if edit == 0:
+            query[pos] = 'ACGT'[rng.integers(4)]
+        elif edit == 1:
+            query.insert(pos, 'ACGT'[rng.integers(4)])
+        else:
+            del query[pos]
+    return ''.join(query)
+
+
+def target_region():
+    tr = TargetRegion.build(AMPLICON.upper(), TARGET_SEQ.upper(), 60, 3)
+    return tr, UserRegion.build(tr.pam_beg, 30, 60)
+
+
+def copy_reads(path):
+    """Decompress the test reads into path/plate."""
+    (path / 'plate').mkdir()
+    for name in READ_FILES:
+        with gzip.open(DATA / 'plate' / f'{name}.gz', 'rb') as f, open(path / 'plate' / name, 'wb') as g:
+            shutil.copyfileobj(f, g)
+    return path / 'plate'
+
+
+def run(cwd, module, *args, check=True):
+    """Run a pea program as a separate process, since the absl flags of the
+    programs can't share one."""
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([str(REPO), os.environ.get('PYTHONPATH', '')]))
+    process = subprocess.run([sys.executable, '-m', module, *args], cwd=cwd, env=env,
+                             capture_output=True, text=True)
+    assert process.returncode == 0 or not check, process.stderr
+    return process
+
+
+def target_flags(tag):
+    return [x for name, value in PROGRAM_TARGETS[tag].items() for x in [f'--{name}', value]]
+
+
+def run_program(cwd, tag, *args):
+    module, *flags = PROGRAM_RUNS[tag]
+    return run(cwd, module, *flags, *target_flags(tag), '--output_nametag', tag, *args)
+
+
+def read_output(path, sep=','):
+    """Output table with its rows sorted, so that the order of ties doesn't
+    matter."""
+    if path.name.endswith('summary.txt'):
+        # the fields of the summary line are compared, not its extra ones
+        df = pd.read_csv(path, sep='\t', header=None, keep_default_na=False).iloc[:, :13]
+    else:
+        df = pd.read_csv(path, sep=sep, keep_default_na=False)
+    return df.sort_values(list(df.columns)).reset_index(drop=True)
+
+
+def assert_same_output(path, expected_path, sep=','):
+    pd.testing.assert_frame_equal(read_output(path, sep), read_output(expected_path, sep),
+                                  check_dtype=False, check_like=True)
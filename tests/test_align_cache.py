@@ -0,0 +1,42 @@
+import numpy as np
+
+from helpers import mutated, target_region
+from pea.align_cache import AlignmentCache
+from pea.util import align_queries, user_region_alignment, user_region_query
+
+
+def test_cached_alignments_equal_aligned(tmp_path):
+    tr, ur = target_region()
+    rng = np.random.default_rng(0)
+    queries = list(dict.fromkeys(mutated(tr.comparison_region(), n, rng) for n in range(4) for _ in range(20)))[:40]
+    path = tmp_path / 'alignments.sqlite'
+    # without the ungapped fast path every miss is aligned and stored
+    for result in [user_region_query, user_region_alignment]:
+        expected = align_queries(result, queries, tr, ur)
+        cache = AlignmentCache(path)
+        assert align_queries(result, queries, tr, ur, cache=cache, max_mismatches=-1) == expected
+        assert (cache.hits, cache.misses) == (0, 40)
+        assert align_queries(result, queries, tr, ur, cache=cache, max_mismatches=-1) == expected
+        assert (cache.hits, cache.misses) == (40, 40)
+        cache.close()
+
+        # the cache outlives the run; other scores are other keys
+        cache = AlignmentCache(path)
+        new = mutated(tr.comparison_region(), 10, rng)
+        assert (align_queries(result, queries[:5] + [new], tr, ur, cache=cache, max_mismatches=-1) ==
+                expected[:5] + align_queries(result, [new], tr, ur))
+        assert (cache.hits, cache.misses) == (5, 1)
+        align_queries(result, queries[:5], tr, ur, open_gap_score=-20, cache=cache, max_mismatches=-1)
+        assert (cache.hits, cache.misses) == (5, 6)
+        cache.close()
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = AlignmentCache(tmp_path / 'alignments.sqlite', max_entries=3)
+    for key in 'abc':
+        cache.put_many([(key, key.upper())])
+    assert cache.get_many(['a']) == {'a': 'A'}
+    cache.put_many([('d', 'D')])
+    assert cache.get_many(list('abcd')) == {'a': 'A', 'c': 'C', 'd': 'D'}
+    assert (cache.hits, cache.misses) == (4, 1)
+    cache.close()
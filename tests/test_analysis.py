@@ -0,0 +1,57 @@
+from collections import Counter
+
+import numpy as np
+import pytest
+
+from helpers import mutated, target_region
+from pea.analysis import count_query_seqs
+from pea.util import IndicatorLocator, matchUpto1, revertedSeq
+
+
+def two_strand_query_seqs(reads, idc_l, idc_r, last_right_indicator):
+    """The query sequences the programs took from every read and its reverse
+    complement before reads were collapsed."""
+    seq_lines = reads + [revertedSeq(x) for x in reads]
+    left = [matchUpto1(idc_l, x) for x in seq_lines]
+    if last_right_indicator:
+        right = [matchUpto1(idc_r, x, reverse=True) for x in seq_lines]
+        return Counter(x[b:e + len(idc_r)] for x, b, e in zip(seq_lines, left, right) if 0 <= b < e)
+    right = [matchUpto1(idc_r, x) + len(idc_r) for x in seq_lines]
+    return Counter(x[b:e] for x, b, e in zip(seq_lines, left, right) if 0 < b < e)
+
+
+@pytest.mark.parametrize('method', ['vectorized', 'legacy'])
+@pytest.mark.parametrize('last_right_indicator', [True, False])
+def test_query_seqs_equal_two_strand_search(last_right_indicator, method):
+    tr, _ = target_region()
+    idc_l, idc_r = tr.left_indicator_seq(15), tr.right_indicator_seq(15)
+    amplicon = tr.aseq[tr.cmp_beg - 10:tr.cmp_end + 10]
+    rng = np.random.default_rng(0)
+    reads = []
+    for n in range(4):
+        for _ in range(50):
+            read = mutated(amplicon, n, rng)
+            reads.append(read if rng.integers(2) else revertedSeq(read))
+    # a spurious forward left indicator on a reverse read, with or without a
+    # right one after it, and a query on each strand
+    spurious = [revertedSeq(amplicon)[:40] + idc_l + revertedSeq(amplicon)[40:],
+                'A' + idc_l + 'GATTACA' + revertedSeq(amplicon),
+                'A' + idc_l + 'GATTACA' + idc_r + revertedSeq(amplicon)]
+    both = amplicon + revertedSeq(amplicon)
+    for read in spurious:
+        assert two_strand_query_seqs([read], idc_l, idc_r, last_right_indicator)
+    assert sum(two_strand_query_seqs([both], idc_l, idc_r, last_right_indicator).values()) == 2
+    reads += spurious + [
+        both,
+        amplicon[:60] + revertedSeq(amplicon),
+        # short right indicator distances, for the end of a missing right one
+        'A' + idc_l + 'CC', 'AAAAA' + idc_l[:5],
+        revertedSeq(amplicon)[:30], 'ACGT' * 10,
+    ]
+    reads = reads + reads[::7]
+    expected = two_strand_query_seqs(reads, idc_l, idc_r, last_right_indicator)
+
+    query_seq_counts, n_unoriented = count_query_seqs(Counter(reads), idc_l, idc_r, IndicatorLocator(method),
+                                                      last_right_indicator)
+    assert query_seq_counts == expected
+    assert n_unoriented == sum(matchUpto1(idc_l, x) < 0 and matchUpto1(idc_l, revertedSeq(x)) < 0 for x in reads)
@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+from helpers import target_region
+from pea.banded import BandedAligner
+from pea.util import get_aligner, alignment_coordinates, align_queries
+from pea.util import user_region_alignment
+
+
+def mutated_queries(ref, n, seed=0):
+    """Queries of ref with up to 3 substitutions and insertions or deletions
+    of 1 to 8 bases, also at the ends."""
+    rng = np.random.default_rng(seed)
+    queries = [ref]
+    for _ in range(n):
+        query = list(ref)
+        for _ in range(rng.integers(0, 4)):
+            query[rng.integers(len(query))] = 'ACGT'[rng.integers(4)]
+        for _ in range(rng.integers(0, 3)):
+            pos, length = rng.integers(len(query) + 1), rng.integers(1, 9)
+            if rng.random() < 0.5:
+                del query[pos:pos + length]
+            else:
+                query[pos:pos] = rng.choice(list('ACGT'), length)
+        queries.append(''.join(query))
+    return queries
+
+
+@pytest.mark.parametrize('open_gap_score', [-2.01, -20])
+@pytest.mark.parametrize('margin', [1, 3])
+def test_banded_alignment_equals_pairwise_aligner(open_gap_score, margin):
+    aligner = get_aligner(open_gap_score)
+    ref = target_region()[0].comparison_region()
+    queries = mutated_queries(ref, 300)
+    paths = BandedAligner(aligner, margin).align_many(ref, queries)
+    n_banded = 0
+    for query, path in zip(queries, paths):
+        if path is not None:
+            assert np.array_equal(path, alignment_coordinates(aligner.align(ref, query)[0])), query
+            n_banded += 1
+    # indels longer than the margin leave the band and go to the full aligner
+    assert 0 < n_banded < len(queries)
+
+
+@pytest.mark.parametrize('open_gap_score', [-2.01, -20])
+def test_align_queries_with_band_equals_without(open_gap_score):
+    tr, ur = target_region()
+    queries = mutated_queries(tr.comparison_region(), 200, seed=1)
+    assert align_queries(user_region_alignment, queries, tr, ur, open_gap_score, max_mismatches=-1, band_margin=2) == \
+        align_queries(user_region_alignment, queries, tr, ur, open_gap_score, max_mismatches=-1)
@@ -0,0 +1,71 @@
+import pytest
+
+from helpers import AMPLICON, BASELINE, PROGRAM_OUTPUTS, PROGRAM_RUNS, PROGRAM_TARGETS, READ_FILES
+from helpers import assert_same_output, copy_reads, run, run_program, target_flags
+
+
+def run_batch(cwd, tag, *args):
+    module, *flags = PROGRAM_RUNS[tag]
+    return run(cwd, 'pea.batch', '--program', module.split('.')[1], *flags, '--output_nametag', tag, *args)
+
+
+def assert_outputs_equal_baseline(path, tag):
+    for name in READ_FILES:
+        for output in PROGRAM_OUTPUTS[tag]:
+            output = f'plate.{name}.{output}'
+            assert_same_output(path / output, BASELINE / output)
+
+
+@pytest.mark.parametrize('tag', ['o1', 'p1'])
+def test_batch_outputs_equal_baseline(tmp_path, tag):
+    copy_reads(tmp_path)
+    (tmp_path / 'samples.csv').write_text('key,data_dir,range\nplate,plate,1~2\n')
+    run_batch(tmp_path, tag, *target_flags(tag), '--sample_sheet', 'samples.csv', '--sample', 'plate', '--jobs', '2')
+    assert_outputs_equal_baseline(tmp_path, tag)
+
+
+@pytest.mark.parametrize('tag', ['o1', 'p1'])
+def test_demultiplexed_outputs_equal_baseline(tmp_path, tag):
+    copy_reads(tmp_path)
+    # a second target of the pool, further along the amplicon
+    targets = PROGRAM_TARGETS[tag]
+    other_target = {'amplicon_seq': f'aseq2:{AMPLICON}', 'target_seq': f'trg2:{AMPLICON[130:146]}',
+                    'user_target_mutation': f'mut2:{AMPLICON[135:155].upper()}'}
+    (tmp_path / 'targets.csv').write_text(
+        ','.join(targets) + '\n' + ','.join(targets.values()) + '\n' +
+        ','.join(other_target[name] for name in targets) + '\n')
+    run_batch(tmp_path, tag, '--targets', 'targets.csv', '--sample', 'plate/1.fastqjoin', '--sample', 'plate/2.fastqjoin')
+    assert_outputs_equal_baseline(tmp_path, tag)
+
+
+def test_resume_skips_current_runs(tmp_path):
+    copy_reads(tmp_path)
+    args = [*target_flags('p1'), '--sample', 'plate/1.fastqjoin', '--sample', 'plate/2.fastqjoin', '--resume']
+    skipped = 'skip 1 of 1 targets, which are up to date'
+    assert skipped not in run_batch(tmp_path, 'p1', *args).stderr
+    assert run_batch(tmp_path, 'p1', *args).stderr.count(skipped) == 2
+    assert_outputs_equal_baseline(tmp_path, 'p1')
+
+    # a changed output, or other parameters, are run again
+    (tmp_path / f'plate.1.fastqjoin.{PROGRAM_OUTPUTS["p1"][1]}').write_text('')
+    assert run_batch(tmp_path, 'p1', *args).stderr.count(skipped) == 1
+    assert_outputs_equal_baseline(tmp_path, 'p1')
+    assert skipped not in run_batch(tmp_path, 'p1', *args, '--indicator_seq_length', '14').stderr
+
+
+def test_demultiplexed_prefilter_equals_standalone_runs(tmp_path):
+    plate = copy_reads(tmp_path)
+    # reads longer than the amplicon that hold no target, which a run of the
+    # target on its own rejects by length rather than leaving out
+    with open(plate / '1.fastqjoin', 'a') as f:
+        f.writelines(f'@long{i}\n{"ACGT" * 60}\n+\n{"I" * 240}\n' for i in range(5))
+    targets = PROGRAM_TARGETS['p1']
+    (tmp_path / 'targets.csv').write_text(
+        ','.join(targets) + '\n' + ','.join(targets.values()) + '\n' +
+        f'aseq2:{AMPLICON},trg2:{AMPLICON[130:146]},mut2:{AMPLICON[135:155].upper()}\n')
+    prefilter = ['--read_length_margin', '0', '--max_n', '0']
+    outputs = [tmp_path / f'plate.1.fastqjoin.{x}' for x in PROGRAM_OUTPUTS['p1']]
+    run_program(tmp_path, 'p1', '--input', 'plate/1.fastqjoin', *prefilter)
+    expected = [x.read_text() for x in outputs]
+    run_batch(tmp_path, 'p1', '--targets', 'targets.csv', '--sample', 'plate/1.fastqjoin', *prefilter)
+    assert [x.read_text() for x in outputs] == expected
@@ -0,0 +1,43 @@
+import shutil
+
+import pytest
+
+from helpers import BASELINE, assert_same_output, run
+
+
+BE_STATS_RUNS = {
+    'be_stats': ['--be_mut', 'AtoG', '--be_mut', 'CtoT', '--nonX_mut', 'C', '--nonX_mut', 'G'],
+    'be_stats_with_indels': ['--noexclude_indel_reads', '--be_mut', 'AtoG', '--nonX_mut', 'A'],
+}
+SUMMARIES = ['summary.base_editing.csv', 'summary.be_overall.csv', 'summary.mutations.csv',
+             'summary.nonX_per_pos.mutations.csv']
+
+
+@pytest.mark.parametrize('jobs', [1, 3])
+@pytest.mark.parametrize('name', list(BE_STATS_RUNS))
+def test_summaries_equal_baseline(tmp_path, name, jobs):
+    for path in BASELINE.glob('*.align.csv'):
+        shutil.copy(path, tmp_path)
+    run(tmp_path, 'pea.be_stats', *BE_STATS_RUNS[name], '--jobs', str(jobs), '--raw_output', 'all_mutation_raw.csv')
+    for summary in SUMMARIES:
+        assert (tmp_path / summary).read_bytes() == (BASELINE / name / summary).read_bytes()
+    # the raw reads are appended as the files are done
+    assert_same_output(tmp_path / 'all_mutation_raw.csv', BASELINE / name / 'all_mutation_raw.csv')
+
+
+def test_stats_cache_keeps_summaries(tmp_path):
+    for path in BASELINE.glob('*.align.csv'):
+        shutil.copy(path, tmp_path)
+    name = 'be_stats'
+    for _ in range(2):
+        run(tmp_path, 'pea.be_stats', *BE_STATS_RUNS[name], '--stats_cache', 'stats.pickle')
+        for summary in SUMMARIES:
+            assert (tmp_path / summary).read_bytes() == (BASELINE / name / summary).read_bytes()
+    # stats of other options, or of a changed file, are not reused
+    run(tmp_path, 'pea.be_stats', *BE_STATS_RUNS['be_stats_with_indels'], '--stats_cache', 'stats.pickle')
+    for summary in SUMMARIES:
+        assert (tmp_path / summary).read_bytes() == (BASELINE / 'be_stats_with_indels' / summary).read_bytes()
+    changed = tmp_path / 'plate.1.fastqjoin.aseq1.site1.align_mutations.o1.align.csv'
+    changed.write_text(changed.read_text().replace(',270,', ',271,'))
+    run(tmp_path, 'pea.be_stats', *BE_STATS_RUNS[name], '--stats_cache', 'stats.pickle')
+    assert (tmp_path / 'summary.be_overall.csv').read_bytes() != (BASELINE / name / 'summary.be_overall.csv').read_bytes()
@@ -0,0 +1,40 @@
+import json
+
+import numpy as np
+
+from benchmarks.synthetic import EXAMPLE_AMPLICON, EXAMPLE_TARGET, Library, write_fastqjoin
+from helpers import run
+from pea.util import revertedSeq
+from pea.util_io import iter_fastq
+
+
+def test_library_reads(tmp_path):
+    library = Library(EXAMPLE_AMPLICON, EXAMPLE_TARGET, diversity=2000, prime_edit_rate=0.2, seed=1)
+    reads = list(library.reads(5000, reverse_fraction=0.3, chunk_size=1000))
+    assert reads == list(Library(EXAMPLE_AMPLICON, EXAMPLE_TARGET, diversity=2000, prime_edit_rate=0.2,
+                                 seed=1).reads(5000, reverse_fraction=0.3, chunk_size=1000))
+    molecules = set(library.molecules)
+    forward = np.array([x in molecules for x in reads])
+    assert all(revertedSeq(x) in molecules for x, f in zip(reads, forward) if not f)
+    assert 0.25 < 1 - forward.mean() < 0.35
+    edited = np.mean([library.edited_seq[70:100] in x for x in library.molecules])
+    assert 0.15 < edited < 0.25
+    assert library.aseq[70:100] != library.edited_seq[70:100]
+
+    write_fastqjoin(tmp_path / 'synthetic.fastqjoin', reads, chunk_size=999)
+    assert list(iter_fastq(tmp_path / 'synthetic.fastqjoin')) == reads
+
+
+def test_run_compares_with_baseline(tmp_path):
+    args = ['--n_reads', '2000', '--diversity', '200', '--repeats', '1']
+    run(tmp_path, 'benchmarks.run', *args, '--results', 'baseline.json')
+    results = json.loads((tmp_path / 'baseline.json').read_text())
+    assert results['counts']['reads'] == 2000
+    assert {'read', 'locate_indicators', 'align_read_to_user_region', 'be_stats'} <= set(results['stages'])
+
+    for stage in results['stages'].values():
+        stage['seconds'] /= 1000
+    (tmp_path / 'fast.json').write_text(json.dumps(results))
+    process = run(tmp_path, 'benchmarks.run', *args, '--baseline', 'fast.json', check=False)
+    assert process.returncode == 1
+    assert 'Slower than the baseline' in process.stderr
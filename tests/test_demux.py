@@ -0,0 +1,39 @@
+from collections import Counter
+
+import numpy as np
+
+from helpers import mutated
+from pea.demux import demultiplex
+from pea.util import locate_indicators, revertedSeq
+
+
+def test_demultiplex_assigns_every_read_holding_an_indicator():
+    rng = np.random.default_rng(0)
+    amplicons = [''.join(rng.choice(list('ACGT'), 120)) for _ in range(5)]
+    indicators = [amplicon[20:35] for amplicon in amplicons]
+    reads = []
+    for amplicon in amplicons:
+        for n in range(4):
+            for _ in range(30):
+                read = mutated(amplicon[rng.integers(0, 20):], n, rng)
+                reads.append(read if rng.integers(2) else revertedSeq(read))
+    # indicators cut at either read end, and reads of no amplicon
+    reads += [amplicons[0][21:60], amplicons[1][22:60], amplicons[2][:34], amplicons[3][:33], 'ACGT' * 20, 'N' * 30]
+    read_counts = Counter(reads)
+
+    per_target, n_unassigned = demultiplex(read_counts, indicators)
+
+    def holds(idc, read):
+        return locate_indicators(idc, [read])[0] >= 0 or locate_indicators(idc, [revertedSeq(read)])[0] >= 0
+
+    def holds_overhanging(idc, read):
+        # an indicator may hang one base over either end of either strand
+        return holds(idc, f'N{read}N')
+
+    for idc, counts in zip(indicators, per_target):
+        assert counts == {x: n for x, n in read_counts.items() if holds_overhanging(idc, x)}
+        # so every read a standalone run would orient is kept
+        assert all(counts[x] == n for x, n in read_counts.items() if holds(idc, x))
+    assert n_unassigned == sum(n for x, n in read_counts.items()
+                               if not any(holds_overhanging(idc, x) for idc in indicators))
+    assert 0 < n_unassigned < len(reads) // 4
@@ -0,0 +1,38 @@
+import os
+
+from pea.manifest import is_current, write_manifest
+
+
+def test_is_current_round_trip(tmp_path):
+    inputs = [tmp_path / 'reads.fastqjoin']
+    outputs = [tmp_path / 'out.align.csv']
+    inputs[0].write_text('@r\nACGT\n+\nIIII\n')
+    outputs[0].write_text('read,n_reads\nACGT,1\n')
+    prefix = tmp_path / 'out'
+    parameters = {'program': 'align_mutations', 'options': {'user_region_length': 30}}
+
+    assert not is_current(prefix, parameters, inputs)
+    write_manifest(prefix, parameters, inputs, outputs)
+    assert is_current(prefix, parameters, inputs)
+    assert not is_current(prefix, {**parameters, 'options': {'user_region_length': 40}}, inputs)
+    assert not is_current(prefix, parameters, [tmp_path / 'other.fastqjoin'])
+
+    # a touched input is changed, unless its hash shows the same content
+    os.utime(inputs[0], ns=(0, 0))
+    assert not is_current(prefix, parameters, inputs)
+    write_manifest(prefix, parameters, inputs, outputs, hash_inputs=True)
+    os.utime(inputs[0], ns=(1, 1))
+    assert is_current(prefix, parameters, inputs)
+    inputs[0].write_text('@r\nACGA\n+\nIIII\n')
+    assert not is_current(prefix, parameters, inputs)
+
+    write_manifest(prefix, parameters, inputs, outputs)
+    outputs[0].write_text('read,n_reads\nACGT,2\n')
+    os.utime(outputs[0], ns=(0, 0))
+    assert not is_current(prefix, parameters, inputs)
+    write_manifest(prefix, parameters, inputs, outputs)
+    outputs[0].unlink()
+    assert not is_current(prefix, parameters, inputs)
+
+    (tmp_path / 'out.manifest.json').write_text('{')
+    assert not is_current(prefix, parameters, inputs)
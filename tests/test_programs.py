@@ -0,0 +1,61 @@
+import json
+from collections import Counter
+
+import pytest
+
+from helpers import BASELINE, BASELINE_ALIGNER, PROGRAM_OUTPUTS, READ_FILES, assert_same_output, copy_reads, run_program
+
+
+@pytest.mark.parametrize('tag', ['o1', pytest.param('o2', marks=pytest.mark.skipif(
+    not BASELINE_ALIGNER, reason="gaps of the baseline placed by biopython 1.79")), 'p1'])
+def test_outputs_equal_baseline(tmp_path, tag):
+    plate = copy_reads(tmp_path)
+    seqs = (plate / READ_FILES[0]).read_text().splitlines()[1::4]
+    # repeated reads, and reads repeated as their reverse complement, are
+    # collapsed before they are searched
+    assert Counter(seqs).most_common(1)[0][1] > 10
+    for name in READ_FILES:
+        run_program(tmp_path, tag, '--input', f'plate/{name}')
+        for output in PROGRAM_OUTPUTS[tag]:
+            output = f'plate.{name}.{output}'
+            assert_same_output(tmp_path / output, BASELINE / output)
+
+
+@pytest.mark.parametrize('tag', ['o1', 'p1'])
+def test_workers_outputs_equal_baseline(tmp_path, tag):
+    copy_reads(tmp_path)
+    run_program(tmp_path, tag, '--input', f'plate/{READ_FILES[0]}', '--workers', '3')
+    for output in PROGRAM_OUTPUTS[tag]:
+        output = f'plate.{READ_FILES[0]}.{output}'
+        assert_same_output(tmp_path / output, BASELINE / output)
+
+
+def test_prefiltered_reads_are_left_out(tmp_path):
+    plate = copy_reads(tmp_path)
+    lines = (plate / READ_FILES[0]).read_text().splitlines()
+    records = list(zip(lines[1::4], lines[3::4]))
+    rejected = [x.count('N') > 0 or sum(ord(c) - 33 for c in q) < 20 * len(q) for x, q in records]
+    assert 0 < sum(rejected) < len(records) // 2
+    with open(plate / 'kept.fastqjoin', 'w') as f:
+        f.writelines(f'@r{i}\n{x}\n+\n{q}\n' for i, ((x, q), r) in enumerate(zip(records, rejected)) if not r)
+
+    run_program(tmp_path, 'p1', '--input', f'plate/{READ_FILES[0]}', '--max_n', '0', '--min_mean_quality', '20')
+    run_program(tmp_path, 'p1', '--input', 'plate/kept.fastqjoin')
+    prefix, kept_prefix = f'plate.{READ_FILES[0]}', 'plate.kept.fastqjoin'
+    count, summary = PROGRAM_OUTPUTS['p1']
+    assert_same_output(tmp_path / f'{prefix}.{count}', tmp_path / f'{kept_prefix}.{count}')
+    fields = (tmp_path / f'{prefix}.{summary}').read_text().rstrip('\n').split('\t')
+    kept_fields = (tmp_path / f'{kept_prefix}.{summary}').read_text().rstrip('\n').split('\t')
+    # all reads are counted, the rejected ones by reason
+    assert fields[5:11] == kept_fields[5:11] and fields[13] == kept_fields[13]
+    assert int(fields[12]) == len(records) and int(kept_fields[12]) == len(records) - sum(rejected)
+    n_by_n = sum(x.count('N') > 0 for x, _ in records)
+    assert list(map(int, fields[14:])) == [n_by_n, 0, sum(rejected) - n_by_n, 0]
+
+
+def test_metrics_record_the_process_peak_rss(tmp_path):
+    copy_reads(tmp_path)
+    run_program(tmp_path, 'p1', '--input', f'plate/{READ_FILES[0]}', '--metrics')
+    metrics = json.loads((tmp_path / f'plate.{READ_FILES[0]}.aseq1.trg1.mut1.prime_editor.p1.metrics.json').read_text())
+    peaks = [stage['process_peak_rss_mb'] for stage in metrics['stages'].values()]
+    assert peaks == sorted(peaks) and peaks[-1] <= metrics['peak_rss_mb']
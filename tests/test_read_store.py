@@ -0,0 +1,68 @@
+from collections import Counter
+
+import numpy as np
+import pytest
+
+import pea.read_store as read_store
+from pea.read_store import ReadStore, MAX_PACKED_LENGTH
+from pea.util_io import iter_fastq, ReadFilter
+
+
+def write_fastq(path, reads):
+    with open(path, 'w') as f:
+        for i, read in enumerate(reads):
+            f.write(f'@r{i}\n{read}\n+\n{"I" * len(read)}\n')
+
+
+def random_reads(n_distinct, n_reads, seed=0):
+    """Reads of 1 to 40 bases, some with N, one of each of the escaped kinds,
+    drawn with repeats from n_distinct sequences."""
+    rng = np.random.default_rng(seed)
+    distinct = [''.join(rng.choice(list('ACGTN'), rng.integers(1, 41), p=[.3, .3, .2, .19, .01]))
+                for _ in range(n_distinct)]
+    distinct += ['ACGTN', 'NNNN', 'A' * (MAX_PACKED_LENGTH + 1)]
+    return [distinct[i] for i in rng.integers(0, len(distinct), n_reads)]
+
+
+def assert_same_as_counter(path, read_filter=None):
+    rejected = Counter()
+    expected = Counter(iter_fastq(path, read_filter=read_filter, rejected=rejected))
+    store_rejected = Counter()
+    store = ReadStore.from_fastq(path, read_filter, store_rejected)
+    assert list(store.items()) == list(expected.items())
+    assert len(store) == len(expected)
+    assert sum(store.values()) == sum(expected.values())
+    assert store_rejected == rejected
+
+
+def test_counts_reads_of_mixed_lengths_and_n(tmp_path):
+    path = tmp_path / 'reads.fastqjoin'
+    write_fastq(path, random_reads(500, 5000))
+    assert_same_as_counter(path)
+    assert_same_as_counter(path, ReadFilter(max_n=0, min_length=5))
+
+
+def assert_blocks_same_as_counter(reads, block_size):
+    store = ReadStore()
+    for beg in range(0, len(reads), block_size):
+        store.add([x.encode('ascii') for x in reads[beg:beg + block_size]])
+    expected = Counter(reads)
+    assert list(store.items()) == list(expected.items())
+    assert len(store) == len(expected)
+    return store
+
+
+def test_counts_across_resizes_and_index_merges(monkeypatch):
+    # small chunks: many chunks, counts grown and pending indexes merged
+    monkeypatch.setattr(read_store, 'CHUNK_ROWS', 50)
+    monkeypatch.setattr(read_store, 'PENDING_INDEXES', 2)
+    store = assert_blocks_same_as_counter(random_reads(2000, 6000, seed=1), 64)
+    assert len(store.chunks) > 1 and len(store.index[0]) > 0
+
+
+@pytest.mark.parametrize('n_hashes', [1, 4])
+def test_counts_with_hash_collisions(monkeypatch, n_hashes):
+    row_hashes = read_store.row_hashes
+    monkeypatch.setattr(read_store, 'row_hashes', lambda keys: row_hashes(keys) % np.uint64(n_hashes))
+    monkeypatch.setattr(read_store, 'PENDING_INDEXES', 2)
+    assert_blocks_same_as_counter(random_reads(300, 2000, seed=2), 256)
@@ -0,0 +1,95 @@
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+import pytest
+
+from helpers import PROGRAM_OUTPUTS, PROGRAM_RUNS, READ_FILES, REPO, copy_reads, target_flags
+from pea.client import request
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+@contextmanager
+def serving(cwd, *args):
+    """Port of a pea.serve server with one worker per program, run in cwd."""
+    port = free_port()
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([str(REPO), os.environ.get('PYTHONPATH', '')]))
+    process = subprocess.Popen([sys.executable, '-m', 'pea.serve', '--serve_port', str(port), '--serve_jobs', '1',
+                                *args], cwd=cwd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        for _ in range(100):
+            try:
+                request(port, '/status')
+                break
+            except OSError:
+                time.sleep(0.1)
+        yield port
+    finally:
+        process.send_signal(signal.SIGINT)
+        process.wait(timeout=30)
+
+
+def submit(port, cwd, tag):
+    module, *flags = PROGRAM_RUNS['p1']
+    args = [*flags, *target_flags('p1'), '--input', f'plate/{READ_FILES[0]}', '--output_nametag', tag]
+    return request(port, '/jobs', {'program': module.split('.')[1], 'args': args, 'cwd': str(cwd)})
+
+
+def wait_for_jobs(port, n_jobs):
+    """The number of running jobs of each status until n_jobs finished."""
+    running = []
+    while True:
+        status = request(port, '/status')
+        running.append(status['running'])
+        if status['done'] + status['failed'] == n_jobs:
+            return running
+        time.sleep(0.02)
+
+
+def test_jobs_run_once_a_worker_starts_them(tmp_path):
+    copy_reads(tmp_path)
+    with serving(tmp_path) as port:
+        jobs = [submit(port, tmp_path, f'p1_{i}') for i in range(4)]
+        assert [job['state'] for job in jobs].count('running') <= 1
+        # one worker runs one job at a time, though the pool hands it the next
+        assert max(wait_for_jobs(port, len(jobs))) == 1
+        for job in jobs:
+            job = request(port, f"/jobs/{job['id']}?wait=1")
+            assert job['state'] == 'done', job['error']
+            output = PROGRAM_OUTPUTS['p1'][0].replace('.p1.', f".{job['args'][-1]}.")
+            assert (tmp_path / f'plate.{READ_FILES[0]}.{output}').exists()
+
+
+def test_only_the_last_finished_jobs_are_kept(tmp_path):
+    with serving(tmp_path, '--serve_max_finished_jobs', '2') as port:
+        jobs = [request(port, '/jobs', {'program': 'prime_editor', 'args': ['--no_such_flag'], 'cwd': str(tmp_path)})
+                for _ in range(5)]
+        assert [job['id'] for job in jobs] == [1, 2, 3, 4, 5]
+        wait_for_jobs(port, len(jobs))
+        status = request(port, '/status')
+        assert (status['done'], status['failed'], status['queue_depth'], status['running']) == (0, 5, 0, 0)
+        assert [request(port, f'/jobs/{i}').get('state') for i in range(1, 6)] == [None] * 3 + ['failed'] * 2
+
+
+@pytest.mark.parametrize('headers, code', [({'Content-Type': 'text/plain'}, 415), ({}, 415),
+                                           ({'Content-Type': 'application/json', 'Origin': 'http://example.com'}, 403)])
+def test_jobs_are_posted_as_json_without_origin(tmp_path, headers, code):
+    body = json.dumps({'program': 'prime_editor', 'args': [], 'cwd': str(tmp_path)}).encode()
+    with serving(tmp_path) as port:
+        with pytest.raises(HTTPError) as e:
+            urlopen(Request(f'http://127.0.0.1:{port}/jobs', data=body, headers=headers))
+        assert e.value.code == code
+        status = request(port, '/status')
+        assert status['queue_depth'] == status['running'] == status['failed'] == 0
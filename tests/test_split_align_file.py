@@ -0,0 +1,20 @@
+import pandas as pd
+
+from pea.split_align_file import split_file
+
+
+def test_split_file_of_input_in_subdirectory(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'runs').mkdir()
+    (tmp_path / 'trimmed').mkdir()
+    pd.DataFrame({'ref': ['ACGTACGT', 'ACGTACGT', 'ACGTACGT'],
+                  'alignment': ['||||||||', '||.|||||', '||.|||||'],
+                  'read': ['ACGTACGT', 'ACTTACGT', 'ACATACGT'],
+                  'n_reads': [5, 2, 1],
+                  'ratio': [0.625, 0.25, 0.125]}).to_csv('runs/x.align.csv', index=False)
+
+    assert split_file('runs/x.align.csv', [3], 'trimmed', 1, 6) == (8, 3, 8, 3)
+    assert sorted(p.name for p in (tmp_path / 'trimmed').iterdir()) == \
+        ['G3A.x.align.csv', 'G3G.x.align.csv', 'G3T.x.align.csv']
+    df = pd.read_csv('trimmed/G3T.x.align.csv')
+    assert df.read.tolist() == ['CTTAC'] and df.n_reads.tolist() == [2]
@@ -0,0 +1,151 @@
+from collections import Counter
+
+import numpy as np
+import pytest
+
+from helpers import mutated, target_region
+from pea.util import align_queries, user_region_alignment, user_region_query, get_aligner
+from pea.util import alignment_coordinates, project_alignment, max_ungapped_mismatches, triage_ungapped
+from pea.util import matchUpto1, locate_indicators
+
+
+def substituted(ref, n_subs, rng):
+    query = list(ref)
+    for pos in rng.choice(len(ref), n_subs, replace=False):
+        query[pos] = rng.choice([b for b in 'ACGT' if b != ref[pos]])
+    return ''.join(query)
+
+
+def shifted(ref, n_mismatches, beg, end):
+    """Equal-length queries of ref with a base in [beg, end) deleted and a later
+    one duplicated, n_mismatches substitutions away from ref; a gapped
+    alignment of them has all but one base matched."""
+    queries = []
+    for p in range(beg, end):
+        for q in range(p + 1, end):
+            if sum(ref[i] != ref[i + 1] for i in range(p, q)) == n_mismatches:
+                queries.append(ref[:p] + ref[p + 1:q + 1] + ref[q] + ref[q + 1:])
+    return queries[:20]
+
+
+def test_align_queries_over_process_pool_keeps_order():
+    tr, ur = target_region()
+    rng = np.random.default_rng(0)
+    queries = [mutated(tr.comparison_region(), n, rng) for n in range(6) for _ in range(40)]
+    for result in [user_region_query, user_region_alignment]:
+        expected = align_queries(result, queries, tr, ur)
+        assert len(set(map(str, expected))) > 100
+        assert align_queries(result, queries, tr, ur, workers=3) == expected
+
+
+def gapped(target, query, coordinates):
+    """ref/alignment/read lines of the three-line str(alignment) layout."""
+    str_ref, str_align, str_read = '', '', ''
+    for (t0, q0), (t1, q1) in zip(coordinates.T[:-1].tolist(), coordinates.T[1:].tolist()):
+        for i in range(max(t1 - t0, q1 - q0)):
+            ref = target[t0 + i] if t1 > t0 else '-'
+            read = query[q0 + i] if q1 > q0 else '-'
+            str_ref += ref
+            str_read += read
+            str_align += '-' if '-' in (ref, read) else '|' if ref == read else '.'
+    return str_ref, str_align, str_read
+
+
+def parsed_projection(str_ref, str_align, str_read, beg, end):
+    """The projection of the str(alignment) lines the helpers used to do."""
+    if '-' not in str_ref:
+        f = lambda x: x[beg:end]
+    else:
+        mapper = np.cumsum(np.array(list(str_ref)) != '-') - 1
+        f = lambda x: x[np.argmax(mapper == beg):np.argmax(mapper == end)]
+    return f(str_ref), f(str_align), f(str_read)
+
+
+def test_project_alignment_equals_parsed_str():
+    tr, _ = target_region()
+    ref = tr.comparison_region()
+    aligner = get_aligner()
+    rng = np.random.default_rng(0)
+    n_insertions = 0
+    for n in range(8):
+        for _ in range(30):
+            alignment = aligner.align(ref, mutated(ref, n, rng))[0]
+            lines = gapped(ref, alignment.query, alignment_coordinates(alignment))
+            if len(str(alignment).split('\n')) == 4:
+                # the layout of biopython < 1.80
+                assert str(alignment).split('\n')[:3] == list(lines)
+            n_insertions += '-' in lines[0]
+            for beg, end in [(0, len(ref)), (30, 90), (59, 60), (100, len(ref)), (0, 1)]:
+                assert project_alignment(alignment, beg, end) == parsed_projection(*lines, beg, end)
+    assert n_insertions > 50
+
+
+@pytest.mark.parametrize('open_gap_score, threshold', [(-2.01, 2), (-20, 19)])
+def test_fast_path_threshold_is_tight(open_gap_score, threshold):
+    assert max_ungapped_mismatches(get_aligner(open_gap_score)) == threshold
+    tr, ur = target_region()
+    ref = tr.comparison_region()
+    beg, end = ur.beg - tr.cmp_beg, ur.end - tr.cmp_beg
+    at, over = shifted(ref, threshold, beg, end), shifted(ref, threshold + 1, beg, end)
+    assert at and over
+    aligned = align_queries(user_region_alignment, at + over, tr, ur, open_gap_score, max_mismatches=-1)
+    ungapped = [user_region_alignment(x) for x in triage_ungapped(tr, ur, at + over, threshold + 1)]
+    # at the threshold the ungapped alignment is the aligner's; one more
+    # mismatch and the aligner prefers the gaps
+    assert aligned[:len(at)] == ungapped[:len(at)]
+    assert all(a != u for a, u in zip(aligned[len(at):], ungapped[len(at):]))
+    assert align_queries(user_region_alignment, at + over, tr, ur, open_gap_score) == aligned
+    assert align_queries(user_region_alignment, at + over, tr, ur, open_gap_score, max_mismatches=100) == aligned
+
+
+@pytest.mark.parametrize('open_gap_score, threshold', [(-2.01, 2), (-20, 19)])
+def test_fast_path_equals_aligner_at_threshold(open_gap_score, threshold):
+    tr, ur = target_region()
+    ref = tr.comparison_region()
+    rng = np.random.default_rng(0)
+    n_subs = [n for n in [0, threshold - 1, threshold, threshold + 1, threshold + 2] if n >= 0]
+    queries = [substituted(ref, n, rng) for n in n_subs for _ in range(50)]
+    for result in [user_region_alignment, user_region_query]:
+        stats = Counter()
+        fast = align_queries(result, queries, tr, ur, open_gap_score, stats=stats)
+        assert stats['fast_path'] == sum(n <= threshold for n in n_subs) * 50
+        assert fast == align_queries(result, queries, tr, ur, open_gap_score, max_mismatches=-1)
+        # a larger max_mismatches is capped at the threshold
+        assert align_queries(result, queries, tr, ur, open_gap_score, max_mismatches=100) == fast
+
+
+INDICATOR = 'CCTAGCCGTTTACTC'
+
+
+@pytest.mark.parametrize('reverse', [False, True])
+def test_locate_indicators_equals_match_upto_1(reverse):
+    idc = INDICATOR
+    one_mismatch = idc[:3] + 'G' + idc[4:]
+    two_mismatches = idc[:3] + 'G' + idc[4:10] + 'A' + idc[11:]
+    snd_half_only = 'A' + idc[1:]
+    reads = ['GATTACA' + idc + 'GATTACA',              # exact
+             'GATTACA' + one_mismatch + 'GATTACA',     # one mismatch in the first half
+             'GATTACA' + snd_half_only + 'GATTACA',    # one mismatch, first half broken
+             'GATTACA' + two_mismatches + 'GATTACA',   # two mismatches: no hit
+             idc + 'GATTACA',                          # at the read start
+             'GATTACA' + idc,                          # at the read end
+             'GATTACA' + idc[:-1],                     # hanging over the end by one base
+             'GATTACA' + idc[:-2],                     # by two bases: no hit
+             idc,
+             one_mismatch + 'A' + idc,                 # an exact first half is preferred
+             idc + 'A' + idc,                          # leftmost hit (rightmost if reverse)
+             '',
+             'ACGT']
+    rng = np.random.default_rng(0)
+    for _ in range(300):
+        read = list(''.join(rng.choice(list('ACGT'), rng.integers(10, 60))))
+        pos = rng.integers(-5, len(read))
+        read[max(0, pos):pos + len(idc)] = idc[max(0, -pos):]
+        for _ in range(rng.integers(0, 3)):
+            read[rng.integers(len(read))] = 'ACGT'[rng.integers(4)]
+        reads.append(''.join(read))
+    expected = [matchUpto1(idc, read, reverse) for read in reads]
+    assert expected[:11] == [7, 7, 7, -1, 0, 7, 7, -1, 0, 16, 16 if reverse else 0]
+    assert locate_indicators(idc, reads, reverse).tolist() == expected
+    # alone, each read is the widest of its block
+    assert [locate_indicators(idc, [read], reverse).tolist()[0] for read in reads[:13]] == expected[:13]
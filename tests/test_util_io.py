@@ -0,0 +1,147 @@
+import asyncio
+import gzip
+import time
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from helpers import BASELINE, copy_reads, run_program
+import pea.util_io as util_io
+from pea.util_io import PHRED_OFFSET, REJECT_REASONS, ReadFilter, iter_fastq, read_table, write_table
+from pea.util_io import get_async_eventloop, run_async_commands, input_commands
+
+
+ALIGN_TABLE = BASELINE / 'plate.1.fastqjoin.aseq1.site1.align_mutations.o1.align.csv'
+COUNT_TABLE = BASELINE / 'plate.1.fastqjoin.aseq1.trg1.mut1.prime_editor.p1.count.csv'
+
+
+def test_parquet_tables_round_trip(tmp_path):
+    df = read_table(ALIGN_TABLE)
+    write_table(df, tmp_path / 'align.parquet')
+    # the alignment strings are dictionary-encoded in the file
+    assert (pd.read_parquet(tmp_path / 'align.parquet', engine='fastparquet').dtypes[['ref', 'alignment', 'read']]
+            == 'category').all()
+    pd.testing.assert_frame_equal(read_table(tmp_path / 'align.parquet'), df, check_dtype=False)
+    pd.testing.assert_frame_equal(read_table(tmp_path / 'align.parquet', ['read', 'n_reads']), df[['read', 'n_reads']],
+                                  check_dtype=False)
+
+    counts = pd.read_csv(COUNT_TABLE, index_col=0, keep_default_na=False)
+    write_table(counts, tmp_path / 'count.parquet', index=True)
+    pd.testing.assert_frame_equal(pd.read_parquet(tmp_path / 'count.parquet', engine='fastparquet'), counts,
+                                  check_dtype=False, check_index_type=False)
+
+
+def test_parquet_output_equals_csv_output(tmp_path):
+    copy_reads(tmp_path)
+    run_program(tmp_path, 'o1', '--input', 'plate/1.fastqjoin', '--output_format', 'parquet')
+    df = read_table(tmp_path / ALIGN_TABLE.name.replace('.csv', '.parquet'))
+    expected = read_table(ALIGN_TABLE)
+    pd.testing.assert_frame_equal(df.sort_values(list(df.columns)).reset_index(drop=True),
+                                  expected.sort_values(list(df.columns)).reset_index(drop=True), check_dtype=False)
+
+
+def naive_reject_code(read_filter, seq, qual=None):
+    """Index in REJECT_REASONS of the first criterion seq fails, or -1."""
+    quals = [ord(c) - PHRED_OFFSET for c in qual] if qual is not None else None
+    checks = [read_filter.max_n is not None and seq.count('N') > read_filter.max_n,
+              (read_filter.min_length is not None and len(seq) < read_filter.min_length) or
+              (read_filter.max_length is not None and len(seq) > read_filter.max_length),
+              quals is not None and read_filter.min_mean_quality is not None and
+              (not quals or sum(quals) / len(quals) < read_filter.min_mean_quality),
+              quals is not None and read_filter.min_base_quality is not None and
+              bool(quals) and min(quals) < read_filter.min_base_quality]
+    return checks.index(True) if any(checks) else -1
+
+
+def random_records(n, rng):
+    seqs = [''.join(rng.choice(list('ACGTN'), rng.integers(0, 30), p=[0.24, 0.24, 0.24, 0.24, 0.04])) for _ in range(n)]
+    quals = [''.join(chr(PHRED_OFFSET + q) for q in rng.integers(rng.integers(0, 30), 41, len(x))) for x in seqs]
+    return seqs, quals
+
+
+@pytest.mark.parametrize('read_filter', [ReadFilter(max_n=0), ReadFilter(max_n=1, min_length=10, max_length=25),
+                                         ReadFilter(min_mean_quality=25.5), ReadFilter(min_base_quality=10),
+                                         ReadFilter(1, 5, 20, 20, 5)])
+def test_reject_codes_equal_checking_each_read(read_filter):
+    seqs, quals = random_records(500, np.random.default_rng(0))
+    codes = read_filter.reject_codes([x.encode() for x in seqs], [x.encode() for x in quals]).tolist()
+    assert codes == [naive_reject_code(read_filter, x, q) for x, q in zip(seqs, quals)]
+    assert len(set(codes)) > 1
+    codes = read_filter.reject_codes([x.encode() for x in seqs]).tolist()
+    assert codes == [naive_reject_code(read_filter, x) for x in seqs]
+
+
+def test_iter_fastq_drops_and_counts_rejected_reads(tmp_path):
+    seqs, quals = random_records(3000, np.random.default_rng(1))
+    with gzip.open(tmp_path / 'reads.fastqjoin', 'wt') as f:
+        f.writelines(f'@r{i}\r\n{x}\r\n+\r\n{q}\r\n' for i, (x, q) in enumerate(zip(seqs, quals)))
+    read_filter = ReadFilter(1, 5, 25, 22, 3)
+    rejected = Counter()
+    records = list(iter_fastq(tmp_path / 'reads.fastqjoin', with_quality=True, read_filter=read_filter,
+                              rejected=rejected, chunk_size=1000))
+    codes = [naive_reject_code(read_filter, x, q) for x, q in zip(seqs, quals)]
+    assert records == [(x, q) for x, q, code in zip(seqs, quals, codes) if code < 0]
+    assert rejected == Counter(REJECT_REASONS[code] for code in codes if code >= 0)
+    assert list(iter_fastq(tmp_path / 'reads.fastqjoin', read_filter=read_filter)) == [x for x, _ in records]
+    assert list(iter_fastq(tmp_path / 'reads.fastqjoin', with_quality=True, chunk_size=1000)) == list(zip(seqs, quals))
+    assert list(iter_fastq(tmp_path / 'reads.fastqjoin', read_filter=ReadFilter())) == seqs
+
+
+def run_timed(cmds, **kwargs):
+    loop = get_async_eventloop()
+    try:
+        t = time.perf_counter()
+        results = run_async_commands(loop, cmds, **kwargs)
+        return results, time.perf_counter() - t
+    finally:
+        loop.close()
+
+
+class FakeJobs:
+    """run_logged_command of jobs that take 300 MiB of 1000 once they have
+    loaded their input; records the most that ran at once."""
+    def __init__(self):
+        self.running = self.loaded = self.most_running = 0
+
+    def available_memory_mb(self):
+        return 1000 - 300 * self.loaded
+
+    async def run_logged_command(self, cmd, log_path, timeout=None):
+        self.running += 1
+        self.most_running = max(self.most_running, self.running)
+        await asyncio.sleep(0.01)
+        self.loaded += 1
+        await asyncio.sleep(0.1)
+        self.loaded -= 1
+        self.running -= 1
+        return 0
+
+
+@pytest.mark.parametrize('min_free_memory_mb, settle_seconds, most_running', [
+    (None, 0.05, 3),  # no memory limit
+    (50, 0.05, 3),    # memory to spare
+    (500, 0.05, 2),   # short once two jobs have loaded their inputs
+    (800, 0.05, 1),   # short once a job has loaded its input
+    (800, 0, 3),      # checked before the jobs have loaded their inputs
+])
+def test_memory_admission_waits_while_memory_is_short(tmp_path, monkeypatch, min_free_memory_mb, settle_seconds,
+                                                      most_running):
+    jobs = FakeJobs()
+    monkeypatch.setattr(util_io, 'available_memory_mb', jobs.available_memory_mb)
+    monkeypatch.setattr(util_io, 'run_logged_command', jobs.run_logged_command)
+    results, _ = run_timed(['true'] * 3, max_jobs=3, log_dir=tmp_path, min_free_memory_mb=min_free_memory_mb,
+                           poll_seconds=0.01, settle_seconds=settle_seconds)
+    assert [r.exit_code for r in results] == [0] * 3
+    assert jobs.most_running == most_running
+
+
+def test_exit_codes_logs_timeouts_and_retries(tmp_path):
+    cmds = input_commands('sh -c "echo {input}; echo error >&2; exit 3"', ['a/1.fastqjoin', 'b/1.fastqjoin'])
+    cmds['slow'] = 'sleep 10'
+    results, seconds = run_timed(cmds, max_jobs=3, timeout=0.5, retries=1, log_dir=tmp_path)
+    assert [(r.name, r.exit_code, r.attempts) for r in results] == \
+        [('a.1.fastqjoin', 3, 2), ('b.1.fastqjoin', 3, 2), ('slow', None, 2)]
+    assert seconds < 5
+    assert (tmp_path / 'a.1.fastqjoin.log').read_text().count('a/1.fastqjoin\nerror\n') == 2